@@ -19,6 +19,7 @@ import logging
 from uuid import uuid4
 import diskcache
 import os
+import hashlib
 from modules.scRNAseq import ScRNAseq
 
 # LBAE modules
@@ -38,6 +39,7 @@ from modules.atlas import Atlas
 from modules.launch import Launch
 from modules.storage import Storage
 from modules.scRNAseq import ScRNAseq
+from modules.tools.image import ImageStore, URL_IMAGES, URL_TILES
 
 # ==================================================================================================
 # --- App pre-computations
@@ -60,8 +62,8 @@ else:
     path_db = "data/app_data/data.db"
     cache_dir = "data/cache/"
 
-# Load shelve database
-storage = Storage(path_db)
+# Load shelve database (the atlas hierarchy is always kept in memory once loaded)
+storage = Storage(path_db, l_pinned_prefixes=("atlas/atlas_objects/hierarchy",))
 
 # Load data
 data = MaldiData(path_data, path_annotations, sample_data=SAMPLE_DATA)
@@ -70,11 +72,14 @@ data = MaldiData(path_data, path_annotations, sample_data=SAMPLE_DATA)
 # been done). Used for debugging purposes.
 sample = False
 
+# Folder in which the images of the heatmaps are written, to be served by URL (see serve_image())
+image_store = ImageStore(cache_dir + "images/")
+
 # Load Atlas and Figures objects. At first launch, many objects will be precomputed and shelved in
 # the classes Atlas and Figures.
 atlas = Atlas(data, storage, resolution=25, sample=sample)
 scRNAseq = ScRNAseq()
-figures = Figures(data, storage, atlas, scRNAseq, sample=sample)
+figures = Figures(data, storage, atlas, scRNAseq, sample=sample, image_store=image_store)
 logging.info("Memory use after three main object have been instantiated" + logmem())
 
 
@@ -139,6 +144,59 @@ else:
 cache_flask = Cache()
 cache_flask.init_app(app.server, config=CACHE_CONFIG)  # Comment this line for a faster launch
 
-# Initiate the cache as unlocked
-cache_flask.set("locked-cleaning", False)
-cache_flask.set("locked-reading", False)
+# ==================================================================================================
+# --- Routes
+# ==================================================================================================
+
+
+@server.route(URL_IMAGES + "<key>.<format>")
+def serve_image(key, format):
+    """This function serves the images registered in image_store (i.e. the heatmaps of the
+    figures) as binary files. As the key of an image depends on its content only, the image can't
+    change for a given URL, and can therefore be cached indefinitely by browsers and proxies.
+
+    Args:
+        key (str): The key of the image.
+        format (str): The format of the image ("png" or "webp").
+
+    Returns:
+        (flask.Response): The image, or an empty response if the client already has it.
+    """
+    if key in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        content = image_store.get_image(key, format)
+        if content is None:
+            flask.abort(404)
+        response = flask.Response(content, mimetype="image/" + format)
+    response.set_etag(key)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+@server.route(
+    URL_TILES + "<type_figure>/<int:index_image>/<int:contours>/<int:level>/<int:row>_<int:col>.png"
+)
+def serve_tile(type_figure, index_image, contours, level, row, col):
+    """This function serves the tiles of the basic slice images (see
+    Figures.compute_figure_basic_image_tiled()) as png files. The ETag of a tile is a hash of its
+    content, such that clients can revalidate their cached version cheaply.
+
+    Args:
+        type_figure (str): The type of the basic image.
+        index_image (int): Index of the slice image.
+        contours (int): 1 if the atlas contours are superimposed with the tile, 0 otherwise.
+        level (int): The zoom level of the tile.
+        row (int): The row of the tile in the grid of tiles of the zoom level.
+        col (int): The column of the tile in the grid of tiles of the zoom level.
+
+    Returns:
+        (flask.Response): The tile, or an empty response if the client already has it.
+    """
+    content = figures.return_tile_png(type_figure, index_image, bool(contours), level, row, col)
+    if content is None:
+        flask.abort(404)
+    response = flask.Response(content, mimetype="image/png")
+    response.set_etag(hashlib.sha1(content).hexdigest())
+    response.headers["Cache-Control"] = "public, max-age=86400"
+    return response.make_conditional(flask.request)
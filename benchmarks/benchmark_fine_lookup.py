@@ -0,0 +1,132 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This script benchmarks the computation of lipid images from narrow m/z selections, with and
+without the fine lookup table (see build_fine_index_lookup_table()), which refines the lookup table
+below the resolution given by DIVIDER_LOOKUP. To run it, use the following command in the main lbae
+folder:
+
+`python -m benchmarks.benchmark_fine_lookup [path_slice_npz]`
+
+If the path of a slice npz file (as saved by process_lookup_tables()) is given, its spectra are used
+for the benchmark. Otherwise, a dense synthetic slice is generated.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import sys
+import numpy as np
+
+# LBAE imports
+from modules.tools.lookup_tables import (
+    build_index_lookup_table,
+    build_cumulated_image_lookup_table,
+    build_fine_index_lookup_table,
+    DIVIDER_LOOKUP,
+)
+from modules.tools.spectra import (
+    compute_image_using_index_and_image_lookup,
+    compute_images_using_index_and_image_lookup_batch,
+)
+from benchmarks.benchmark_numba_threads import build_synthetic_slice, load_slice, time_function
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def run_benchmark(array_spectra, array_pixel_indexes, image_shape, mz_range=(400, 1200)):
+    """This function prints the execution time of the computation of lipid images from narrow m/z
+    selections, with and without the fine lookup table, as well as the size of the fine lookup
+    table.
+
+    Args:
+        array_spectra (np.ndarray): The array of spectra of the slice.
+        array_pixel_indexes (np.ndarray): The array of pixel indexes of the slice.
+        image_shape (tuple): The shape of the slice.
+        mz_range (tuple, optional): The m/z range covered by the fine lookup table. Defaults to
+            (400, 1200).
+    """
+    divider_lookup = DIVIDER_LOOKUP
+    lookup_table_spectra = build_index_lookup_table(
+        array_spectra, array_pixel_indexes, divider_lookup
+    )
+    lookup_table_image = build_cumulated_image_lookup_table(
+        array_spectra, array_pixel_indexes, image_shape, divider_lookup
+    )
+    first_bin_fine = int(mz_range[0] / divider_lookup)
+    lookup_table_fine = build_fine_index_lookup_table(
+        array_spectra,
+        array_pixel_indexes,
+        lookup_table_spectra,
+        first_bin_fine,
+        int(np.ceil(mz_range[1] / divider_lookup)) - first_bin_fine,
+        divider_lookup,
+    )
+    array_peaks_transformed_lipids = np.zeros((0, 3), dtype=np.float32)
+    array_corrective_factors = np.zeros((0, image_shape[0], image_shape[1]), dtype=np.float32)
+
+    # Narrow selections located at the end of their bin, i.e. the worst case for the coarse lookup
+    array_bounds = np.array([[500.85 + 30 * i, 500.86 + 30 * i] for i in range(20)])
+
+    print("Slice of shape " + str(image_shape) + " with " + str(array_spectra.shape[1]) + " peaks")
+    print(
+        "Size of the fine lookup table: "
+        + "{:.2f}".format(lookup_table_fine.nbytes / 1024**2)
+        + " MB"
+    )
+    for name, kwargs in [
+        ("coarse", {}),
+        ("fine", {"lookup_table_fine": lookup_table_fine, "first_bin_fine": first_bin_fine}),
+    ]:
+        time_single = time_function(
+            lambda: compute_image_using_index_and_image_lookup(
+                700.85,
+                700.86,
+                array_spectra,
+                array_pixel_indexes,
+                image_shape,
+                lookup_table_spectra,
+                lookup_table_image,
+                divider_lookup,
+                array_peaks_transformed_lipids,
+                array_corrective_factors,
+                **kwargs
+            )
+        )
+        time_batch = time_function(
+            lambda: compute_images_using_index_and_image_lookup_batch(
+                array_bounds,
+                array_spectra,
+                array_pixel_indexes,
+                image_shape,
+                lookup_table_spectra,
+                lookup_table_image,
+                divider_lookup,
+                array_peaks_transformed_lipids,
+                array_corrective_factors,
+                **kwargs
+            )
+        )
+        print(
+            name
+            + " lookup: "
+            + "{:.2f}".format(time_single)
+            + " ms for a 0.01 m/z selection, "
+            + "{:.2f}".format(time_batch)
+            + " ms for a batch of 20"
+        )
+
+
+# ==================================================================================================
+# --- Main
+# ==================================================================================================
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run_benchmark(*load_slice(sys.argv[1]))
+    else:
+        run_benchmark(*build_synthetic_slice(shape=(20, 25), n_peaks=30000))
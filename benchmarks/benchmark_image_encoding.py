@@ -0,0 +1,113 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This script benchmarks the encoding of uint8 lipid images into png, comparing the former path
+(colormap applied to the image, RGBA conversion for transparency, and quantization into a palette)
+with the paletted path of encode_indexed_image_to_png(), for several zlib compression levels. To run
+it, use the following command in the main lbae folder:
+
+`python -m benchmarks.benchmark_image_encoding`
+
+The latencies are reported per megapixel, for synthetic images of the size of an acquired slice and
+of a projected slice.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+from io import BytesIO
+import numpy as np
+from PIL import Image
+
+# LBAE imports
+from config import black_viridis
+from modules.tools.image import black_to_transparency, encode_indexed_image_to_png
+from benchmarks.benchmark_numba_threads import time_function
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def build_synthetic_image(shape):
+    """This function builds a synthetic uint8 lipid image, i.e. a smooth signal with some noise,
+    surrounded by black (empty) pixels.
+
+    Args:
+        shape (tuple): Shape of the image.
+
+    Returns:
+        (np.ndarray): The image.
+    """
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0 : shape[0], 0 : shape[1]] / np.array(shape)[:, None, None]
+    image = np.sin(8 * x) * np.cos(5 * y) + 0.3 * rng.random(shape)
+    image = (image - image.min()) / (image.max() - image.min())
+    image[(x - 0.5) ** 2 + (y - 0.5) ** 2 > 0.2] = 0
+    return np.round(image * 255).astype(np.uint8)
+
+
+def encode_with_former_path(image, optimize=True):
+    """This function encodes an uint8 image in png, as done by convert_image_to_base64() before
+    the paletted path was introduced.
+
+    Args:
+        image (np.ndarray): The image to encode.
+        optimize (bool, optional): If True, PIL optimizes the size of the image. Defaults to True.
+
+    Returns:
+        (bytes): The png image.
+    """
+    pil_img = Image.fromarray(np.uint8(black_viridis(image) * 255))
+    pil_img = black_to_transparency(pil_img)
+    pil_img = pil_img.convert("P")
+    with BytesIO() as stream:
+        pil_img.save(stream, format="png", optimize=optimize, bits=9)
+        return stream.getvalue()
+
+
+def run_benchmark(l_shapes=((320, 456), (1280, 1824))):
+    """This function prints the encoding latency (per megapixel) and the size of the png images,
+    for the former path and the paletted path.
+
+    Args:
+        l_shapes (tuple, optional): Shapes of the images to encode. Defaults to ((320, 456),
+            (1280, 1824)).
+    """
+    for shape in l_shapes:
+        image = build_synthetic_image(shape)
+        n_megapixels = shape[0] * shape[1] / 10**6
+        dic_functions = {
+            "former path (optimize)": lambda: encode_with_former_path(image),
+            "paletted (optimize)": lambda: encode_indexed_image_to_png(
+                image, transparent_zeros=True
+            ),
+        }
+        for compress_level in [1, 6]:
+            dic_functions["paletted (zlib level " + str(compress_level) + ")"] = (
+                lambda compress_level=compress_level: encode_indexed_image_to_png(
+                    image, transparent_zeros=True, compress_level=compress_level
+                )
+            )
+
+        print("Image of shape " + str(shape))
+        for name, function in dic_functions.items():
+            time = time_function(function)
+            print(
+                name
+                + ": "
+                + "{:.2f}".format(time / n_megapixels)
+                + " ms/MP, "
+                + "{:.1f}".format(len(function()) / 1024)
+                + " kB"
+            )
+
+
+# ==================================================================================================
+# --- Main
+# ==================================================================================================
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,144 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This script benchmarks the startup time and memory usage of the loading of the small per-slice
+arrays of the dataset, from light_arrays.pickle against the columnar container (see
+modules/tools/columnar.py). To run it, use the following command in the main lbae folder:
+
+`python -m benchmarks.benchmark_light_arrays [path_data]`
+
+If the path of a dataset containing a (non-compressed) light_arrays.pickle file is given, it is
+used for the benchmark (the columnar container is then saved in its light_arrays folder).
+Otherwise, a synthetic dataset is generated in a temporary folder.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import os
+import pickle
+import sys
+import tempfile
+import time
+import numpy as np
+import psutil
+
+# LBAE imports
+from modules.tools.columnar import save_columnar_arrays, ColumnarArrays
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def build_synthetic_light_arrays(n_slices=32, shape=(320, 456)):
+    """This function builds a dictionnary mimicking the content of light_arrays.pickle.
+
+    Args:
+        n_slices (int, optional): Number of slices to simulate. Defaults to 32.
+        shape (tuple, optional): Shape of the slices. Defaults to (320, 456).
+
+    Returns:
+        (dict): A dictionnary mapping each slice index to a dictionnary of arrays and values.
+    """
+    rng = np.random.default_rng(0)
+    dic_lightweight = {}
+    for slice_index in range(1, n_slices + 1):
+        dic_lightweight[slice_index] = {
+            "image_shape": shape,
+            "divider_lookup": 100,
+            "is_brain_1": slice_index <= n_slices // 2,
+            "array_avg_spectrum_downsampled": rng.random((2, 50000), dtype=np.float32),
+            "array_lookup_pixels": rng.integers(0, 10**8, (shape[0] * shape[1], 2), np.int32),
+            "array_lookup_mz_avg": rng.integers(0, 10**6, 120000, np.int32),
+            "array_peaks_transformed_lipids": rng.random((50, 3), dtype=np.float32),
+            "array_spectra_shape": (2, 10**8),
+            "array_lookup_mz_shape": (1200, shape[0] * shape[1]),
+        }
+    return dic_lightweight
+
+
+def get_rss():
+    """This function returns the resident memory of the current process, in MB.
+
+    Returns:
+        (float): The resident memory, in MB.
+    """
+    return psutil.Process(os.getpid()).memory_info().rss / 1024**2
+
+
+def run_benchmark(path_data):
+    """This function prints the time taken to open the small per-slice arrays, from the pickle file
+    and from the columnar container, as well as the increase of resident memory, and the time taken
+    to access the arrays of a slice.
+
+    Args:
+        path_data (str): The folder containing light_arrays.pickle, in which the columnar container
+            is saved.
+    """
+    path_pickle = os.path.join(path_data, "light_arrays.pickle")
+    path_columnar = os.path.join(path_data, "light_arrays")
+    with open(path_pickle, "rb") as handle:
+        dic_lightweight = pickle.load(handle)
+    t0 = time.perf_counter()
+    save_columnar_arrays(dic_lightweight, path_columnar)
+    print("Conversion: " + "{:.2f}".format((time.perf_counter() - t0) * 1000) + " ms")
+    l_slices = sorted(dic_lightweight.keys())
+    del dic_lightweight
+
+    rss = get_rss()
+    t0 = time.perf_counter()
+    with open(path_pickle, "rb") as handle:
+        dic_lightweight = pickle.load(handle)
+    print(
+        "Pickle: opened in "
+        + "{:.2f}".format((time.perf_counter() - t0) * 1000)
+        + " ms, "
+        + "{:.2f}".format(get_rss() - rss)
+        + " MB of resident memory"
+    )
+    del dic_lightweight
+
+    rss = get_rss()
+    t0 = time.perf_counter()
+    columnar_arrays = ColumnarArrays(path_columnar)
+    print(
+        "Columnar: opened in "
+        + "{:.2f}".format((time.perf_counter() - t0) * 1000)
+        + " ms, "
+        + "{:.2f}".format(get_rss() - rss)
+        + " MB of resident memory"
+    )
+
+    # Access all arrays of a slice, as done when a slice is first displayed
+    slice_index = l_slices[len(l_slices) // 2]
+    t0 = time.perf_counter()
+    for key in columnar_arrays[slice_index].keys():
+        value = columnar_arrays[slice_index][key]
+        if isinstance(value, np.ndarray):
+            value.sum()
+    print(
+        "Columnar: arrays of slice "
+        + str(slice_index)
+        + " read in "
+        + "{:.2f}".format((time.perf_counter() - t0) * 1000)
+        + " ms, "
+        + "{:.2f}".format(get_rss() - rss)
+        + " MB of resident memory"
+    )
+
+
+# ==================================================================================================
+# --- Main
+# ==================================================================================================
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run_benchmark(sys.argv[1])
+    else:
+        with tempfile.TemporaryDirectory() as path_temp:
+            with open(os.path.join(path_temp, "light_arrays.pickle"), "wb") as handle:
+                pickle.dump(build_synthetic_light_arrays(), handle)
+            run_benchmark(path_temp)
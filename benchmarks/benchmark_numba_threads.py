@@ -0,0 +1,191 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This script benchmarks the per-pixel numba functions used to build the lookup tables and to
+compute lipid images, for 1, 2, 4 and 8 threads (see set_numba_threads()). To run it, use the
+following command in the main lbae folder:
+
+`python -m benchmarks.benchmark_numba_threads [path_slice_npz]`
+
+If the path of a slice npz file (as saved by process_lookup_tables()) is given, its spectra are used
+for the benchmark. Otherwise, a synthetic slice is generated. Thread counts above the number of
+threads numba has been started with (NUMBA_NUM_THREADS) are skipped.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import sys
+import time
+import numba
+import numpy as np
+
+# LBAE imports
+from modules.tools.parallel import set_numba_threads, select_numba_function
+from modules.tools.lookup_tables import (
+    build_index_lookup_table,
+    build_index_lookup_table_parallel,
+    build_cumulated_image_lookup_table,
+    build_cumulated_image_lookup_table_parallel,
+    DIVIDER_LOOKUP,
+)
+from modules.tools.spectra import (
+    compute_image_using_index_and_image_lookup,
+    compute_images_using_index_and_image_lookup_batch,
+)
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def build_synthetic_slice(shape=(120, 160), n_peaks=400):
+    """This function builds the spectral data of a synthetic slice.
+
+    Args:
+        shape (tuple, optional): Shape of the slice. Defaults to (120, 160).
+        n_peaks (int, optional): Average number of peaks per pixel. Defaults to 400.
+
+    Returns:
+        (np.ndarray, np.ndarray, tuple): The array of spectra, the array of pixel indexes, and the
+            shape of the slice.
+    """
+    rng = np.random.default_rng(0)
+    n_pixels = shape[0] * shape[1]
+    array_n_peaks = rng.integers(n_peaks // 2, 3 * n_peaks // 2, n_pixels)
+    array_n_peaks[rng.random(n_pixels) < 0.2] = 0
+    array_pixel_indexes = np.full((n_pixels, 2), -1, dtype=np.int32)
+    array_ends = np.cumsum(array_n_peaks)
+    array_pixel_indexes[array_n_peaks > 0, 0] = (array_ends - array_n_peaks)[array_n_peaks > 0]
+    array_pixel_indexes[array_n_peaks > 0, 1] = array_ends[array_n_peaks > 0] - 1
+    array_spectra = np.empty((2, array_ends[-1]), dtype=np.float32)
+    for idx_pix in np.flatnonzero(array_n_peaks):
+        i, j = array_pixel_indexes[idx_pix]
+        array_spectra[0, i : j + 1] = np.sort(rng.uniform(400, 1200, j + 1 - i))
+    array_spectra[1] = rng.random(array_ends[-1], dtype=np.float32)
+    return array_spectra, array_pixel_indexes, shape
+
+
+def load_slice(path_npz):
+    """This function loads the spectral data of a slice from a npz file.
+
+    Args:
+        path_npz (str): Path of the npz file.
+
+    Returns:
+        (np.ndarray, np.ndarray, tuple): The array of spectra, the array of pixel indexes, and the
+            shape of the slice.
+    """
+    with np.load(path_npz) as npzfile:
+        return (
+            npzfile["array_spectra_high_res"],
+            npzfile["array_pixel_indexes_high_res"],
+            tuple(npzfile["image_shape"]),
+        )
+
+
+def time_function(function, n_repeats=3):
+    """This function returns the best execution time (in ms) of function over n_repeats runs, after
+    a first run used for compilation.
+
+    Args:
+        function (func): Function without argument to time.
+        n_repeats (int, optional): Number of runs. Defaults to 3.
+
+    Returns:
+        (float): The best execution time, in ms.
+    """
+    function()
+    l_times = []
+    for _ in range(n_repeats):
+        t0 = time.perf_counter()
+        function()
+        l_times.append((time.perf_counter() - t0) * 1000)
+    return min(l_times)
+
+
+def run_benchmark(array_spectra, array_pixel_indexes, image_shape):
+    """This function prints the execution time of the per-pixel numba functions for 1, 2, 4 and 8
+    threads.
+
+    Args:
+        array_spectra (np.ndarray): The array of spectra of the slice.
+        array_pixel_indexes (np.ndarray): The array of pixel indexes of the slice.
+        image_shape (tuple): The shape of the slice.
+    """
+    divider_lookup = DIVIDER_LOOKUP
+    lookup_table_spectra = build_index_lookup_table(
+        array_spectra, array_pixel_indexes, divider_lookup
+    )
+    lookup_table_image = build_cumulated_image_lookup_table(
+        array_spectra, array_pixel_indexes, image_shape, divider_lookup
+    )
+    array_peaks_transformed_lipids = np.zeros((0, 3), dtype=np.float32)
+    array_corrective_factors = np.zeros((0, image_shape[0], image_shape[1]), dtype=np.float32)
+    array_bounds = np.array([[500.0 + 30 * i, 500.3 + 30 * i] for i in range(20)])
+
+    dic_functions = {
+        "build_index_lookup_table": lambda: select_numba_function(
+            build_index_lookup_table, build_index_lookup_table_parallel
+        )(array_spectra, array_pixel_indexes, divider_lookup),
+        "build_cumulated_image_lookup_table": lambda: select_numba_function(
+            build_cumulated_image_lookup_table, build_cumulated_image_lookup_table_parallel
+        )(array_spectra, array_pixel_indexes, image_shape, divider_lookup),
+    }
+    for name, (lb, hb) in [("narrow", (700.1, 700.4)), ("wide", (700.1, 720.4))]:
+        dic_functions["image from " + name + " selection"] = (
+            lambda lb=lb, hb=hb: compute_image_using_index_and_image_lookup(
+                lb,
+                hb,
+                array_spectra,
+                array_pixel_indexes,
+                image_shape,
+                lookup_table_spectra,
+                lookup_table_image,
+                divider_lookup,
+                array_peaks_transformed_lipids,
+                array_corrective_factors,
+            )
+        )
+    dic_functions["batch of 20 images"] = lambda: compute_images_using_index_and_image_lookup_batch(
+        array_bounds,
+        array_spectra,
+        array_pixel_indexes,
+        image_shape,
+        lookup_table_spectra,
+        lookup_table_image,
+        divider_lookup,
+        array_peaks_transformed_lipids,
+        array_corrective_factors,
+    )
+
+    l_n_threads = [n for n in [1, 2, 4, 8] if n <= numba.config.NUMBA_NUM_THREADS]
+    print("Slice of shape " + str(image_shape) + " with " + str(array_spectra.shape[1]) + " peaks")
+    print("Threads: " + ", ".join([str(n) for n in l_n_threads]))
+    for name, function in dic_functions.items():
+        l_times = []
+        for n_threads in l_n_threads:
+            set_numba_threads(n_threads)
+            l_times.append(time_function(function))
+        print(
+            name
+            + ": "
+            + ", ".join(["{:.2f}".format(t) + " ms" for t in l_times])
+            + " (speedup x"
+            + "{:.1f}".format(l_times[0] / l_times[-1])
+            + ")"
+        )
+    set_numba_threads(1)
+
+
+# ==================================================================================================
+# --- Main
+# ==================================================================================================
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run_benchmark(*load_slice(sys.argv[1]))
+    else:
+        run_benchmark(*build_synthetic_slice())
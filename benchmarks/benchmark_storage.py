@@ -0,0 +1,166 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This script benchmarks the loading of objects from the Storage class against the former
+shelve-based implementation, in which a shelve database was opened for every single call. It
+focuses on the entries under the 'figures/load_page' and 'atlas/atlas_objects' folders, which are
+queried by slider- and hover-driven callbacks. To run it, use the following command in the main
+lbae folder:
+
+`python -m benchmarks.benchmark_storage [path_legacy_shelve]`
+
+If the path of an existing shelve database is given, its entries are used for the benchmark.
+Otherwise, synthetic entries mimicking the real ones are generated in a temporary folder.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import os
+import shelve
+import sys
+import tempfile
+import time
+import numpy as np
+
+# LBAE imports
+from modules.storage import Storage
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def build_synthetic_entries(n_slices=10, n_masks=20, shape=(320, 456)):
+    """This function builds a dictionnary of objects mimicking the entries of the app database.
+
+    Args:
+        n_slices (int, optional): Number of slices to simulate. Defaults to 10.
+        n_masks (int, optional): Number of masks per slice to simulate. Defaults to 20.
+        shape (tuple, optional): Shape of the images. Defaults to (320, 456).
+
+    Returns:
+        (dict): A dictionnary mapping database keys to objects.
+    """
+    rng = np.random.default_rng(0)
+    dic_entries = {}
+    for slice_index in range(n_slices):
+        # Figures of the load_slice page, which basically embed a base64 string
+        key = "figures/load_page/figure_basic_image_projection_corrected_" + str(slice_index)
+        dic_entries[key + "_False"] = {
+            "data": [{"type": "image", "source": "data:image/png;base64," + "A" * 300000}],
+            "layout": {"margin": dict(t=0, r=0, b=0, l=0)},
+        }
+
+        # Masks and spectra of the region analysis page
+        for id_mask in range(n_masks):
+            projected_mask = np.zeros(shape, dtype=np.uint8)
+            projected_mask[rng.integers(0, shape[0] // 2) :, rng.integers(0, shape[1] // 2) :] = 1
+            spectrum = rng.random((2, 5000), dtype=np.float32)
+            dic_entries[
+                "atlas/atlas_objects/mask_and_spectrum_" + str(slice_index) + "_" + str(id_mask)
+            ] = (projected_mask, spectrum)
+
+    dic_entries["figures/load_page/array_basic_images_warped_data"] = rng.random(
+        (n_slices,) + shape, dtype=np.float32
+    )
+    dic_entries["atlas/atlas_objects/hierarchy"] = (
+        [str(i) for i in range(1000)],
+        {str(i): [str(j) for j in range(10)] for i in range(1000)},
+    )
+    return dic_entries
+
+
+def load_entries_from_shelve(path_shelve):
+    """This function loads the entries of interest from an existing shelve database.
+
+    Args:
+        path_shelve (str): Path of the shelve database.
+
+    Returns:
+        (dict): A dictionnary mapping database keys to objects.
+    """
+    with shelve.open(path_shelve, flag="r") as db:
+        return {
+            key: db[key]
+            for key in db
+            if key.startswith("figures/load_page") or key.startswith("atlas/atlas_objects")
+        }
+
+
+def time_loads(load_function, l_keys, n_repeats=3):
+    """This function times the loading of all the keys in l_keys.
+
+    Args:
+        load_function (func): Function taking a key as argument and returning the object.
+        l_keys (list): List of keys to load.
+        n_repeats (int, optional): Number of times each key is loaded. Defaults to 3.
+
+    Returns:
+        (float): The average time (in ms) taken to load one key.
+    """
+    t0 = time.perf_counter()
+    for _ in range(n_repeats):
+        for key in l_keys:
+            load_function(key)
+    return (time.perf_counter() - t0) * 1000 / (n_repeats * len(l_keys))
+
+
+def run_benchmark(dic_entries, path_folder):
+    """This function writes dic_entries both in a shelve database and in the Storage class, and
+    prints the average loading time per prefix for both implementations.
+
+    Args:
+        dic_entries (dict): A dictionnary mapping database keys to objects.
+        path_folder (str): Path of the folder in which the databases are written.
+    """
+    # Write legacy shelve
+    path_shelve = os.path.join(path_folder, "legacy.db")
+    with shelve.open(path_shelve) as db:
+        for key, object in dic_entries.items():
+            db[key] = object
+
+    # Write new storage
+    storage = Storage(os.path.join(path_folder, "storage"))
+    for key, object in dic_entries.items():
+        data_folder, file_name = key.rsplit("/", 1)
+        storage.dump_shelved_object(data_folder, file_name, object)
+
+    def load_shelve(key):
+        with shelve.open(path_shelve) as db:
+            return db[key]
+
+    def load_storage(key):
+        data_folder, file_name = key.rsplit("/", 1)
+        return storage.load_shelved_object(data_folder, file_name)
+
+    for prefix in ["figures/load_page", "atlas/atlas_objects"]:
+        l_keys = [key for key in dic_entries if key.startswith(prefix)]
+        t_shelve = time_loads(load_shelve, l_keys)
+        t_storage = time_loads(load_storage, l_keys)
+        print(
+            prefix
+            + " ("
+            + str(len(l_keys))
+            + " keys): shelve "
+            + "{:.3f}".format(t_shelve)
+            + " ms/load, storage "
+            + "{:.3f}".format(t_storage)
+            + " ms/load, speedup x"
+            + "{:.1f}".format(t_shelve / t_storage)
+        )
+
+
+# ==================================================================================================
+# --- Main
+# ==================================================================================================
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        dic_entries = load_entries_from_shelve(sys.argv[1])
+    else:
+        dic_entries = build_synthetic_entries()
+    with tempfile.TemporaryDirectory() as path_folder:
+        run_benchmark(dic_entries, path_folder)
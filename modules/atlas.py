@@ -19,19 +19,25 @@ import io
 import skimage
 from imageio import imread
 import shutil
+import time
 
 # LBAE imports
 from modules.tools.atlas import (
-    project_atlas_mask,
-    get_array_rows_from_atlas_mask,
+    project_atlas_annotation,
+    compute_mask_runs,
+    compute_mask_runs_per_structure,
+    compute_last_projected_pixels,
+    get_array_rows_from_mask_runs,
     fill_array_projection,
     solve_plane_equation,
     compute_simplified_atlas_annotation,
     compute_array_images_atlas,
+    compute_projection_flat_indices,
 )
 from modules.tools.spectra import compute_spectrum_per_row_selection, compute_thread_safe_function
 from modules.atlas_labels import Labels
 from modules.tools.misc import logmem
+from modules.tools.parallel import run_tasks_in_parallel
 
 
 # ==================================================================================================
@@ -67,6 +73,11 @@ class Atlas:
             acronym, a specific name.
         array_projection_correspondence_corrected (np.ndarray): An array that contains encodes the
             warping/upscaling transformation of the data.
+        array_projection_flat_indices (np.ndarray): An array that contains, for each slice and each
+            pixel of the warped data, the flat index of the corresponding pixel in the original
+            acquisition.
+        array_label_planes (np.ndarray): An array that contains, for each slice and each pixel of
+            the warped data, the index of the corresponding label in labels.array_names.
         l_original_coor (list(np.ndarray)): A list of arrays that contains the coordinates of the
             original data in the CCFv3.
         dic_existing_masks (dict): A dictionnary of existing masks per slice, which associates slice
@@ -90,19 +101,28 @@ class Atlas:
         compute_array_projection(nearest_neighbour_correction=False, atlas_correction=False):
             Compute three arrays relating the original coordinates of our data to their projection
             in the CCFv3.
+        compute_array_projection_flat_indices(): Compute, for each slice, the array of flat indices
+            associating the pixels of the warped data to the pixels of the original acquisition.
+        compute_array_label_planes(): Compute, for each slice, the plane of labels of the warped
+            data.
         compute_projection_parameters(): Compute the parameters used to map the 3D coordinates of
             the CCFv3 to the the 2D (tiled) slices.
         compute_list_projected_atlas_borders_figures(): Compute an array of projected atlas borders.
         prepare_and_compute_array_images_atlas(zero_out_of_annotation=False): Wrapper for
             compute_array_images_atlas.
         get_atlas_mask(structure): Compute a mask for the structure given as argument.
+        compute_projected_masks_runs(slice_index, l_id_mask, slice_coor_rescaled=None): Compute the
+            projected masks of several structures on a given slice, in a single pass.
         compute_spectrum_data(slice_index, projected_mask=None, mask_name=None,
-            slice_coor_rescaled=None, MAIA_correction=False, cache_flask=None): Compute the averaged
-            spectral data for a given slice and a given mask.
-        save_all_projected_masks_and_spectra(force_update=False, cache_flask=None, sample=False):
-            Save all the (2D) masks and corresponding averaged spectral data, for all the slices.
+            slice_coor_rescaled=None, MAIA_correction=False, cache_flask=None, array_mask_runs=None,
+            array_last_pixels=None): Compute the averaged spectral data for a given slice and a
+            given mask.
+        save_all_projected_masks_and_spectra(force_update=False, cache_flask=None, sample=False,
+            n_workers=None): Save all the (2D) masks and corresponding averaged spectral data, for
+            all the slices, in parallel.
         get_projected_mask_and_spectrum(slice_index, mask_name, MAIA_correction=False): Get the
-            projected mask and corresponding averaged spectral data for a given mask and slice.
+            projected mask (encoded as runs) and corresponding averaged spectral data for a given
+            mask and slice.
 
     """
 
@@ -166,11 +186,10 @@ class Atlas:
         # longitudinal direction, otherwise it's too heavy
         self.subsampling_block = 20
 
-        # Load string annotation for contour plot, for each voxel.
-        # These objects are heavy (~300mb) as they force the loading of annotations from the core
-        # Atlas class. But they shouldn't be memory-mapped as they are called when hovering and
-        # require very fast response from the server
-        self.labels = Labels(self.bg_atlas, force_init=True)
+        # Load string annotation for contour plot, for each voxel. Only the (light) table of
+        # structure names is loaded, as hovering relies on the label planes of the slices (see
+        # self.array_label_planes), such that the annotations (~300mb) don't need to be in memory
+        self.labels = Labels(self.bg_atlas, force_init=False)
 
         # Compute a dictionnary that associates to each structure (acronym) the set of ids (int) of
         # all of its children. Used only in page_4_plot_graph_volume, but it's very light (~3mb) so
@@ -225,6 +244,26 @@ class Atlas:
             atlas_correction=True,
         )[1]
 
+        # Flat version of the projection correspondence, used to project lipid images with a single
+        # gather. It is memory-mapped, and therefore shared across requests.
+        # Weights ~150mb, as array_projection_correspondence_corrected
+        self.array_projection_flat_indices = self.storage.return_shelved_object(
+            "atlas/atlas_objects",
+            "array_projection_flat_indices",
+            force_update=False,
+            compute_function=self.compute_array_projection_flat_indices,
+        )
+
+        # Label planes of the slices, used to get the hovered brain region with a single lookup.
+        # It is memory-mapped, and therefore shared across requests.
+        # Weights ~75mb
+        self.array_label_planes = self.storage.return_shelved_object(
+            "atlas/atlas_objects",
+            "array_label_planes",
+            force_update=False,
+            compute_function=self.compute_array_label_planes,
+        )
+
         # Load arrays of original images coordinates. It is used everytime a 3D object is computed.
         # Weights ~50mb
         self.l_original_coor = self.storage.return_shelved_object(
@@ -487,6 +526,49 @@ class Atlas:
 
         return array_projection, array_projection_correspondence, l_original_coor
 
+    def compute_array_projection_flat_indices(self):
+        """Compute, for each slice, the array of flat indices associating each pixel of the warped
+        higher-resolution image to the corresponding pixel of the flattened original acquisition
+        (see compute_projection_flat_indices()).
+
+        Returns:
+            (np.ndarray): A three-dimensional array of flat indices, with -1 corresponding to
+                unassigned pixels.
+        """
+        array_projection_flat_indices = np.empty(
+            self.array_projection_correspondence_corrected.shape[:-1], dtype=np.int32
+        )
+        for i in range(array_projection_flat_indices.shape[0]):
+            array_projection_flat_indices[i] = compute_projection_flat_indices(
+                self.array_projection_correspondence_corrected[i],
+                np.array(self.data.get_image_shape(i + 1)),
+            )
+        return array_projection_flat_indices
+
+    def compute_array_label_planes(self):
+        """Compute, for each slice, the plane of labels of the warped data, i.e. the compact index
+        (see Labels.get_label_indices()) of the finest structure of the atlas containing each pixel.
+
+        Returns:
+            (np.ndarray): A three-dimensional array of label indices, such that
+                self.labels.array_names[array_label_planes[slice_index, x, y]] is the name of the
+                structure at coordinates (x, y) of the slice slice_index.
+        """
+        array_label_planes = np.empty(
+            self.array_coordinates_warped_data.shape[:-1], dtype=np.uint16
+        )
+        for slice_index in range(array_label_planes.shape[0]):
+            slice_coor_rescaled = np.asarray(
+                (
+                    self.array_coordinates_warped_data[slice_index, :, :] * 1000 / self.resolution
+                ).round(0),
+                dtype=np.int16,
+            )
+            array_label_planes[slice_index] = self.labels.get_label_indices(
+                project_atlas_annotation(self.bg_atlas.annotation, slice_coor_rescaled)
+            )
+        return array_label_planes
+
     def compute_projection_parameters(self):
         """Compute the parameters used to map the 3D coordinates of the CCFv3 to the the 2D (tiled)
         slices.
@@ -618,6 +700,68 @@ class Atlas:
         logging.info('Mask computed for structure "{}"'.format(structure))
         return mask_stack
 
+    def compute_projected_masks_runs(self, slice_index, l_id_mask, slice_coor_rescaled=None):
+        """Compute the projected masks (encoded as runs, see compute_mask_runs()) of several
+        structures on a given slice. As opposed to get_atlas_mask(), which requires a pass over the
+        whole annotation volume per structure, the annotation is only projected once on the slice,
+        and each projected structure id is then assigned to all of its ancestors, such that the
+        masks of all structures are obtained in a single sweep over the slice.
+
+        Args:
+            slice_index (int): Index of the requested slice.
+            l_id_mask (list(str)): List of structures (acronyms) whose masks are requested.
+            slice_coor_rescaled (np.ndarray, optional): The array of coordinates in the CCFv3 for
+                the current slice. Computed if not provided. Defaults to None.
+
+        Returns:
+            (dict): A dictionnary that associates to each requested structure (acronym) its
+                projected mask on the slice, encoded as a list of runs.
+        """
+        if slice_coor_rescaled is None:
+            slice_coor_rescaled = np.asarray(
+                (
+                    self.array_coordinates_warped_data[slice_index, :, :] * 1000 / self.resolution
+                ).round(0),
+                dtype=np.int16,
+            )
+
+        # Project the annotation on the slice, and relabel the structure ids contiguously
+        projected_annotation = project_atlas_annotation(
+            self.bg_atlas.annotation, slice_coor_rescaled
+        )
+        array_id, projected_labels = np.unique(projected_annotation, return_inverse=True)
+        projected_labels = projected_labels.reshape(projected_annotation.shape).astype(np.int32)
+
+        # Build the table associating to each label the indexes of the requested structures that
+        # contain it (i.e. the structure itself and its ancestors)
+        dic_index_structure = {
+            self.bg_atlas.structures[id_mask]["id"]: idx for idx, id_mask in enumerate(l_id_mask)
+        }
+        ll_ancestors = [
+            [
+                dic_index_structure[id_ancestor]
+                for id_ancestor in self.bg_atlas.structures[int(id)]["structure_id_path"]
+                if id_ancestor in dic_index_structure
+            ]
+            if int(id) in self.bg_atlas.structures
+            else []
+            for id in array_id
+        ]
+        array_ancestors = np.full(
+            (len(ll_ancestors), max([1] + [len(l) for l in ll_ancestors])), -1, dtype=np.int32
+        )
+        for idx_label, l_ancestors in enumerate(ll_ancestors):
+            array_ancestors[idx_label, : len(l_ancestors)] = l_ancestors
+
+        # Compute the runs of all structures in one sweep
+        array_runs, array_offsets = compute_mask_runs_per_structure(
+            projected_labels, array_ancestors, len(l_id_mask)
+        )
+        return {
+            id_mask: array_runs[array_offsets[idx] : array_offsets[idx + 1]]
+            for idx, id_mask in enumerate(l_id_mask)
+        }
+
     def compute_spectrum_data(
         self,
         slice_index,
@@ -626,11 +770,13 @@ class Atlas:
         slice_coor_rescaled=None,
         MAIA_correction=False,
         cache_flask=None,
+        array_mask_runs=None,
+        array_last_pixels=None,
     ):
         """This function computes the averaged spectral data for a given slice and a given mask, the
-        latter being provided either as a mask name, either as an array (at least one of the two
-        must not be None). If the mask is provided as an array, the corresponding array of slice
-        coordinates (slice_coor_rescaled) must be provided.
+        latter being provided either as a mask name, either as an array, either as a list of runs
+        (at least one of the three must not be None). If the mask is provided as an array, the
+        corresponding array of slice coordinates (slice_coor_rescaled) must be provided.
 
         Args:
             slice_index (int): Index of the requested slice.
@@ -644,6 +790,11 @@ class Atlas:
             cache_flask (flask_caching.Cache, optional): Cache of the Flask database. If set to
                 None, the reading of memory-mapped data will not be multithreads-safe. Defaults to
                 None.
+            array_mask_runs (np.ndarray, optional): The projected mask encoded as a list of runs,
+                as returned by compute_mask_runs(). Defaults to None.
+            array_last_pixels (np.ndarray, optional): The array returned by
+                compute_last_projected_pixels() for the current slice. It is computed if not
+                provided. Defaults to None.
 
         Returns:
             (np.ndarray): A 2D numpy array containing the averaged spectral data of the pixels in the
@@ -652,10 +803,14 @@ class Atlas:
         """
 
         # Control that a mask can be provided one way or the other
-        if projected_mask is None and mask_name is None:
+        if projected_mask is None and mask_name is None and array_mask_runs is None:
             print("Either a mask or a mask name must be provided")
             return None
 
+        # If the mask has been provided as a list of runs, use it directly
+        elif array_mask_runs is not None:
+            pass
+
         # If a mask name has been provided, get the corresponding mask array
         elif mask_name is not None:
             if slice_coor_rescaled is None:
@@ -667,18 +822,27 @@ class Atlas:
                     ).round(0),
                     dtype=np.int16,
                 )
-            stack_mask = self.get_atlas_mask(self.dic_name_acronym[mask_name])
-            projected_mask = project_atlas_mask(
-                stack_mask, slice_coor_rescaled, self.bg_atlas.reference.shape
-            )
+            id_mask = self.dic_name_acronym[mask_name]
+            array_mask_runs = self.compute_projected_masks_runs(
+                slice_index, [id_mask], slice_coor_rescaled=slice_coor_rescaled
+            )[id_mask]
+
+        # Encode the mask as a list of runs, to only browse the pixels belonging to the mask
+        if array_mask_runs is None:
+            array_mask_runs = compute_mask_runs(projected_mask)
 
         # Get the list of rows containing the pixels to average
         original_shape = self.data.get_image_shape(slice_index + 1)
+        if array_last_pixels is None:
+            array_last_pixels = compute_last_projected_pixels(
+                self.array_projection_correspondence_corrected[slice_index], original_shape
+            )
         mask_remapped = np.zeros(original_shape, dtype=np.uint8)
-        list_index_bound_rows, list_index_bound_column_per_row = get_array_rows_from_atlas_mask(
-            projected_mask,
+        list_index_bound_rows, list_index_bound_column_per_row = get_array_rows_from_mask_runs(
+            array_mask_runs,
             mask_remapped,
             self.array_projection_correspondence_corrected[slice_index],
+            array_last_pixels,
         )
         if np.sum(list_index_bound_rows) == 0:
             print("No selection could be found for current mask")
@@ -703,19 +867,25 @@ class Atlas:
         return grah_scattergl_data
 
     def save_all_projected_masks_and_spectra(
-        self, force_update=False, cache_flask=None, sample=False
+        self, force_update=False, cache_flask=None, sample=False, n_workers=None
     ):
         """This function saves all the (2D) masks and corresponding averaged spectral data, for all
-        the slices.
+        the slices. The masks are saved as lists of runs (see compute_mask_runs()), which are much
+        more compact than the dense masks. Each (slice, structure) pair is an independent task,
+        and the tasks are distributed over a pool of processes (see run_tasks_in_parallel()). The
+        completed tasks are regularly checkpointed in the database, such that the computation can
+        be resumed without redoing any work if it is interrupted.
 
         Args:
-            force_update (bool, optional): If True, the function will not overwrite existing files.
+            force_update (bool, optional): If True, the function will overwrite existing files.
                 Defaults to False.
             cache_flask (flask_caching.Cache, optional): Cache of the Flask database. If set to
                 None, the reading of memory-mapped data will not be multithreads-safe. Defaults to
                 None.
             sample (bool, optional): If True, only a tiny sample of the masks will be processed (for
                 debug). Defaults to False.
+            n_workers (int, optional): The number of processes used for the computation. If None,
+                all cores are used. Defaults to None.
         """
 
         # Path atlas for shelving
@@ -725,138 +895,95 @@ class Atlas:
         if sample:
             logging.warning("Only a sample of the masks and spectra will be computed!")
 
-        # Define a dictionnary that contains all the masks that exist for every slice
-        dic_existing_masks = {}
-
-        # Define a dictionnary to save the result of the function slice by slice
-        if self.storage.check_shelved_object(path_atlas, "dic_processed_temp"):
-            dic_processed_temp = self.storage.load_shelved_object(
-                path_atlas,
-                "dic_processed_temp",
-            )
+        # Load the checkpoint, which associates to each slice index a dictionnary indicating, for
+        # each processed mask, whether it exists in the slice or not
+        if self.storage.check_shelved_object(path_atlas, "masks_checkpoint") and not force_update:
+            dic_checkpoint = self.storage.load_shelved_object(path_atlas, "masks_checkpoint")
         else:
-            dic_processed_temp = {}
+            dic_checkpoint = {}
 
+        # Build the list of tasks that remain to be done, sorted by slice such that the per-slice
+        # precomputations of the workers can be reused
+        l_tasks = []
         for slice_index in range(self.data.get_slice_number()):
-            # Break the loop after the first slice if sample is True
+            # Only process the first two slices if sample is True
             if sample and slice_index > 1:
                 break
-
-            logging.info("Starting slice " + str(slice_index))
-            slice_coor_rescaled = np.asarray(
-                (
-                    self.array_coordinates_warped_data[slice_index, :, :] * 1000 / self.resolution
-                ).round(0),
-                dtype=np.int16,
-            )
-
-            dic_existing_masks[slice_index] = set([])
-
-            # Check if the slice has already been processed
-            if slice_index not in dic_processed_temp:
-                dic_processed_temp[slice_index] = set([])
-
-            # Get hierarchical tree of brain structures
-            n_computed = 0
-            for mask_name, id_mask in self.dic_name_acronym.items():
-                if id_mask not in dic_processed_temp[slice_index]:
-                    # Break the loop after a few computations if sample is True
-                    if sample and n_computed > 1:
-                        break
-
-                    if (
-                        not (
-                            self.storage.check_shelved_object(
-                                path_atlas,
-                                "mask_and_spectrum_"
-                                + str(slice_index)
-                                + "_"
-                                + str(id_mask).replace("/", ""),
-                            )
-                            and self.storage.check_shelved_object(
-                                path_atlas,
-                                "mask_and_spectrum_MAIA_corrected_"
-                                + str(slice_index)
-                                + "_"
-                                + str(id_mask).replace("/", ""),
-                            )
-                        )
-                        or force_update
-                    ):
-                        # get the array corresponding to the projected mask
-                        stack_mask = self.get_atlas_mask(id_mask)
-
-                        # Project the mask onto high resolution data
-                        projected_mask = project_atlas_mask(
-                            stack_mask, slice_coor_rescaled, self.bg_atlas.reference.shape
-                        )
-                        if np.sum(projected_mask) == 0:
-                            logging.info(
-                                "The structure "
-                                + mask_name
-                                + " is not present in slice "
-                                + str(slice_index)
-                            )
-                            # Mask doesn't exist, so it considered processed
-                            dic_processed_temp[slice_index].add(id_mask)
-                            continue
-
-                        # Compute average spectrum in the mask
-                        grah_scattergl_data = self.compute_spectrum_data(
-                            slice_index,
-                            projected_mask,
-                            MAIA_correction=False,
-                            cache_flask=cache_flask,
-                        )
-
-                        # Add mask to the list of existing masks
-                        dic_existing_masks[slice_index].add(id_mask)
-                        dic_processed_temp[slice_index].add(id_mask)
-
-                        # Dump the mask and data with shelve
-                        self.storage.dump_shelved_object(
-                            path_atlas,
-                            "mask_and_spectrum_"
-                            + str(slice_index)
-                            + "_"
-                            + str(id_mask).replace("/", ""),
-                            (projected_mask, grah_scattergl_data),
+            dic_checkpoint.setdefault(slice_index, {})
+            for idx_mask, id_mask in enumerate(self.dic_name_acronym.values()):
+                # Only process a few masks per slice if sample is True
+                if sample and idx_mask > 2:
+                    break
+                if id_mask in dic_checkpoint[slice_index]:
+                    continue
+
+                # Masks saved before the checkpoint was written don't need to be recomputed
+                if not force_update and all(
+                    [
+                        self.storage.check_shelved_object(
+                            path_atlas, prefix + str(slice_index) + "_" + id_mask.replace("/", "")
                         )
-
-                        # Same with MAIA corrected data
-                        grah_scattergl_data = self.compute_spectrum_data(
-                            slice_index,
-                            projected_mask,
-                            MAIA_correction=True,
-                            cache_flask=cache_flask,
-                        )
-
-                        self.storage.dump_shelved_object(
-                            path_atlas,
-                            "mask_and_spectrum_MAIA_corrected_"
-                            + str(slice_index)
-                            + "_"
-                            + str(id_mask).replace("/", ""),
-                            (projected_mask, grah_scattergl_data),
-                        )
-
-                    else:
-                        # Add computed masks to the dics of computed masks
-                        dic_existing_masks[slice_index].add(id_mask)
-                        dic_processed_temp[slice_index].add(id_mask)
-
-                    n_computed += 1
-
+                        for prefix in ["mask_and_spectrum_", "mask_and_spectrum_MAIA_corrected_"]
+                    ]
+                ):
+                    dic_checkpoint[slice_index][id_mask] = True
                 else:
-                    n_computed += 1
-                    logging.info('Mask "' + mask_name + '" already processed')
+                    l_tasks.append((slice_index, id_mask))
 
-            # Dump the dictionnary of processed masks with shelve after every slice
-            self.storage.dump_shelved_object(
-                path_atlas,
-                "dic_processed_temp",
-                dic_processed_temp,
+        # Checkpoint every 5 minutes
+        t_last_checkpoint = time.time()
+
+        def save_task_result(task, result):
+            nonlocal t_last_checkpoint
+            slice_index, id_mask = task
+            if result is None:
+                logging.info(
+                    "The structure " + id_mask + " is not present in slice " + str(slice_index)
+                )
+                dic_checkpoint[slice_index][id_mask] = False
+            else:
+                array_mask_runs, grah_scattergl_data, grah_scattergl_data_MAIA = result
+
+                # Dump the mask and data (regular and MAIA corrected) with shelve
+                for prefix, data in [
+                    ("mask_and_spectrum_", grah_scattergl_data),
+                    ("mask_and_spectrum_MAIA_corrected_", grah_scattergl_data_MAIA),
+                ]:
+                    self.storage.dump_shelved_object(
+                        path_atlas,
+                        prefix + str(slice_index) + "_" + id_mask.replace("/", ""),
+                        (array_mask_runs, data),
+                    )
+                dic_checkpoint[slice_index][id_mask] = True
+
+            # The checkpoint is always written after the masks, such that it can't reference a
+            # mask that hasn't been saved
+            if time.time() - t_last_checkpoint > 300:
+                self.storage.dump_shelved_object(path_atlas, "masks_checkpoint", dic_checkpoint)
+                t_last_checkpoint = time.time()
+
+        # The workers inherit the current object when they are forked. The annotations are loaded
+        # beforehand, such that they're shared by all workers instead of being loaded by each one
+        self.bg_atlas.annotation
+        global _worker_atlas, _worker_cache_flask
+        _worker_atlas, _worker_cache_flask = self, cache_flask
+        try:
+            run_tasks_in_parallel(
+                _compute_projected_mask_and_spectra,
+                l_tasks,
+                save_task_result,
+                n_workers=n_workers,
+                name="masks",
             )
+        finally:
+            _worker_atlas, _worker_cache_flask = None, None
+            self.storage.dump_shelved_object(path_atlas, "masks_checkpoint", dic_checkpoint)
+
+        # Define a dictionnary that contains all the masks that exist for every slice
+        dic_existing_masks = {
+            slice_index: set([id_mask for id_mask, exists in dic_masks.items() if exists])
+            for slice_index, dic_masks in dic_checkpoint.items()
+        }
 
         if not sample:
             # Dump the dictionnary of existing masks with shelve
@@ -880,8 +1007,9 @@ class Atlas:
                 is used for computation (if it exists). Defaults to False.
         Returns:
             (np.ndarray, np.ndarray): The first array is represents the projected 2D mask on the
-                requested slice. The second array corresponds to the corresponding averaged spectral
-                data (first row is m/z values, second row is averaged intensities).
+                requested slice, encoded as a list of runs (see compute_mask_runs()). The second
+                array corresponds to the corresponding averaged spectral data (first row is m/z
+                values, second row is averaged intensities).
         """
         id_mask = self.dic_name_acronym[mask_name]
         if MAIA_correction:
@@ -898,7 +1026,13 @@ class Atlas:
             "Loading " + mask_name + " for slice " + str(slice_index) + " from shelve file."
         )
         try:
-            return self.storage.load_shelved_object("atlas/atlas_objects", filename)
+            projected_mask, grah_scattergl_data = self.storage.load_shelved_object(
+                "atlas/atlas_objects", filename
+            )
+            # Masks computed with former versions of the app are stored as dense arrays
+            if projected_mask.dtype == np.uint8:
+                projected_mask = compute_mask_runs(projected_mask)
+            return projected_mask, grah_scattergl_data
         except:
             logging.warning(
                 "The mask and spectrum data could not be found for "
@@ -909,3 +1043,65 @@ class Atlas:
                 + " was present in self.dic_existing_masks"
             )
             return None
+
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+# Atlas object and Flask cache used by the workers of save_all_projected_masks_and_spectra(), which
+# inherit them when they are forked
+_worker_atlas = None
+_worker_cache_flask = None
+
+# Per-slice precomputations of the current worker, indexed by slice
+_dic_worker_slice_data = {}
+
+
+def _compute_projected_mask_and_spectra(slice_index, id_mask):
+    """This function computes the projected mask of a given structure on a given slice, along with
+    the corresponding averaged spectral data (regular and MAIA corrected). It is executed by the
+    workers of Atlas.save_all_projected_masks_and_spectra().
+
+    Args:
+        slice_index (int): Index of the requested slice.
+        id_mask (str): Acronym of the requested structure.
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): The projected mask, encoded as a list of runs, and the
+            corresponding averaged spectral data without and with MAIA correction. None is returned
+            if the structure is not present in the slice.
+    """
+    atlas = _worker_atlas
+
+    # Compute the projected masks of all structures and the mapping of the warped pixels to the
+    # original data only once per slice
+    if slice_index not in _dic_worker_slice_data:
+        _dic_worker_slice_data.clear()
+        dic_mask_runs = atlas.compute_projected_masks_runs(
+            slice_index, list(atlas.dic_name_acronym.values())
+        )
+        array_last_pixels = compute_last_projected_pixels(
+            atlas.array_projection_correspondence_corrected[slice_index],
+            atlas.data.get_image_shape(slice_index + 1),
+        )
+        _dic_worker_slice_data[slice_index] = (dic_mask_runs, array_last_pixels)
+    dic_mask_runs, array_last_pixels = _dic_worker_slice_data[slice_index]
+
+    # Get the projected mask
+    array_mask_runs = dic_mask_runs[id_mask]
+    if array_mask_runs.shape[0] == 0:
+        return None
+
+    # Compute average spectrum in the mask, with and without MAIA correction
+    l_grah_scattergl_data = [
+        atlas.compute_spectrum_data(
+            slice_index,
+            MAIA_correction=MAIA_correction,
+            cache_flask=_worker_cache_flask,
+            array_mask_runs=array_mask_runs,
+            array_last_pixels=array_last_pixels,
+        )
+        for MAIA_correction in [False, True]
+    ]
+    return (array_mask_runs, *l_grah_scattergl_data)
@@ -16,30 +16,58 @@ import numpy as np
 
 
 class Labels:
-    """Class used to access labels data without having to create new arrays.
+    """Class used to access labels data without having to create new arrays. The structure ids of
+    the atlas are remapped to compact indices, such that labels can be looked up with a single array
+    indexing (e.g. in the label planes of Atlas.array_label_planes).
 
     Attributes:
         bg_atlas (BrainGlobeAtlas): BrainGlobeAtlas object, used to query the atlas.
+        array_ids (np.ndarray): The sorted ids of all the structures of the atlas.
+        array_names (np.ndarray): The names of the structures, indexed with the compact indices
+            returned by get_label_indices(). Index 0 corresponds to "undefined".
 
     Methods:
-        __init__(bg_atlas, force_init=True): Initialize the Labels class.
+        __init__(bg_atlas, force_init=False): Initialize the Labels class.
+        get_label_indices(array_ids): Remap structure ids to compact indices.
         __getitem__(key): Getter for the curent class.
     """
 
-    def __init__(self, bg_atlas, force_init=True):
+    def __init__(self, bg_atlas, force_init=False):
         """Initialize the class Labels.
 
         Args:
             bg_atlas (BrainGlobeAtlas): BrainGlobeAtlas object, used to query the atlas.
-            force_init (bool, optional): If True, the arrays of annotations and structures in
-                BrainGlobeAtlas are loaded in memory (this avoids to have them during the first
-                query, but rather when the app is initialized). Defaults to True.
+            force_init (bool, optional): If True, the array of annotations in BrainGlobeAtlas is
+                loaded in memory (this avoids to have it during the first query, but rather when the
+                app is initialized). Defaults to False.
         """
 
         self.bg_atlas = bg_atlas
         if force_init:
             _ = self.bg_atlas.annotation
-            _ = self.bg_atlas.structures
+
+        # Build the table of names, index 0 being used for voxels outside of any structure
+        self.array_ids = np.array(sorted(self.bg_atlas.structures.keys()), dtype=np.uint32)
+        self.array_names = np.array(
+            ["undefined"] + [self.bg_atlas.structures[i]["name"] for i in self.array_ids]
+        )
+
+    def get_label_indices(self, array_ids):
+        """This function remaps structure ids (e.g. from the annotation of the atlas) to the
+        compact indices of self.array_names.
+
+        Args:
+            array_ids (np.ndarray): The structure ids to remap. Can be a scalar.
+
+        Returns:
+            (np.ndarray): The compact indices, as uint16, with 0 for ids that don't correspond to
+                any structure.
+        """
+        array_ids = np.asarray(array_ids)
+        array_indices = np.searchsorted(self.array_ids, array_ids)
+        array_indices = np.minimum(array_indices, len(self.array_ids) - 1)
+        array_found = self.array_ids[array_indices] == array_ids
+        return np.where(array_found, array_indices + 1, 0).astype(np.uint16)
 
     def __getitem__(self, key):
         """Getter for the curent class. For every coordinate (key) passed as a parameter, the
@@ -51,19 +79,7 @@ class Labels:
         Returns:
             (str): Label of the voxel in the Allen Brain Atlas.
         """
-        x = self.bg_atlas.annotation[key]
-        if isinstance(x, np.uint32):
-            if x != 0:
-                return self.bg_atlas.structures[x]["name"]
-            else:
-                return "undefined"
-
-        # an array slice have been provided
-        else:
-            return np.reshape(
-                [
-                    self.bg_atlas.structures[i]["name"] if i != 0 else "undefined"
-                    for i in x.flatten()
-                ],
-                x.shape,
-            )
+        array_names = self.array_names[self.get_label_indices(self.bg_atlas.annotation[key])]
+        if array_names.ndim == 0:
+            return str(array_names)
+        return array_names
@@ -11,6 +11,7 @@ from the MALDI imaging, and the Allen Brain Atlas, as well as the mapping betwee
 # Standard modules
 import numpy as np
 import logging
+import base64
 from modules.tools.misc import logmem
 import plotly.graph_objects as go
 import plotly.express as px
@@ -23,7 +24,13 @@ import copy
 from plotly.subplots import make_subplots
 
 # LBAE imports
-from modules.tools.image import convert_image_to_base64
+from modules.tools.image import (
+    convert_image_to_base64,
+    encode_image_to_base64,
+    downsample_image,
+    URL_TILES,
+    TILE_SIZE,
+)
 from modules.tools.atlas import project_image, slice_to_atlas_transform
 from modules.tools.volume import (
     filter_voxels,
@@ -34,13 +41,23 @@ from modules.tools.volume import (
 )
 from config import dic_colors, l_colors
 from modules.tools.spectra import (
-    compute_image_using_index_and_image_lookup,
+    compute_images_using_index_and_image_lookup_batch,
     compute_index_boundaries,
     compute_avg_intensity_per_lipid,
     global_lipid_index_store,
     compute_thread_safe_function,
 )
 
+# ==================================================================================================
+# --- Constants
+# ==================================================================================================
+
+# Types of basic images which can be displayed as a pyramid of tiles
+L_TYPES_FIGURE_TILED = ["warped_data", "projection_corrected", "atlas"]
+
+# Number of zoom levels of the pyramids of tiles (level 0 being the full resolution). With slice
+# images about 1300 pixels wide, lower levels are only used when the graph is displayed small
+N_LEVELS_TILES = 3
 
 # ==================================================================================================
 # --- Class
@@ -60,6 +77,10 @@ class Figures:
         _scRNAseq (ScRNAseq): Used to manipulate the objects coming from the scRNAseq dataset.
         dic_normalization_factors (dict): Dictionnary of normalization factors across slices for
             MAIA.
+        _dic_lipid_image_cubes (dict): Dictionnary of the precomputed image cubes of the annotated
+            lipids, indexed by (slice_index, apply_transform), loaded when first requested.
+        _image_store (ImageStore): Used to serve the images of the heatmaps by URL. If None, images
+            are embedded in the figures as base64 strings.
 
     Methods:
         __init__(): Initialize the Figures class.
@@ -67,11 +88,25 @@ class Figures:
             from the maldi_data acquisition (TIC) or the corresponding image from the atlas.
         compute_figure_basic_image(): Computes a figure representing slices from the TIC or the
             corresponding image from the atlas.
+        compute_array_basic_images_level(): Computes the array of basic images at a given zoom
+            level of the pyramid of tiles.
+        return_tile_png(): Returns a tile of a basic image, encoded in png.
+        compute_figure_basic_image_tiled(): Similar to compute_figure_basic_image(), but the image
+            is split into tiles, and only the visible tiles, at the resolution needed for the
+            current zoom, are referenced in the figure.
         compute_figure_slices_3D(): Computes a figure representing all slices from the maldi data in
             3D.
         get_surface(): Computes a Plotly Surface representing the requested slice in 3D.
         compute_image_per_lipid(): Allows to query the MALDI data to extract an image representing
             the intensity of each lipid in the requested slice.
+        compute_images_per_lipid(): Batched version of compute_image_per_lipid(), extracting the
+            images of several lipids at once.
+        compute_raw_images_per_lipid(): Extracts the raw images of several lipids at once from the
+            spectral data.
+        compute_lipid_image_cube(): Computes the images of all the annotated lipids of the requested
+            slice, stored in a compact cube.
+        get_lipid_image_cube(): Returns the precomputed image cube of the annotated lipids of the
+            requested slice, if it has been shelved.
         compute_normalization_factor_across_slices(): Computes a dictionnary of normalization
             factors across all slices.
         build_lipid_heatmap_from_image(): Converts a numpy array into a base64 string, a go.Image,
@@ -121,15 +156,25 @@ class Figures:
             a 3D representation of the brain.
         shelve_all_arrays_annotation(): Precomputes and shelves the array of structure annotation
             used in a 3D representation of the brain.
+        shelve_all_lipid_image_cubes(): Precomputes and shelves the image cubes of the annotated
+            lipids, for all slices.
     """
 
-    __slots__ = ["_data", "_atlas", "_scRNAseq", "_storage", "dic_normalization_factors"]
+    __slots__ = [
+        "_data",
+        "_atlas",
+        "_scRNAseq",
+        "_storage",
+        "dic_normalization_factors",
+        "_dic_lipid_image_cubes",
+        "_image_store",
+    ]
 
     # ==============================================================================================
     # --- Constructor
     # ==============================================================================================
 
-    def __init__(self, maldi_data, storage, atlas, scRNAseq, sample=False):
+    def __init__(self, maldi_data, storage, atlas, scRNAseq, sample=False, image_store=None):
         """Initialize the Figures class.
 
         Args:
@@ -139,6 +184,8 @@ class Figures:
             scRNAseq (ScRNAseq): Used to manipulate the objects coming from the scRNAseq dataset.
             sample (bool, optional): If True, only a fraction of the precomputations are made (for
                 debug). Default to False.
+            image_store (ImageStore, optional): Used to serve the images of the heatmaps by URL,
+                instead of embedding them in the figures. Defaults to None.
         """
         logging.info("Initializing Figures object" + logmem())
 
@@ -150,6 +197,12 @@ class Figures:
         # attribute to access the shelve database
         self._storage = storage
 
+        # Image cubes of the annotated lipids, loaded from the database when first requested
+        self._dic_lipid_image_cubes = {}
+
+        # Attribute to serve the images of the heatmaps by URL
+        self._image_store = image_store
+
         # Dic of normalization factors across slices for MAIA normalized lipids
         self.dic_normalization_factors = self._storage.return_shelved_object(
             "figures/lipid_selection",
@@ -242,6 +295,13 @@ class Figures:
         if not self._storage.check_shelved_object("figures/3D_page", "arrays_annotation_computed"):
             self.shelve_all_arrays_annotation()
 
+        # Check that the image cubes of the annotated lipids have been computed, if not, compute
+        # them
+        if not self._storage.check_shelved_object(
+            "figures/lipid_selection", "lipid_image_cubes_computed"
+        ):
+            self.shelve_all_lipid_image_cubes(sample=sample)
+
         logging.info("Figures object instantiated" + logmem())
 
     # ==============================================================================================
@@ -412,6 +472,241 @@ class Figures:
 
         return fig
 
+    def compute_array_basic_images_level(self, type_figure, level):
+        """This function computes the array of basic images (see compute_array_basic_images()) at
+        a given zoom level of the pyramid of tiles, i.e. with a resolution divided by 2**level.
+
+        Args:
+            type_figure (str): The type of the basic images (see compute_array_basic_images()).
+            level (int): The zoom level. Level 0 corresponds to the full resolution.
+
+        Returns:
+            (np.ndarray): A three-dimensional array representing all slices at the requested zoom
+                level.
+        """
+        array_images = self._storage.return_shelved_object(
+            "figures/load_page",
+            "array_basic_images",
+            force_update=False,
+            compute_function=self.compute_array_basic_images,
+            type_figure=type_figure,
+        )
+        for _ in range(level):
+            array_images = downsample_image(array_images)
+        return array_images
+
+    def return_tile_png(self, type_figure, index_image, plot_atlas_contours, level, row, col):
+        """This function returns a tile of a basic image, encoded in png. Tiles are squares of
+        TILE_SIZE pixels (smaller on the bottom and right borders), taken from the image at the
+        requested zoom level. Arrays of the zoom levels are shelved in the database, and the
+        encoded tiles are kept in the cache of the image store, if any.
+
+        Args:
+            type_figure (str): The type of the basic image, among L_TYPES_FIGURE_TILED.
+            index_image (int): Index of the requested slice image.
+            plot_atlas_contours (bool): If True, the atlas contours annotation is superimposed with
+                the tile.
+            level (int): The zoom level of the tile. Level 0 corresponds to the full resolution.
+            row (int): The row of the tile in the grid of tiles of the zoom level.
+            col (int): The column of the tile in the grid of tiles of the zoom level.
+
+        Returns:
+            (bytes): The tile encoded in png, or None if the tile doesn't exist.
+        """
+        if type_figure not in L_TYPES_FIGURE_TILED or not 0 <= level < N_LEVELS_TILES:
+            return None
+        key = "/".join(
+            [type_figure, str(index_image), str(plot_atlas_contours), str(level), str(row)]
+            + [str(col)]
+        )
+        if self._image_store is not None:
+            content = self._image_store.cache.get(key)
+            if content is not None:
+                return content
+
+        # Get the image at the requested zoom level
+        if level == 0:
+            array_images = self._storage.return_shelved_object(
+                "figures/load_page",
+                "array_basic_images",
+                force_update=False,
+                compute_function=self.compute_array_basic_images,
+                type_figure=type_figure,
+            )
+        else:
+            array_images = self._storage.return_shelved_object(
+                "figures/load_page",
+                "array_basic_images_level",
+                force_update=False,
+                compute_function=self.compute_array_basic_images_level,
+                type_figure=type_figure,
+                level=level,
+            )
+        if not 0 <= index_image < array_images.shape[0]:
+            return None
+        tile = array_images[
+            index_image,
+            row * TILE_SIZE : (row + 1) * TILE_SIZE,
+            col * TILE_SIZE : (col + 1) * TILE_SIZE,
+        ]
+        if row < 0 or col < 0 or tile.size == 0:
+            return None
+
+        # Downsample the corresponding part of the contours
+        overlay = None
+        if plot_atlas_contours:
+            size_full_res = TILE_SIZE * 2**level
+            overlay = self._atlas.list_projected_atlas_borders_arrays[index_image][
+                row * size_full_res : (row + 1) * size_full_res,
+                col * size_full_res : (col + 1) * size_full_res,
+            ]
+            for _ in range(level):
+                overlay = downsample_image(overlay)
+
+        base64_string = encode_image_to_base64(
+            np.ascontiguousarray(tile), overlay=overlay, transparent_zeros=True, optimize=False
+        )
+        content = base64.b64decode(base64_string.split(",", 1)[1])
+        if self._image_store is not None:
+            self._image_store.cache.set(key, content, len(content))
+        return content
+
+    def compute_figure_basic_image_tiled(
+        self,
+        type_figure,
+        index_image,
+        plot_atlas_contours=True,
+        draw=False,
+        x_range=None,
+        y_range=None,
+        display_width=None,
+    ):
+        """This function computes and returns a figure representing slices from the maldi_data
+        acquisition (TIC) or the corresponding image from the atlas, as compute_figure_basic_image()
+        does. However, the image is not embedded in the figure: it's referenced as a set of tiles,
+        served by the app (see return_tile_png()), such that only the tiles visible in the current
+        viewport are loaded, at the lowest resolution which still fills the display. If the image
+        can't be tiled (no image store, or type_figure not in L_TYPES_FIGURE_TILED), the figure of
+        compute_figure_basic_image() is returned instead.
+
+        Args:
+            type_figure (str): See compute_figure_basic_image().
+            index_image (int): Index of the requested slice image.
+            plot_atlas_contours (bool, optional): If True, the atlas contours annotation is
+                superimposed with the slice image. Defaults to True.
+            draw (bool, optional): If True, the figure can be drawed on (used for region selection,
+                in page region_analysis). Defaults to False.
+            x_range (list(float), optional): The range of the x axis of the current viewport (in
+                pixels of the full resolution image). If None, the whole width is displayed.
+                Defaults to None.
+            y_range (list(float), optional): The range of the y axis of the current viewport (in
+                pixels of the full resolution image). If None, the whole height is displayed.
+                Defaults to None.
+            display_width (int, optional): The width of the graph in device pixels, as measured in
+                the browser (see the clientside callbacks of the pages), used to choose the zoom
+                level. If None, a width of 1024 pixels is assumed. Defaults to None.
+
+        Returns:
+            (go.Figure): A Plotly figure representing the requested slice image of the requested
+                type.
+        """
+        if self._image_store is None or type_figure not in L_TYPES_FIGURE_TILED:
+            fig = self._storage.return_shelved_object(
+                "figures/load_page",
+                "figure_basic_image",
+                force_update=False,
+                compute_function=self.compute_figure_basic_image,
+                type_figure=type_figure,
+                index_image=index_image,
+                plot_atlas_contours=plot_atlas_contours,
+            )
+            if draw:
+                fig.update_layout(
+                    dragmode="drawclosedpath",
+                    newshape=dict(
+                        fillcolor=l_colors[0], opacity=0.7, line=dict(color="white", width=1)
+                    ),
+                    autosize=True,
+                )
+            return fig
+
+        # Get the shape of the full resolution image
+        array_images = self._storage.return_shelved_object(
+            "figures/load_page",
+            "array_basic_images",
+            force_update=False,
+            compute_function=self.compute_array_basic_images,
+            type_figure=type_figure,
+        )
+        height, width = array_images.shape[1:]
+        if x_range is None:
+            x_range = [-0.5, width - 0.5]
+        if y_range is None:
+            y_range = [height - 0.5, -0.5]
+
+        # Choose the lowest resolution whose number of pixels still exceeds the display width
+        if display_width is None or display_width <= 0:
+            display_width = 1024
+        visible_width = abs(x_range[1] - x_range[0])
+        level = int(
+            np.clip(np.floor(np.log2(max(visible_width / display_width, 1))), 0, N_LEVELS_TILES - 1)
+        )
+        factor = 2**level
+        size_full_res = TILE_SIZE * factor
+
+        # Only reference the visible tiles
+        fig = go.Figure()
+        row_min = max(0, int(min(y_range) // size_full_res))
+        row_max = min(int(np.ceil(height / size_full_res)) - 1, int(max(y_range) // size_full_res))
+        col_min = max(0, int(min(x_range) // size_full_res))
+        col_max = min(int(np.ceil(width / size_full_res)) - 1, int(max(x_range) // size_full_res))
+        for row in range(row_min, row_max + 1):
+            for col in range(col_min, col_max + 1):
+                fig.add_trace(
+                    go.Image(
+                        visible=True,
+                        source=URL_TILES
+                        + "/".join(
+                            [
+                                type_figure,
+                                str(index_image),
+                                str(int(plot_atlas_contours)),
+                                str(level),
+                                str(row) + "_" + str(col) + ".png",
+                            ]
+                        ),
+                        # Coordinates of the center of the first pixel of the tile
+                        x0=col * size_full_res + (factor - 1) / 2,
+                        y0=row * size_full_res + (factor - 1) / 2,
+                        dx=factor,
+                        dy=factor,
+                        hoverinfo="none",
+                    )
+                )
+
+        # Improve layout
+        fig.update_xaxes(showticklabels=False, range=x_range)
+        fig.update_yaxes(showticklabels=False, range=y_range)
+        fig.update_layout(
+            margin=dict(t=0, r=0, b=0, l=0),
+            xaxis=dict(showgrid=False, zeroline=False),
+            yaxis=dict(showgrid=False, zeroline=False),
+            template="plotly_dark",
+            paper_bgcolor="rgba(0,0,0,0)",
+            plot_bgcolor="rgba(0,0,0,0)",
+        )
+
+        if draw:
+            fig.update_layout(
+                dragmode="drawclosedpath",
+                newshape=dict(
+                    fillcolor=l_colors[0], opacity=0.7, line=dict(color="white", width=1)
+                ),
+                autosize=True,
+            )
+
+        return fig
+
     def compute_figure_slices_3D(self, reduce_resolution_factor=20, brain="brain_1"):
         """This function computes and returns a figure representing the slices from the maldi data
         in 3D.
@@ -667,16 +962,161 @@ class Figures:
                 lipid peaking between the values lb_mz and hb_mz in the spectral data, for the slice
                 slice_index.
         """
-        logging.info("Entering compute_image_per_lipid")
+        return self.compute_images_per_lipid(
+            slice_index,
+            [(lb_mz, hb_mz)],
+            RGB_format=RGB_format,
+            normalize=normalize,
+            log=log,
+            projected_image=projected_image,
+            apply_transform=apply_transform,
+            l_lipid_names=[lipid_name],
+            cache_flask=cache_flask,
+        )[0]
 
-        # Get image from raw mass spec data
-        image = compute_thread_safe_function(
-            compute_image_using_index_and_image_lookup,
+    def compute_images_per_lipid(
+        self,
+        slice_index,
+        l_t_bounds,
+        RGB_format=True,
+        normalize=True,
+        log=False,
+        projected_image=True,
+        apply_transform=False,
+        l_lipid_names=None,
+        cache_flask=None,
+    ):
+        """This function is the batched version of compute_image_per_lipid(), i.e. it extracts the
+        images of several lipids at once, browsing the spectral data of the slice only once. Please
+        consult the documentation of compute_image_per_lipid() for more information.
+
+        Args:
+            slice_index (int): Index of the requested slice.
+            l_t_bounds (list(tuple)): List of lower and higher boundaries for the spectral data to
+                query, one tuple per lipid.
+            RGB_format (bool, optional): See compute_image_per_lipid(). Defaults to True.
+            normalize (bool, optional): See compute_image_per_lipid(). Defaults to True.
+            log (bool, optional): See compute_image_per_lipid(). Defaults to False.
+            projected_image (bool, optional): See compute_image_per_lipid(). Defaults to True.
+            apply_transform (bool, optional): See compute_image_per_lipid(). Defaults to False.
+            l_lipid_names (list(str), optional): Names of the lipids that must be MAIA-transformed,
+                if apply_transform and normalize are True. Defaults to None.
+            cache_flask (flask_caching.Cache, optional): Cache of the Flask database. If set to
+                None, the reading of memory-mapped data will not be multithreads-safe. Defaults to
+                None.
+        Returns:
+            (list(np.ndarray)): A list of images (in the form of numpy arrays), one per lipid, as
+                returned by compute_image_per_lipid().
+        """
+        logging.info("Entering compute_images_per_lipid")
+
+        if l_lipid_names is None:
+            l_lipid_names = ["" for x in l_t_bounds]
+
+        # Get the images of annotated lipids from the precomputed cube, if possible
+        l_raw_images = [None for x in l_t_bounds]
+        t_cube = self.get_lipid_image_cube(slice_index, apply_transform=apply_transform)
+        if t_cube is not None:
+            dic_index_bounds, array_cube, array_scales = t_cube
+            for idx_bounds, (lb_mz, hb_mz) in enumerate(l_t_bounds):
+                idx_lipid = dic_index_bounds.get((float(lb_mz), float(hb_mz)))
+                if idx_lipid is not None:
+                    l_raw_images[idx_bounds] = (
+                        array_cube[idx_lipid].astype(np.float32) * array_scales[idx_lipid]
+                    )
+        l_idx_live = [idx for idx, image in enumerate(l_raw_images) if image is None]
+        if len(l_idx_live) < len(l_t_bounds):
+            logging.info(
+                str(len(l_t_bounds) - len(l_idx_live)) + " images returned from the lipid cube"
+            )
+
+        # Get the other images from raw mass spec data
+        if len(l_idx_live) > 0:
+            array_images = self.compute_raw_images_per_lipid(
+                slice_index,
+                [l_t_bounds[idx] for idx in l_idx_live],
+                apply_transform=apply_transform,
+                cache_flask=cache_flask,
+            )
+
+            # In case of bug, return None
+            if array_images is None:
+                return [None for x in l_t_bounds]
+            for idx, image in zip(l_idx_live, array_images):
+                l_raw_images[idx] = image
+
+        l_images = []
+        for image, lipid_name in zip(l_raw_images, l_lipid_names):
+            # Log-transform the image if requested
+            if log:
+                image = np.log(image + 1)
+
+            # Normalize the image if requested
+            if normalize:
+                # Normalize across slice if the lipid has been MAIA transformed
+                if (
+                    lipid_name,
+                    self._data.is_brain_1(slice_index),
+                ) in self.dic_normalization_factors and apply_transform:
+                    perc = self.dic_normalization_factors[
+                        (lipid_name, self._data.is_brain_1(slice_index))
+                    ]
+                    logging.info(
+                        "Normalization made with respect to percentile computed across all slices."
+                    )
+                else:
+                    # Normalize by 99 percentile
+                    perc = np.percentile(image, 99.0)
+                if perc == 0:
+                    perc = np.max(image)
+                if perc == 0:
+                    perc = 1
+                image = image / perc
+                image = np.clip(0, 1, image)
+
+            # Turn to RGB format if requested
+            if RGB_format:
+                image *= 255
+
+            # Change dtype if normalized and RGB to save space
+            if normalize and RGB_format:
+                image = np.round(image).astype(np.uint8)
+            l_images.append(image)
+
+        # Project all images at once into cleaned and higher resolution versions
+        if projected_image and len(l_images) > 0:
+            array_images = project_image(
+                slice_index, np.stack(l_images, axis=-1), self._atlas.array_projection_flat_indices
+            )
+            l_images = list(np.moveaxis(array_images, -1, 0))
+        return l_images
+
+    def compute_raw_images_per_lipid(
+        self, slice_index, l_t_bounds, apply_transform=False, cache_flask=None
+    ):
+        """This function extracts the raw images (i.e. neither normalized nor projected) of several
+        lipids at once from the spectral data, browsing the spectral data of the slice only once.
+
+        Args:
+            slice_index (int): Index of the requested slice.
+            l_t_bounds (list(tuple)): List of lower and higher boundaries for the spectral data to
+                query, one tuple per lipid.
+            apply_transform (bool, optional): If True, applies the MAIA transform (if possible) to
+                the selections. Defaults to False.
+            cache_flask (flask_caching.Cache, optional): Cache of the Flask database. If set to
+                None, the reading of memory-mapped data will not be multithreads-safe. Defaults to
+                None.
+        Returns:
+            (np.ndarray): An array of shape (n_lipids, image_height, image_width) containing the
+                raw images, or None if the computation failed.
+        """
+        lookup_table_fine, first_bin_fine = self._data.get_fine_lookup_mz(slice_index)
+        return compute_thread_safe_function(
+            compute_images_using_index_and_image_lookup_batch,
             cache_flask,
             self._data,
             slice_index,
-            lb_mz,
-            hb_mz,
+            np.array(l_t_bounds, dtype=np.float64),
             self._data.get_array_spectra(slice_index),
             self._data.get_array_lookup_pixels(slice_index),
             self._data.get_image_shape(slice_index),
@@ -684,54 +1124,91 @@ class Figures:
             self._data.get_array_cumulated_lookup_mz_image(slice_index),
             self._data.get_divider_lookup(slice_index),
             self._data.get_array_peaks_transformed_lipids(slice_index),
-            self._data.get_array_corrective_factors(slice_index).astype(np.float32),
+            self._data.get_array_corrective_factors(slice_index),
             apply_transform=apply_transform,
+            lookup_table_fine=lookup_table_fine,
+            first_bin_fine=first_bin_fine,
         )
-        # Log-transform the image if requested
-        if log:
-            image = np.log(image + 1)
 
-        # In case of bug, return None
-        if image is None:
-            return None
+    def compute_lipid_image_cube(self, slice_index, apply_transform=False, cache_flask=None):
+        """This function computes the raw images of all the lipids annotated in the requested slice,
+        and stores them in a compact cube. Images are divided by their maximum and stored as
+        float16, such that the cube is 4 times smaller than the raw images, while keeping a relative
+        precision of about 1e-3, more than enough for display (images are eventually converted to
+        uint8).
 
-        # Normalize the image if requested
-        if normalize:
-            # Normalize across slice if the lipid has been MAIA transformed
-            if (
-                lipid_name,
-                self._data.is_brain_1(slice_index),
-            ) in self.dic_normalization_factors and apply_transform:
-                perc = self.dic_normalization_factors[
-                    (lipid_name, self._data.is_brain_1(slice_index))
-                ]
-                logging.info(
-                    "Normalization made with respect to percentile computed across all slices."
-                )
-            else:
-                # Normalize by 99 percentile
-                perc = np.percentile(image, 99.0)
-            if perc == 0:
-                perc = np.max(image)
-            if perc == 0:
-                perc = 1
-            image = image / perc
-            image = np.clip(0, 1, image)
-
-        # Turn to RGB format if requested
-        if RGB_format:
-            image *= 255
-
-        # Change dtype if normalized and RGB to save space
-        if normalize and RGB_format:
-            image = np.round(image).astype(np.uint8)
-
-        # Project image into cleaned and higher resolution version
-        if projected_image:
-            image = project_image(
-                slice_index, image, self._atlas.array_projection_correspondence_corrected
+        Args:
+            slice_index (int): Index of the requested slice.
+            apply_transform (bool, optional): If True, the MAIA transform is applied to the
+                lipids which have been transformed. Defaults to False.
+            cache_flask (flask_caching.Cache, optional): Cache of the Flask database. If set to
+                None, the reading of memory-mapped data will not be multithreads-safe. Defaults to
+                None.
+
+        Returns:
+            (np.ndarray, np.ndarray, np.ndarray): The peak boundaries of the annotations, in the
+                order of the annotation file (shape (n_lipids, 2)), the cube of images (shape
+                (n_lipids, image_height, image_width), float16), and the scale of each image (shape
+                (n_lipids,)), such that the raw images are given by cube * scale[:, None, None].
+        """
+        logging.info("Computing lipid image cube for slice " + str(slice_index) + logmem())
+        array_min, array_max = self._data.get_annotation_bounds_per_slice(slice_index)
+        array_bounds = np.stack((array_min, array_max), axis=1)
+        image_shape = self._data.get_image_shape(slice_index)
+        if array_bounds.shape[0] == 0:
+            return (
+                array_bounds,
+                np.zeros((0, image_shape[0], image_shape[1]), dtype=np.float16),
+                np.zeros((0,), dtype=np.float32),
+            )
+
+        array_images = self.compute_raw_images_per_lipid(
+            slice_index, array_bounds, apply_transform=apply_transform, cache_flask=cache_flask
+        )
+        array_scales = np.max(array_images, axis=(1, 2)).astype(np.float32)
+        array_scales[array_scales == 0] = 1
+        array_cube = (array_images / array_scales[:, None, None]).astype(np.float16)
+        return array_bounds, array_cube, array_scales
+
+    def get_lipid_image_cube(self, slice_index, apply_transform=False):
+        """This function returns the precomputed image cube of the annotated lipids of the requested
+        slice (see compute_lipid_image_cube()), along with a dictionnary mapping the peak boundaries
+        of each annotation to its index in the cube. The cube is loaded from the database (as a
+        memory map), and is only available once shelve_all_lipid_image_cubes() has been run.
+
+        Args:
+            slice_index (int): Index of the requested slice.
+            apply_transform (bool, optional): If True, the cube of MAIA-transformed images is
+                returned. Defaults to False.
+
+        Returns:
+            (dict, np.ndarray, np.ndarray): The dictionnary mapping the peak boundaries to the index
+                in the cube, the cube of images, and the scale of each image. None if the cubes have
+                not been precomputed.
+        """
+        t_cube = self._dic_lipid_image_cubes.get((slice_index, apply_transform))
+        if t_cube is None:
+            if not self._storage.check_shelved_object(
+                "figures/lipid_selection", "lipid_image_cubes_computed"
+            ):
+                return None
+            array_bounds, array_cube, array_scales = self._storage.return_shelved_object(
+                "figures/lipid_selection",
+                "lipid_image_cube",
+                force_update=False,
+                compute_function=self.compute_lipid_image_cube,
+                slice_index=slice_index,
+                apply_transform=apply_transform,
+                cache_flask=None,
             )
-        return image
+
+            # Keep the first annotation if several ones have the same boundaries
+            dic_index_bounds = {}
+            for idx_lipid, (lb_mz, hb_mz) in enumerate(array_bounds):
+                dic_index_bounds.setdefault((float(lb_mz), float(hb_mz)), idx_lipid)
+            t_cube = (dic_index_bounds, array_cube, array_scales)
+            self._dic_lipid_image_cubes[(slice_index, apply_transform)] = t_cube
+        return t_cube
 
     def compute_normalization_factor_across_slices(self, cache_flask=None):
         """This function computes a dictionnary of normalization factors (used for MAIA-transformed
@@ -753,74 +1230,72 @@ class Figures:
         # Dictionnnary that will contain the percentile across all slices of a given brain
         dic_max_percentile = {}
 
-        # Function to compute the percentile across all slices
-        def _compute_percentile_across_slices(name, structure, cation, brain_1):
-            max_perc = 0
-            lipid_string = ""
+        for brain_1 in [True, False]:
+            # Maximum percentile across slices for each MAIA transformed lipid, or None if the
+            # lipid is not annotated in any slice
+            l_lipids = [
+                (name, structure, cation)
+                for index, (
+                    name,
+                    structure,
+                    cation,
+                    mz,
+                ) in self._data.get_annotations_MAIA_transformed_lipids(brain_1=brain_1).iterrows()
+            ]
+            dic_max_perc_lipid = {t_lipid: None for t_lipid in l_lipids}
+
             for slice_index in self._data.get_slice_list(
                 indices="brain_1" if brain_1 else "brain_2"
             ):
-                # Find lipid location
-                l_lipid_loc = (
-                    self._data.get_annotations()
-                    .index[
-                        (self._data.get_annotations()["name"] == name)
-                        & (self._data.get_annotations()["structure"] == structure)
-                        & (self._data.get_annotations()["slice"] == slice_index)
-                        & (self._data.get_annotations()["cation"] == cation)
-                    ]
-                    .tolist()
+                # Find lipid locations in the current slice
+                l_t_lipids = []
+                l_t_bounds = []
+                for name, structure, cation in l_lipids:
+                    index = self._data.get_annotation_index(name, structure, cation, slice_index)
+                    if index != -1:
+                        l_t_lipids.append((name, structure, cation))
+                        l_t_bounds.append(self._data.get_annotation_bounds(index))
+
+                if len(l_t_bounds) == 0:
+                    continue
+
+                # Get corresponding images, all at once
+                lookup_table_fine, first_bin_fine = self._data.get_fine_lookup_mz(slice_index)
+                array_images = compute_thread_safe_function(
+                    compute_images_using_index_and_image_lookup_batch,
+                    cache_flask,
+                    self._data,
+                    slice_index,
+                    np.array(l_t_bounds, dtype=np.float64),
+                    self._data.get_array_spectra(slice_index),
+                    self._data.get_array_lookup_pixels(slice_index),
+                    self._data.get_image_shape(slice_index),
+                    self._data.get_array_lookup_mz(slice_index),
+                    self._data.get_array_cumulated_lookup_mz_image(slice_index),
+                    self._data.get_divider_lookup(slice_index),
+                    self._data.get_array_peaks_transformed_lipids(slice_index),
+                    self._data.get_array_corrective_factors(slice_index),
+                    apply_transform=False,
+                    lookup_table_fine=lookup_table_fine,
+                    first_bin_fine=first_bin_fine,
                 )
 
-                # If several lipids correspond to the selection, we have a problem...
-                if len(l_lipid_loc) >= 1:
-                    index = l_lipid_loc[-1]
-
-                    # get final lipid name
-                    lipid_string = name + "_" + structure + "_" + cation
-
-                    # get lipid bounds
-                    lb_mz = float(self._data.get_annotations().iloc[index]["min"])
-                    hb_mz = float(self._data.get_annotations().iloc[index]["max"])
-
-                    # Get corresponding image
-                    image = compute_thread_safe_function(
-                        compute_image_using_index_and_image_lookup,
-                        cache_flask,
-                        self._data,
-                        slice_index,
-                        lb_mz,
-                        hb_mz,
-                        self._data.get_array_spectra(slice_index),
-                        self._data.get_array_lookup_pixels(slice_index),
-                        self._data.get_image_shape(slice_index),
-                        self._data.get_array_lookup_mz(slice_index),
-                        self._data.get_array_cumulated_lookup_mz_image(slice_index),
-                        self._data.get_divider_lookup(slice_index),
-                        self._data.get_array_peaks_transformed_lipids(slice_index),
-                        self._data.get_array_corrective_factors(slice_index).astype(np.float32),
-                        apply_transform=False,
-                    )
-
+                for t_lipid, image in zip(l_t_lipids, array_images):
                     # Check 99th percentile for normalization
                     perc = np.percentile(image, 99.0)
 
                     # perc must be quite small in theory... otherwise it's a bug
-                    if perc > max_perc:  # and perc<1:
-                        max_perc = perc
-            return max_perc, lipid_string
-
-        # Simulate a click on all MAIA transformed lipids
-        for brain_1 in [True, False]:
-            for (
-                index,
-                (name, structure, cation, mz),
-            ) in self._data.get_annotations_MAIA_transformed_lipids(brain_1=brain_1).iterrows():
-                max_perc, lipid_string = _compute_percentile_across_slices(
-                    name, structure, cation, brain_1
-                )
-                # Store max percentile across slices
-                dic_max_percentile[(lipid_string, brain_1)] = max_perc
+                    if dic_max_perc_lipid[t_lipid] is None:
+                        dic_max_perc_lipid[t_lipid] = 0
+                    if perc > dic_max_perc_lipid[t_lipid]:
+                        dic_max_perc_lipid[t_lipid] = perc
+
+            # Store max percentile across slices
+            for (name, structure, cation), max_perc in dic_max_perc_lipid.items():
+                if max_perc is None:
+                    dic_max_percentile[("", brain_1)] = 0
+                else:
+                    dic_max_percentile[(name + "_" + structure + "_" + cation, brain_1)] = max_perc
 
         return dic_max_percentile
 
@@ -834,7 +1309,9 @@ class Figures:
     ):
         """This function converts a numpy array into a base64 string, which can be returned
         directly, or itself be turned into a go.Image, which can be returned directly, or be
-        turned into a Plotly Figure, which will be returned.
+        turned into a Plotly Figure, which will be returned. If an ImageStore has been provided,
+        the go.Image references the image by its URL instead of embedding the base64 string, such
+        that the image can be cached by the browser, and the figure remains small.
 
         Args:
             image (np.ndarray): A numpy array representing the image to be converted. Possibly with
@@ -857,19 +1334,24 @@ class Figures:
         logging.info("Converting image to string")
 
         # Set optimize to False to gain computation time
-        base64_string = convert_image_to_base64(
-            image, type=type_image, overlay=None, transparent_zeros=True, optimize=False
-        )
+        if return_base64_string or self._image_store is None:
+            source = convert_image_to_base64(
+                image, type=type_image, overlay=None, transparent_zeros=True, optimize=False
+            )
+        else:
+            source = self._image_store.register_image(
+                image, type=type_image, overlay=None, transparent_zeros=True, optimize=False
+            )
 
         # Either return image directly
         if return_base64_string:
-            return base64_string
+            return source
 
         # Or compute heatmap as go image if needed
         logging.info("Converting image to go image")
         final_image = go.Image(
             visible=True,
-            source=base64_string,
+            source=source,
         )
 
         # Potentially return the go image directly
@@ -1022,27 +1504,29 @@ class Figures:
         if ll_lipid_names is None:
             ll_lipid_names = [["" for y in l_t_bounds] for l_t_bounds in ll_t_bounds]
 
-        # Loop over channels
+        # Gather the selected lipids of all channels
+        l_t_bounds_selected = []
+        l_lipid_names_selected = []
         for l_t_bounds, l_lipid_names in zip(ll_t_bounds, ll_lipid_names):
             if l_t_bounds is not None:
-                # Loop over lipids
                 for boundaries, lipid_name in zip(l_t_bounds, l_lipid_names):
                     if boundaries is not None:
-                        (lb_mz, hb_mz) = boundaries
-
-                        # Cmpute expression image per lipid
-                        image_temp = self.compute_image_per_lipid(
-                            slice_index,
-                            lb_mz,
-                            hb_mz,
-                            RGB_format=True,
-                            normalize=normalize,
-                            projected_image=projected_image,
-                            apply_transform=apply_transform,
-                            lipid_name=lipid_name,
-                            cache_flask=cache_flask,
-                        )
-                        image += image_temp
+                        l_t_bounds_selected.append(boundaries)
+                        l_lipid_names_selected.append(lipid_name)
+
+        # Compute expression images of all lipids at once and add them
+        if len(l_t_bounds_selected) > 0:
+            for image_temp in self.compute_images_per_lipid(
+                slice_index,
+                l_t_bounds_selected,
+                RGB_format=True,
+                normalize=normalize,
+                projected_image=projected_image,
+                apply_transform=apply_transform,
+                l_lipid_names=l_lipid_names_selected,
+                cache_flask=cache_flask,
+            ):
+                image += image_temp
 
         # Compute corresponding figure
         fig = self.build_lipid_heatmap_from_image(image, return_base64_string=return_base64_string)
@@ -1099,39 +1583,44 @@ class Figures:
                 for l_t_bounds in ll_t_bounds
             ]
 
-        # Build a list of empty images and add selected lipids for each channel
-        l_images = []
+        # Gather the selected lipids of all channels, recording the channel of each
+        l_t_bounds_selected = []
+        l_lipid_names_selected = []
+        l_channels_selected = []
+        for idx_channel, (l_boundaries, l_names) in enumerate(zip(ll_t_bounds, ll_lipid_names)):
+            if l_boundaries is not None:
+                for boundaries, lipid_name in zip(l_boundaries, l_names):
+                    if boundaries is not None:
+                        l_t_bounds_selected.append(boundaries)
+                        l_lipid_names_selected.append(lipid_name)
+                        l_channels_selected.append(idx_channel)
 
-        # Loop over channels
-        for l_boundaries, l_names in zip(ll_t_bounds, ll_lipid_names):
-            image = np.zeros(
+        # Build a list of empty images and add selected lipids for each channel
+        l_images = [
+            np.zeros(
                 self._atlas.image_shape
                 if projected_image
                 else self._data.get_image_shape(slice_index)
             )
-            if l_boundaries is not None:
-                # Loop over lipids
-                for boundaries, lipid_name in zip(l_boundaries, l_names):
-                    if boundaries is not None:
-                        (lb_mz, hb_mz) = boundaries
-
-                        # Cmpute expression image per lipid
-                        image_temp = self.compute_image_per_lipid(
-                            slice_index,
-                            lb_mz,
-                            hb_mz,
-                            RGB_format=True,
-                            normalize=normalize_independently,
-                            projected_image=projected_image,
-                            log=log,
-                            apply_transform=apply_transform,
-                            lipid_name=lipid_name,
-                            cache_flask=cache_flask,
-                        )
-                        if image_temp is not None:
-                            image += image_temp
+            for l_boundaries in ll_t_bounds
+        ]
 
-            l_images.append(image)
+        # Compute expression images of all lipids at once
+        if len(l_t_bounds_selected) > 0:
+            l_images_temp = self.compute_images_per_lipid(
+                slice_index,
+                l_t_bounds_selected,
+                RGB_format=True,
+                normalize=normalize_independently,
+                projected_image=projected_image,
+                log=log,
+                apply_transform=apply_transform,
+                l_lipid_names=l_lipid_names_selected,
+                cache_flask=cache_flask,
+            )
+            for idx_channel, image_temp in zip(l_channels_selected, l_images_temp):
+                if image_temp is not None:
+                    l_images[idx_channel] += image_temp
 
         # Reoder axis to match plotly go.image requirements
         array_image = np.moveaxis(np.array(l_images), 0, 2)
@@ -2171,14 +2660,8 @@ class Figures:
         logging.info("Lowly expressed lipids excluded")
 
         # Replace idx_lipids by actual name
-        df_names = self._data.get_annotations()
-        df_avg_intensity_lipids.index = df_avg_intensity_lipids.index.map(
-            lambda idx: df_names.iloc[idx]["name"]
-            + "_"
-            + df_names.iloc[idx]["structure"]
-            + "_"
-            + df_names.iloc[idx]["cation"]
-        )
+        l_labels = self._data.compute_l_labels()
+        df_avg_intensity_lipids.index = df_avg_intensity_lipids.index.map(lambda idx: l_labels[idx])
         logging.info("Lipid indexes replaced by names")
         logging.info("Preparing plot")
         # Plot
@@ -2659,7 +3142,8 @@ class Figures:
 
     def shelve_arrays_basic_figures(self, force_update=False):
         """This function shelves in the database all the arrays of basic images computed in
-        self.compute_figure_basic_image(), across all slices and all types of arrays. This forces
+        self.compute_figure_basic_image(), across all slices and all types of arrays, as well as the
+        zoom levels of the pyramids of tiles (see compute_figure_basic_image_tiled()). This forces
         the precomputations of these arrays, and allows to access them faster. Once everything has
         been shelved, a boolean value is stored in the shelve database, to indicate that the arrays
         do not need to be recomputed at next app startup.
@@ -2684,6 +3168,18 @@ class Figures:
                         else False,
                     )
 
+        # Precompute the zoom levels of the pyramids of tiles
+        for type_figure in L_TYPES_FIGURE_TILED:
+            for level in range(1, N_LEVELS_TILES):
+                self._storage.return_shelved_object(
+                    "figures/load_page",
+                    "array_basic_images_level",
+                    force_update=force_update,
+                    compute_function=self.compute_array_basic_images_level,
+                    type_figure=type_figure,
+                    level=level,
+                )
+
         self._storage.dump_shelved_object(
             "figures/load_page", "arrays_basic_figures_computed", True
         )
@@ -2722,29 +3218,12 @@ class Figures:
                     for slice_index in self._data.get_slice_list(
                         indices="brain_1" if brain_1 else "brain_2"
                     ):
-                        # Find lipid location
-                        l_lipid_loc = (
-                            self._data.get_annotations()
-                            .index[
-                                (self._data.get_annotations()["name"] == name)
-                                & (self._data.get_annotations()["structure"] == structure)
-                                & (self._data.get_annotations()["slice"] == slice_index)
-                                & (self._data.get_annotations()["cation"] == cation)
-                            ]
-                            .tolist()
+                        # Add lipid index for each slice (-1 if no lipid correspond to the
+                        # selection)
+                        l_selected_lipids.append(
+                            self._data.get_annotation_index(name, structure, cation, slice_index)
                         )
 
-                        # If several lipids correspond to the selection, we have a problem...
-                        if len(l_lipid_loc) > 1:
-                            logging.warning("More than one lipid corresponds to the selection")
-                            l_lipid_loc = [l_lipid_loc[-1]]
-                        # If no lipid correspond to the selection, set to -1
-                        if len(l_lipid_loc) == 0:
-                            l_lipid_loc = [-1]
-
-                        # add lipid index for each slice
-                        l_selected_lipids.append(l_lipid_loc[0])
-
                     # Get final lipid name
                     lipid_string = name + " " + structure + " " + cation
 
@@ -2755,12 +3234,7 @@ class Figures:
                         # Build the list of mz boundaries for each peak and each index
                         lll_lipid_bounds = [
                             [
-                                [
-                                    (
-                                        float(self._data.get_annotations().iloc[index]["min"]),
-                                        float(self._data.get_annotations().iloc[index]["max"]),
-                                    )
-                                ]
+                                [self._data.get_annotation_bounds(index)]
                                 if index != -1
                                 else None
                                 for index in [lipid_1_index, -1, -1]
@@ -2791,6 +3265,42 @@ class Figures:
             "figures/3D_page", "arrays_expression_" + str(brain_1) + "_computed", True
         )
 
+    def shelve_all_lipid_image_cubes(self, force_update=False, sample=False):
+        """This functions precomputes and shelves the image cubes of the annotated lipids (see
+        compute_lipid_image_cube()), with and without MAIA transform, for all slices. Once
+        everything has been shelved, a boolean value is stored in the shelve database, to indicate
+        that the cubes do not need to be recomputed at next app startup, and that they can be used
+        in compute_images_per_lipid().
+
+        Args:
+            force_update (bool, optional): If True, the function will not overwrite existing files.
+                Defaults to False.
+            sample (bool, optional): If True, only a fraction of the precomputations are made (for
+                debug). In this case, the cubes are not used by the app. Default to False.
+        """
+        l_slices = self._data.get_slice_list()
+        if sample:
+            logging.warning("Only a sample of the lipid image cubes will be computed!")
+            l_slices = l_slices[:2]
+
+        for slice_index in l_slices:
+            for apply_transform in [False, True]:
+                self._storage.return_shelved_object(
+                    "figures/lipid_selection",
+                    "lipid_image_cube",
+                    force_update=force_update,
+                    compute_function=self.compute_lipid_image_cube,
+                    slice_index=slice_index,
+                    apply_transform=apply_transform,
+                    cache_flask=None,  # No cache needed since launched at startup
+                )
+
+        # Variable to signal everything has been computed
+        if not sample:
+            self._storage.dump_shelved_object(
+                "figures/lipid_selection", "lipid_image_cubes_computed", True
+            )
+
     def shelve_all_arrays_annotation(self):
         """This functions precomputes and shelves the array of structure annotation used in a
         3D representation of the brain (through self.compute_3D_volume_figure()), at different
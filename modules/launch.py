@@ -10,7 +10,6 @@ launch."""
 
 # Standard modules
 import logging
-import shelve
 import sys
 import numpy as np
 
@@ -19,6 +18,7 @@ from modules.tools.spectra import (
     add_zeros_to_spectrum,
     compute_avg_intensity_per_lipid,
     compute_image_using_index_and_image_lookup,
+    compute_images_using_index_and_image_lookup_batch,
     return_idx_inf,
     return_idx_sup,
     sample_rows_from_path,
@@ -99,6 +99,14 @@ class Launch:
             # returned by Atlas.compute_array_projection(True, True)
             "atlas/atlas_objects/arrays_projection_corrected_True_True",
             #
+            # Computed in Atlas.__init__() as an argument of Atlas. Corresponds to the object
+            # returned by Atlas.compute_array_projection_flat_indices()
+            "atlas/atlas_objects/array_projection_flat_indices",
+            #
+            # Computed in Atlas.__init__() as an argument of Atlas. Corresponds to the object
+            # returned by Atlas.compute_array_label_planes()
+            "atlas/atlas_objects/array_label_planes",
+            #
             # Computed in Atlas.__init__(), calling Atlas.compute_array_projection() when
             # computing arrays_projection_corrected_True_True. Corresponds to the object returned by
             # Atlas.compute_projection_parameters()
@@ -137,7 +145,7 @@ class Launch:
             # Computed in Figures.__init__() as an argument of Figures. Corresponds to the
             # object returned by
             # Figures.compute_normalization_factor_across_slices(cache_flask=None)
-            "figures/lipid_selection/dic_normalization_factors_None",
+            "figures/lipid_selection/dic_normalization_factors",
             #
             # Computed in Figures.__init__(). Corresponds to the object returned
             # by Figures.compute_treemaps_figure().
@@ -183,6 +191,18 @@ class Launch:
             "figures/load_page/array_basic_images_projection_corrected",
             "figures/load_page/array_basic_images_atlas",
             #
+            # Computed in Figures.shelve_arrays_basic_figures(), itself called in
+            # Figures.__init__(). Corresponds to the object returned by
+            # figures.compute_array_basic_images_level(type_figure, level), i.e. the zoom levels of
+            # the pyramids of tiles, with type_figure in L_TYPES_FIGURE_TILED and level ranging from
+            # 1 to N_LEVELS_TILES - 1
+            "figures/load_page/array_basic_images_level_warped_data_1",
+            "figures/load_page/array_basic_images_level_warped_data_2",
+            "figures/load_page/array_basic_images_level_projection_corrected_1",
+            "figures/load_page/array_basic_images_level_projection_corrected_2",
+            "figures/load_page/array_basic_images_level_atlas_1",
+            "figures/load_page/array_basic_images_level_atlas_2",
+            #
             # Computed in Figures.__init(), calling Figures.shelve_all_l_array_2D(), but it
             # doesn't correspond to an object returned by a specific function.
             # All the list of 2D slices of expression objects are computed and saved in the
@@ -195,6 +215,14 @@ class Launch:
             "figures/3D_page/arrays_expression_True_computed",
             "figures/3D_page/arrays_expression_False_computed",
             #
+            # Computed in Figures.__init(), calling Figures.shelve_all_lipid_image_cubes(), but it
+            # doesn't correspond to an object returned by a specific function.
+            # The image cubes of the annotated lipids are computed and saved in the shelve database
+            # with the following ids:
+            # "figures/lipid_selection/lipid_image_cube_$slice_index$_$apply_transform$",
+            # (not explicitely in this list as there are too many).
+            "figures/lipid_selection/lipid_image_cubes_computed",
+            #
             # Computed in in Figures.__init(), calling Figures.shelve_all_arrays_annotation(),
             # but it doesn't correspond to an object returned by a specific function. The
             # corresponding objects saved in Figures.shelve_all_arrays_annotation() are in the
@@ -234,8 +262,9 @@ class Launch:
         self.l_entries_to_ignore = [
             "figures/3D_page/arrays_expression_",
             "figures/load_page/figure_basic_image_",
+            "figures/lipid_selection/lipid_image_cube_",
             "atlas/atlas_objects/mask_and_spectrum_",
-            "atlas/atlas_objects/dic_processed_temp",
+            "atlas/atlas_objects/masks_checkpoint",
             "launch/first_launch",
         ]
 
@@ -248,17 +277,17 @@ class Launch:
         It then returns a list containing the missing entries.
         """
 
-        # Get database
-        db = shelve.open(self.storage.path_db)
+        # Get database keys
+        l_db_keys = self.storage.list_keys()
 
         # Build a set of missing entries
-        l_missing_entries = list(set(self.l_db_entries) - set(db.keys()))
+        l_missing_entries = list(set(self.l_db_entries) - set(l_db_keys))
 
         if len(l_missing_entries) > 0:
             logging.info("Missing entries found in the shelve database:" + str(l_missing_entries))
 
         # Find out if there are entries in the databse and not in the list of entries to check
-        l_unexpected_entries = list(set(db.keys()) - set(self.l_db_entries))
+        l_unexpected_entries = list(set(l_db_keys) - set(self.l_db_entries))
 
         # Remove entries that are not in the initial list but are in the database, i.e all 2D lipid
         # slices, all brain regions, all figures in the load_slice page, and all atlas masks.
@@ -274,9 +303,6 @@ class Launch:
                 + str(l_unexpected_entries)
             )
 
-        # Close database
-        db.close()
-
         return l_missing_entries
 
     def compute_and_fill_entries(self, l_missing_entries):
@@ -287,9 +313,6 @@ class Launch:
             l_missing_entries (list): list of entries to compute and insert in the shelve database.
         """
 
-        # Get database
-        db = shelve.open(self.storage.path_db)
-
         # Compute missing entries if possible
         for entry in l_missing_entries:
 
@@ -312,15 +335,15 @@ class Launch:
             elif entry in self.l_other_objects_to_compute:
                 logging.info("Entry: " + entry + " is missing. Computing now.")
                 if entry == "annotations/lipid_options":
-                    db[entry] = self.data.return_lipid_options()
+                    data_folder, file_name = entry.rsplit("/", 1)
+                    self.storage.dump_shelved_object(
+                        data_folder, file_name, self.data.return_lipid_options()
+                    )
                 else:
                     logging.warning(
                         "Entry " + entry + " not found in the list of entries to compute."
                     )
 
-        # Close database
-        db.close()
-
     def run_compiled_functions(self):
         """This function runs once the slowest numba functions, whose compilation can take a little
         bit of time, so that the app is as fast as it can be after startup. Basically, it simulates
@@ -383,6 +406,18 @@ class Launch:
                 self.data.get_array_corrective_factors(slice_index).astype(np.float32),
                 apply_transform=False,
             )
+            compute_images_using_index_and_image_lookup_batch(
+                np.array([[500.1, 500.2], [600.1, 610.2]]),
+                self.data.get_array_spectra(slice_index),
+                self.data.get_array_lookup_pixels(slice_index),
+                self.data.get_image_shape(slice_index),
+                self.data.get_array_lookup_mz(slice_index),
+                self.data.get_array_cumulated_lookup_mz_image(slice_index),
+                self.data.get_divider_lookup(slice_index),
+                self.data.get_array_peaks_transformed_lipids(slice_index),
+                self.data.get_array_corrective_factors(slice_index),
+                apply_transform=True,
+            )
 
         def select_lipid_and_region_and_plot_volume():
             ll_t_bounds = [[None, None, None] for i in self.data.get_slice_list(indices="brain_1")]
@@ -393,8 +428,8 @@ class Launch:
         logging.info("Please wait while compiled functions are executed...")
         draw_region_and_compute_spectral_data()
         select_lipid_and_region_and_plot_volume()
-        # Clean memory as it has not been done since compute_thread_safe function wasn't used
-        self.data.clean_memory(slice_index=1)
+        # Release memory as it has not been done since compute_thread_safe function wasn't used
+        self.data.release_memory(slice_index=1)
         logging.info("Compiled functions executed.")
 
     def launch(self, force_exit_if_first_launch=True):
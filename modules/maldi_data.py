@@ -11,16 +11,40 @@ of memory maps, and annotations."""
 # Standard modules
 import logging
 import pickle
-import time
 import numpy as np
 import pandas as pd
 import os
 from skimage import io
 import lzma
+import mmap
+import psutil
+import hashlib
+import tempfile
+import threading
+import queue
+from collections import OrderedDict
 
 # LBAE imports
-from modules.tools.misc import logmem
+from modules.tools.misc import logmem, ReadWriteLock
+from modules.tools.columnar import ColumnarArrays, NAME_META_FILE
 
+# ==================================================================================================
+# --- Constants
+# ==================================================================================================
+
+# Names of the arrays stored in memory maps, for each slice
+L_ARRAYS_MEMMAP = [
+    "array_spectra",
+    "array_avg_spectrum",
+    "array_avg_spectrum_after_standardization",
+    "array_lookup_mz",
+    "array_cumulated_lookup_mz_image",
+    "array_corrective_factors",
+    "array_fine_lookup_mz",
+]
+
+# Names of the memory-mapped arrays which are not stored as float32
+DIC_DTYPES_MEMMAP = {"array_lookup_mz": "int32", "array_fine_lookup_mz": "uint8"}
 
 # ==================================================================================================
 # --- Class
@@ -35,9 +59,10 @@ class MaldiData:
 
     Attributes:
         _sample_data (bool): if True, use the sampled dataset. Else use the whole dataset.
-        _dic_lightweight (dictionnary): a dictionnary containing the following lightweights arrays,
-            which remain in memory as long as the app is running, as well as the shape of thoses
-            stored in memory maps:
+        _dic_lightweight (dictionnary or ColumnarArrays): a dictionnary containing the following
+            lightweights arrays, which remain in memory as long as the app is running (or are
+            memory-mapped if the dataset has been converted to a columnar container), as well as
+            the shape of thoses stored in memory maps:
             - image_shape: a tuple of integers, indicating the vertical and horizontal sizes of the
                 corresponding slice.
             - divider_lookup: integer that sets the resolution of the lookup tables.
@@ -57,10 +82,12 @@ class MaldiData:
         _l_slices (list): list of slices indices in the dataset. Indices start at 1.
         _l_slices_brain_1 (list): list of slices indices belonging to brain 1.
         _l_slices_brain_2 (list): list of slices indices belonging to brain 2.
-        _dic_memmap (dictionnary): a dictionnary containing numpy memory maps allowing to access the
+        _dic_memmap (OrderedDict): an ordered dictionnary containing the numpy memory maps
+            currently open, indexed by (slice index, array name), allowing to access the
             heavyweights arrays of the datasets, without saturating the disk (ONLY IF _sample_data
-            IS FALSE. ELSE ALL THE DATASET IS STORED IN _dic_lightweight). The arrays in the
-            dictionnary are:
+            IS FALSE. ELSE ALL THE DATASET IS STORED IN _dic_lightweight). The memory maps are
+            opened when first accessed, and ordered from the least to the most recently used. The
+            arrays that can be accessed are:
             - array_spectra: bidimensional, it contains the concatenated spectra of each pixel.
                 First row contains the m/z values, while second row contains the corresponding
                 intensities.
@@ -71,11 +98,31 @@ class MaldiData:
                 standardization.
             - array_lookup_mz: bidimensional, it maps m/z values to indexes in array_spectra for
                 each pixel.
-            - array_cumulated_lookup_mz_image: bidimensional, it maps m/z values to the cumulated
-                spectrum until the corresponding m/z value for each pixel.
+            - array_cumulated_lookup_mz_image: three-dimensional, it maps m/z values to the
+                cumulated spectrum until the corresponding m/z value for each pixel. If the dataset
+                has been processed with sparse image lookups, it's bidimensional and only contains
+                the pixels with at least one peak (see build_sparse_cumulated_image_lookup_table()).
             - array_corrective_factors: three-dimensional, it contains the MAIA corrective factor
                 used for lipid (first dimension) and each pixel (second and third dimension).
         _path_data (str): path were the data files are stored.
+        _max_open_memmaps (int): maximum number of memory maps kept open at the same time.
+        _memmap_lock (threading.Lock): lock protecting _dic_memmap from concurrent modifications.
+        _last_slice_index (int): index of the slice whose memory maps were last accessed.
+        _prefetch_neighbours (bool): if True, the files of the neighbouring slices are read ahead
+            in the background when a new slice is accessed.
+        _prefetch_queue (queue.Queue): queue of the slices whose files must be read ahead.
+        _set_prefetch_pending (set): slices currently in _prefetch_queue, such that a slice is not
+            queued twice.
+        _prefetch_thread (threading.Thread): long-lived worker reading ahead the files of the slices
+            in _prefetch_queue, started when first needed.
+        _memory_mode (str): "madvise" to release the memory used by the memory-mapped arrays by
+            advising the kernel that their pages are not needed anymore, or "remap" to recreate the
+            memory maps.
+        _rss_budget (int): if not None, the memory is only released when the resident memory of the
+            process (in bytes) is above this budget.
+        _lock (ReadWriteLock): multi-readers/single-writer lock, shared by all the threads and
+            processes using the same data, used to prevent the memory-mapped arrays from being
+            cleaned while being read.
         _df_annotations (pd.dataframe): a dataframe containing for each slice and each annotated
             peak the name of the lipid in between the two annotated peak boundaries. Columns are
             'slice', 'name', 'structure', 'cation', 'theoretical m/z', 'min', 'max', 'num_pixels',
@@ -85,14 +132,40 @@ class MaldiData:
             'cation', 'estimated_mz', for brain 1.
         _df_annotations_MAIA_transformed_lipids_brain_2 (pd.dataframe): Same as
             _df_annotations_MAIA_transformed_lipids_brain_1 for brain 2.
+        _dic_annotation_index (dict): a dictionnary mapping each (name, structure, cation, slice)
+            to the (positional) index of the corresponding row in _df_annotations.
+        _dic_annotation_rows_per_lipid (dict): a dictionnary mapping each (name, structure, cation)
+            to the list of indices of the corresponding rows in _df_annotations, for all slices.
+        _array_annotation_bounds (np.ndarray): bidimensional, it contains the (min, max) peak
+            boundaries of each row of _df_annotations.
+        _dic_annotation_rows_per_slice (dict): a dictionnary mapping each slice index to the array
+            of indices of its rows in _df_annotations, in the order of the annotation file.
+        _dic_labels (dict): a dictionnary mapping each slice index (or None for the whole dataset)
+            to the corresponding list of lipid labels, computed when first requested.
+        _l_lipid_options (list): the lipid options returned by return_lipid_options(), computed
+            when first requested.
 
     Methods:
-        __init__(path_data="data/whole_dataset/", path_annotations="data/annotations/"): Initialize
-            the class MaldiData.
+        __init__(path_data="data/whole_dataset/", path_annotations="data/annotations/",
+            sample_data=False, memory_mode="madvise", rss_budget=None, max_open_memmaps=64,
+            prefetch_neighbours=True): Initialize the class MaldiData.
+        _open_memmap(slice_index, array_name): Opens the memory map of the requested array for the
+            requested slice, closing the least recently used ones if needed.
+        _get_memmap(slice_index, array_name): Returns the memory map of the requested array for the
+            requested slice, opening it if needed.
+        _queue_prefetch(l_slices): Queues the slices whose files must be read ahead.
+        _run_prefetch(): Reads ahead the files of the queued slices, in a background thread.
+        _build_annotation_index(): Builds the indices used to look up the lipid annotations.
+        load_annotations(path_annotations): (Re)loads the lipid annotation of each slice.
         get_annotations(): Getter for the lipid annotation of each slice, contained in a pandas
             dataframe.
         get_annotations_MAIA_transformed_lipids(brain_1=True): Getter for the MAIA transformed
             lipid annotation, contained in a pandas dataframe.
+        get_annotation_index(name, structure, cation, slice_index=None): Returns the index of the
+            annotation of the requested lipid in the requested slice, or -1 if it doesn't exist.
+        get_annotation_bounds(index): Returns the (min, max) peak boundaries of an annotation.
+        get_annotation_bounds_per_slice(slice_index): Returns the arrays of lower and upper peak
+            boundaries of the annotations of the requested slice.
         get_slice_number(): Getter for the number of slice present in the dataset.
         get_slice_list(indices="all"): Getter for the list of slice indices in the dataset.
         get_image_shape(slice_index): Getter for image_shape, which indicates the shape of the image
@@ -127,6 +200,8 @@ class MaldiData:
         get_array_cumulated_lookup_mz_image(slice_index): Getter for
             array_cumulated_lookup_mz_image, which is a lookup table that maps m/z values to the
             cumulated spectrum until the corresponding m/z value for each pixel.
+        get_fine_lookup_mz(slice_index): Getter for array_fine_lookup_mz, an optional lookup table
+            refining array_lookup_mz in a restricted m/z range, along with its first bin.
         get_partial_array_spectra(slice_index, lb=None, hb=None, index=None): Getter for
             partial_array_spectra, which is a (memmaped) numpy array containing the spectral data
             of slice indexed by slice_index, between lb and hb m/z values.
@@ -147,11 +222,16 @@ class MaldiData:
             data of slice indexed by slice_index.
         is_brain_1(self, slice_index): Returns True if the slice indexed by slice_index is from
             brain 1, False otherwise.
-        clean_memory(slice_index=None, array=None, cache=None): Cleans the memory (reset the
+        get_lock(): Getter for the read/write lock protecting the memory-mapped arrays.
+        get_lock_stats(): Returns the counters (number of readers, waiting times) of the lock.
+        clean_memory(slice_index=None, array=None, cache=None): Cleans the memory (close the
             memory-mapped arrays) of the app.
-        compute_l_labels(slice_index): Computes and returns the labels of the lipids in the dataset
-            for the requested slice.
-        return_lipid_options(): Computes and returns the list of lipid names, structures and cation.
+        release_memory(slice_index=None): Releases the memory used by the memory-mapped arrays,
+            according to the memory mode and budget.
+        compute_l_labels(slice_index=None): Computes (once) and returns the labels of the lipids in
+            the dataset, or in the requested slice.
+        return_lipid_options(): Computes (once) and returns the list of lipid names, structures and
+            cation.
         compute_padded_original_images(): Pads the original slice images of the dataset so that they
             all have the same size.
     """
@@ -167,7 +247,23 @@ class MaldiData:
         "_df_annotations",
         "_df_annotations_MAIA_transformed_lipids_brain_1",
         "_df_annotations_MAIA_transformed_lipids_brain_2",
+        "_dic_annotation_index",
+        "_dic_annotation_rows_per_lipid",
+        "_array_annotation_bounds",
+        "_dic_annotation_rows_per_slice",
+        "_dic_labels",
+        "_l_lipid_options",
         "_path_data",
+        "_memory_mode",
+        "_rss_budget",
+        "_lock",
+        "_max_open_memmaps",
+        "_memmap_lock",
+        "_last_slice_index",
+        "_prefetch_neighbours",
+        "_prefetch_queue",
+        "_set_prefetch_pending",
+        "_prefetch_thread",
     ]
 
     # ==============================================================================================
@@ -179,12 +275,27 @@ class MaldiData:
         path_data="data/whole_dataset/",
         path_annotations="data/annotations/",
         sample_data=False,
+        memory_mode="madvise",
+        rss_budget=None,
+        max_open_memmaps=64,
+        prefetch_neighbours=True,
     ):
         """Initialize the class MaldiData.
 
         Args:
             path_data (str): Path used to load the files containing the MALDI data.
             path_annotations (str): Path used to load the files containing the annotations.
+            sample_data (bool): If True, use the sampled dataset. Defaults to False.
+            memory_mode (str): "madvise" to release the memory used by the memory-mapped arrays
+                while keeping them open, or "remap" to recreate them (see release_memory()).
+                Defaults to "madvise".
+            rss_budget (int): If not None, the memory used by the memory-mapped arrays is only
+                released when the resident memory of the process (in bytes) is above this budget.
+                Defaults to None.
+            max_open_memmaps (int): Maximum number of memory maps kept open at the same time. The
+                least recently used ones are closed first. Defaults to 64.
+            prefetch_neighbours (bool): If True, the files of the neighbouring slices are read
+                ahead in the background when a new slice is accessed. Defaults to True.
         """
 
         logging.info("Initializing MaldiData object" + logmem())
@@ -192,8 +303,12 @@ class MaldiData:
         # Set if use the sampled dataset or not
         self._sample_data = sample_data
 
-        # Load the dictionnary containing small-size data for all slices
-        if self._sample_data:
+        # Load the dictionnary containing small-size data for all slices. If it has been converted
+        # to a columnar container (see convert_light_arrays_pickle()), it's memory-mapped and
+        # only read on demand. Else, it's loaded from the pickle file
+        if os.path.exists(os.path.join(path_data, "light_arrays", NAME_META_FILE)):
+            self._dic_lightweight = ColumnarArrays(os.path.join(path_data, "light_arrays"))
+        elif self._sample_data:
             with lzma.open(path_data + "light_arrays.pickle", "rb") as handle:
                 self._dic_lightweight = pickle.load(handle)
         else:
@@ -210,31 +325,42 @@ class MaldiData:
             [slice_idx for slice_idx, val in self._dic_lightweight.items() if not val["is_brain_1"]]
         )
 
-        # Set the accesser to the mmap files
-        self._dic_memmap = {}
-        if not self._sample_data:
-            for slice_index in self._l_slices:
-                self._dic_memmap[slice_index] = {}
-                for array_name in [
-                    "array_spectra",
-                    "array_avg_spectrum",
-                    "array_avg_spectrum_after_standardization",
-                    "array_lookup_mz",
-                    "array_cumulated_lookup_mz_image",
-                    "array_corrective_factors",
-                ]:
-                    self._dic_memmap[slice_index][array_name] = np.memmap(
-                        path_data + array_name + "_" + str(slice_index) + ".mmap",
-                        dtype="float32" if array_name != "array_lookup_mz" else "int32",
-                        mode="r",
-                        shape=self._dic_lightweight[slice_index][array_name + "_shape"],
-                    )
+        # Set the accesser to the mmap files. The memory maps are only opened when first accessed,
+        # and at most max_open_memmaps of them are kept open (least recently used ones are closed
+        # first)
+        self._dic_memmap = OrderedDict()
+        self._max_open_memmaps = max_open_memmaps
+        self._memmap_lock = threading.Lock()
+        self._last_slice_index = None
+        self._prefetch_neighbours = prefetch_neighbours
+        self._prefetch_queue = queue.Queue()
+        self._set_prefetch_pending = set()
+        self._prefetch_thread = None
 
         # Save path_data for cleaning memmap in case
         self._path_data = path_data
 
-        # Load lipid annotation (not user-session specific)
-        self._df_annotations = pd.read_csv(path_annotations + "lipid_annotation.csv")
+        # Set how the memory used by the memmaps is released. madvise can't be used with
+        # Python < 3.8 or on systems which don't support it
+        if memory_mode == "madvise" and not hasattr(mmap.mmap, "madvise"):
+            logging.warning("madvise is not available, memory maps will be recreated instead")
+            memory_mode = "remap"
+        self._memory_mode = memory_mode
+        self._rss_budget = rss_budget
+
+        # Lock preventing the memmaps from being cleaned while being read. The lock file is shared
+        # by all the processes using the same data
+        self._lock = ReadWriteLock(
+            os.path.join(
+                tempfile.gettempdir(),
+                "lbae_"
+                + hashlib.sha1(os.path.abspath(path_data).encode()).hexdigest()[:16]
+                + ".lock",
+            )
+        )
+
+        # Load lipid annotation (not user-session specific), and index it for fast lookups
+        self.load_annotations(path_annotations)
 
         # Load lipid annotations of MAIA-transformed lipids for brain 1
         self._df_annotations_MAIA_transformed_lipids_brain_1 = pd.read_csv(
@@ -256,6 +382,138 @@ class MaldiData:
     # --- Methods
     # ==============================================================================================
 
+    def _open_memmap(self, slice_index, array_name):
+        """Opens the memory map of the requested array for the requested slice, and registers it in
+        _dic_memmap, after closing the least recently used memory maps if too many of them are
+        open. The memory maps are closed by simply dropping them, which means that the ones still
+        being used elsewhere remain valid until they are not referenced anymore. _memmap_lock must
+        be held when calling this function.
+
+        Args:
+            slice_index (int): Index of the slice whose memory map must be opened.
+            array_name (str): Name of the array whose memory map must be opened.
+
+        Returns:
+            (np.memmap): The memory map of the requested array.
+        """
+        while len(self._dic_memmap) >= self._max_open_memmaps:
+            self._dic_memmap.popitem(last=False)
+        memmap = np.memmap(
+            self._path_data + array_name + "_" + str(slice_index) + ".mmap",
+            dtype=DIC_DTYPES_MEMMAP.get(array_name, "float32"),
+            mode="r",
+            shape=self._dic_lightweight[slice_index][array_name + "_shape"],
+        )
+        self._dic_memmap[(slice_index, array_name)] = memmap
+        return memmap
+
+    def _get_memmap(self, slice_index, array_name):
+        """Returns the memory map of the requested array for the requested slice, opening it if it
+        is not already open. If the slice is not the one that was last accessed (i.e. the slider
+        has been moved), the files of the neighbouring slices are read ahead in the background.
+
+        Args:
+            slice_index (int): Index of the slice whose memory map is requested.
+            array_name (str): Name of the array whose memory map is requested.
+
+        Returns:
+            (np.memmap): The memory map of the requested array.
+        """
+        with self._memmap_lock:
+            memmap = self._dic_memmap.get((slice_index, array_name))
+            if memmap is not None:
+                self._dic_memmap.move_to_end((slice_index, array_name))
+            else:
+                memmap = self._open_memmap(slice_index, array_name)
+            new_slice = slice_index != self._last_slice_index
+            self._last_slice_index = slice_index
+
+        if new_slice and self._prefetch_neighbours:
+            position = self._l_slices.index(slice_index)
+            l_neighbours = self._l_slices[max(0, position - 1) : position + 2]
+            self._queue_prefetch([index for index in l_neighbours if index != slice_index])
+        return memmap
+
+    def _queue_prefetch(self, l_slices):
+        """Queues the slices whose files must be read ahead, skipping the ones already queued, and
+        starts the prefetching thread if it's not running yet. A single thread is used for the
+        whole process, such that slice changes (e.g. loops over all slices) don't spawn threads.
+
+        Args:
+            l_slices (list(int)): Indices of the slices whose files must be read ahead.
+        """
+        with self._memmap_lock:
+            for slice_index in l_slices:
+                if slice_index not in self._set_prefetch_pending:
+                    self._set_prefetch_pending.add(slice_index)
+                    self._prefetch_queue.put(slice_index)
+            if self._prefetch_thread is None:
+                self._prefetch_thread = threading.Thread(target=self._run_prefetch, daemon=True)
+                self._prefetch_thread.start()
+
+    def _run_prefetch(self):
+        """Reads ahead the files of the queued slices, by advising the kernel that they will be
+        needed soon (POSIX_FADV_WILLNEED). The kernel then loads them in the page cache
+        asynchronously, such that the memory maps of these slices don't fault on first access. This
+        is a no-op on platforms without posix_fadvise. Optional arrays (e.g. array_fine_lookup_mz)
+        are skipped if they don't exist for the slice.
+        """
+        while True:
+            slice_index = self._prefetch_queue.get()
+            for array_name in L_ARRAYS_MEMMAP:
+                if array_name + "_shape" not in self._dic_lightweight[slice_index]:
+                    continue
+                if not hasattr(os, "posix_fadvise"):
+                    break
+                try:
+                    fd = os.open(
+                        self._path_data + array_name + "_" + str(slice_index) + ".mmap", os.O_RDONLY
+                    )
+                    try:
+                        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                    finally:
+                        os.close(fd)
+                except OSError as e:
+                    logging.info("Could not read ahead slice " + str(slice_index) + ": " + str(e))
+            with self._memmap_lock:
+                self._set_prefetch_pending.discard(slice_index)
+
+    def _build_annotation_index(self):
+        """Builds the indices used to look up the lipid annotations in constant time, instead of
+        filtering _df_annotations with boolean masks. Indices are positional, i.e. they can be used
+        with _df_annotations.iloc. If the same lipid is annotated several times in a slice, the last
+        annotation is kept, as done previously when filtering the dataframe.
+        """
+        df = self._df_annotations
+        self._dic_annotation_index = {}
+        self._dic_annotation_rows_per_lipid = {}
+        for index, (name, structure, cation, slice_index) in enumerate(
+            zip(df["name"], df["structure"], df["cation"], df["slice"])
+        ):
+            self._dic_annotation_index[(name, structure, cation, int(slice_index))] = index
+            self._dic_annotation_rows_per_lipid.setdefault((name, structure, cation), []).append(
+                index
+            )
+        self._array_annotation_bounds = df[["min", "max"]].to_numpy(dtype=np.float64)
+        self._dic_annotation_rows_per_slice = {
+            int(slice_index): array_rows
+            for slice_index, array_rows in df.groupby("slice").indices.items()
+        }
+        self._dic_labels = {}
+
+        # The lipid options are recomputed when first requested
+        self._l_lipid_options = None
+
+    def load_annotations(self, path_annotations):
+        """(Re)loads the lipid annotation of each slice, and rebuilds the indices and cached lists
+        (labels, lipid options) which depend on it.
+
+        Args:
+            path_annotations (str): Path used to load the file containing the annotations.
+        """
+        self._df_annotations = pd.read_csv(path_annotations + "lipid_annotation.csv")
+        self._build_annotation_index()
+
     def get_annotations(self):
         """Getter for the lipid annotation of each slice, contained in a pandas
             dataframe.
@@ -280,6 +538,57 @@ class MaldiData:
         else:
             return self._df_annotations_MAIA_transformed_lipids_brain_2
 
+    def get_annotation_index(self, name, structure, cation, slice_index=None):
+        """Returns the (positional) index of the annotation of the requested lipid in the requested
+        slice, i.e. the row of the dataframe returned by get_annotations().
+
+        Args:
+            name (str): Name of the lipid.
+            structure (str): Structure of the lipid.
+            cation (str): Cation of the lipid.
+            slice_index (int, optional): Index of the slice. If None, the first annotation of the
+                lipid, across all slices, is returned. Defaults to None.
+
+        Returns:
+            (int): The index of the annotation, or -1 if the lipid is not annotated.
+        """
+        if slice_index is None:
+            l_rows = self._dic_annotation_rows_per_lipid.get((name, structure, cation))
+            return l_rows[0] if l_rows is not None else -1
+        return self._dic_annotation_index.get((name, structure, cation, slice_index), -1)
+
+    def get_annotation_bounds(self, index):
+        """Returns the peak boundaries of the annotation indexed by index.
+
+        Args:
+            index (int): The (positional) index of the annotation.
+
+        Returns:
+            (float, float): The lower and upper peak boundaries of the annotation.
+        """
+        return (
+            float(self._array_annotation_bounds[index, 0]),
+            float(self._array_annotation_bounds[index, 1]),
+        )
+
+    def get_annotation_bounds_per_slice(self, slice_index):
+        """Returns the peak boundaries of the annotations of the requested slice, in the order of
+        the annotation file (i.e. the order of compute_l_labels(slice_index)).
+
+        Args:
+            slice_index (int): Index of the slice.
+
+        Returns:
+            (np.ndarray, np.ndarray): The lower and upper peak boundaries of the annotations.
+        """
+        array_rows = self._dic_annotation_rows_per_slice.get(
+            slice_index, np.zeros((0,), dtype=np.int64)
+        )
+        return (
+            self._array_annotation_bounds[array_rows, 0],
+            self._array_annotation_bounds[array_rows, 1],
+        )
+
     def get_slice_number(self):
         """Getter for the number of slice present in the dataset.
 
@@ -398,7 +707,7 @@ class MaldiData:
         if self._sample_data:
             return self._dic_lightweight[slice_index]["array_corrective_factors"]
         else:
-            return self._dic_memmap[slice_index]["array_corrective_factors"]
+            return self._get_memmap(slice_index, "array_corrective_factors")
 
     def get_array_spectra(self, slice_index):
         """Getter for array_spectra, which is a numpy array containing the spectral data
@@ -413,7 +722,7 @@ class MaldiData:
         if self._sample_data:
             return self._dic_lightweight[slice_index]["array_spectra"]
         else:
-            return self._dic_memmap[slice_index]["array_spectra"]
+            return self._get_memmap(slice_index, "array_spectra")
 
     def get_array_mz(self, slice_index):
         """Getter for array_mz, which corresponds to the first row of array_spectra, i.e. the m/z
@@ -429,7 +738,7 @@ class MaldiData:
         if self._sample_data:
             return self._dic_lightweight[slice_index]["array_spectra"][0, :]
         else:
-            return self._dic_memmap[slice_index]["array_spectra"][0, :]
+            return self._get_memmap(slice_index, "array_spectra")[0, :]
 
     def get_array_intensity(self, slice_index):
         """Getter for array_intensity, which corresponds to the second row of array_spectra, i.e.
@@ -445,7 +754,7 @@ class MaldiData:
         if self._sample_data:
             return self._dic_lightweight[slice_index]["array_spectra"][1, :]
         else:
-            return self._dic_memmap[slice_index]["array_spectra"][1, :]
+            return self._get_memmap(slice_index, "array_spectra")[1, :]
 
     def get_array_avg_spectrum(self, slice_index, standardization=True):
         """Getter for array_avg_spectrum, which is a numpy array containing the (high
@@ -463,14 +772,14 @@ class MaldiData:
             if self._sample_data:
                 return self._dic_lightweight[slice_index]["array_avg_spectrum"]
             else:
-                return self._dic_memmap[slice_index]["array_avg_spectrum"]
+                return self._get_memmap(slice_index, "array_avg_spectrum")
         else:
             if self._sample_data:
                 return self._dic_lightweight[slice_index][
                     "array_avg_spectrum_after_standardization"
                 ]
             else:
-                return self._dic_memmap[slice_index]["array_avg_spectrum_after_standardization"]
+                return self._get_memmap(slice_index, "array_avg_spectrum_after_standardization")
 
     def get_array_lookup_mz(self, slice_index):
         """Getter for array_lookup_mz, which is a lookup table that maps m/z values to the
@@ -485,7 +794,7 @@ class MaldiData:
         if self._sample_data:
             return self._dic_lightweight[slice_index]["array_lookup_mz"]
         else:
-            return self._dic_memmap[slice_index]["array_lookup_mz"]
+            return self._get_memmap(slice_index, "array_lookup_mz")
 
     def get_array_cumulated_lookup_mz_image(self, slice_index):
         """Getter for array_cumulated_lookup_mz_image, which is a lookup table that maps m/z values
@@ -500,7 +809,29 @@ class MaldiData:
         if self._sample_data:
             return self._dic_lightweight[slice_index]["array_cumulated_lookup_mz_image"]
         else:
-            return self._dic_memmap[slice_index]["array_cumulated_lookup_mz_image"]
+            return self._get_memmap(slice_index, "array_cumulated_lookup_mz_image")
+
+    def get_fine_lookup_mz(self, slice_index):
+        """Getter for array_fine_lookup_mz, which is an optional lookup table refining
+        array_lookup_mz in a restricted m/z range (see build_fine_index_lookup_table() in
+        modules/tools/lookup_tables.py), along with the index of its first bin.
+
+        Args:
+            slice_index (int): Index of the slice for which the lookup table is requested.
+
+        Returns:
+            (np.ndarray (mmaped if not sampled dataset), int): The requested lookup table (None if
+                it has not been computed for this slice), and the index of its first bin.
+        """
+        dic = self._dic_lightweight[slice_index]
+        if self._sample_data:
+            if "array_fine_lookup_mz" not in dic:
+                return None, 0
+            return dic["array_fine_lookup_mz"], dic["first_bin_fine"]
+        else:
+            if "array_fine_lookup_mz_shape" not in dic:
+                return None, 0
+            return self._get_memmap(slice_index, "array_fine_lookup_mz"), dic["first_bin_fine"]
 
     def get_partial_array_spectra(self, slice_index, lb=None, hb=None, index=None):
         """Getter for partial_array_spectra, which is a numpy array containing the
@@ -520,7 +851,7 @@ class MaldiData:
         if self._sample_data:
             dic = self._dic_lightweight[slice_index]
         else:
-            dic = self._dic_memmap[slice_index]
+            dic = {"array_spectra": self._get_memmap(slice_index, "array_spectra")}
 
         if lb is None and hb is None and index is None:
             # Previously called array_spectra_high_res.
@@ -575,7 +906,7 @@ class MaldiData:
         if self._sample_data:
             dic = self._dic_lightweight[slice_index]
         else:
-            dic = self._dic_memmap[slice_index]
+            dic = {"array_spectra": self._get_memmap(slice_index, "array_spectra")}
 
         if lb is None and hb is None and index is None:
             # Previously called array_spectra_high_res
@@ -630,7 +961,7 @@ class MaldiData:
         if self._sample_data:
             dic = self._dic_lightweight[slice_index]
         else:
-            dic = self._dic_memmap[slice_index]
+            dic = {"array_spectra": self._get_memmap(slice_index, "array_spectra")}
 
         if lb is None and hb is None and index is None:
             # Previously called array_spectra_high_res
@@ -681,34 +1012,22 @@ class MaldiData:
             (np.ndarray, mmaped if not sampled dataset)): Average spectrum of the spectral data of the
                 requested slice between lb and hb.
         """
-        # As there are many possibilities, define new dic depending if sampled data or not
-        if self._sample_data:
-            dic = self._dic_lightweight[slice_index]
-        else:
-            dic = self._dic_memmap[slice_index]
+        # Get the requested average spectrum (standardized or not) before slicing it
+        array_avg_spectrum = self.get_array_avg_spectrum(slice_index, standardization)
 
         # Start with most likely case
         if hb is not None and lb is not None:
-            if standardization:
-                return dic[slice_index]["array_avg_spectrum"][:, lb:hb]
-            else:
-                return dic[slice_index]["array_avg_spectrum_before_standardization"][:, lb:hb]
+            return array_avg_spectrum[:, lb:hb]
 
         # Second most likely case : full slice
         elif lb is None and hb is None:
-            return self.get_array_avg_spectrum(slice_index, standardization)
+            return array_avg_spectrum
 
         # Most likely the remaining cases won't be used
         elif lb is None:
-            if standardization:
-                return dic[slice_index]["array_avg_spectrum"][:, :hb]
-            else:
-                return dic[slice_index]["array_avg_spectrum_before_standardization"][:, :hb]
+            return array_avg_spectrum[:, :hb]
         else:
-            if standardization:
-                return dic[slice_index]["array_avg_spectrum"][:, lb:]
-            else:
-                return dic[slice_index]["array_avg_spectrum_before_standardization"][:, lb:]
+            return array_avg_spectrum[:, lb:]
 
     def get_lookup_mz(self, slice_index, index):
         """Returns the m/z value corresponding to the index in the spectral data of the slice
@@ -726,7 +1045,7 @@ class MaldiData:
         if self._sample_data:
             return self._dic_lightweight[slice_index]["array_lookup_mz"][index]
         else:
-            return self._dic_memmap[slice_index]["array_lookup_mz"][index]
+            return self._get_memmap(slice_index, "array_lookup_mz")[index]
 
     def get_cumulated_lookup_mz_image(self, slice_index, index):
         """Returns the cumulated spectrum until the corresponding m/z value for the pixel
@@ -744,7 +1063,7 @@ class MaldiData:
         if self._sample_data:
             return self._dic_lightweight[slice_index]["array_cumulated_lookup_mz_image"][index]
         else:
-            return self._dic_memmap[slice_index]["array_cumulated_lookup_mz_image"][index]
+            return self._get_memmap(slice_index, "array_cumulated_lookup_mz_image")[index]
 
     def is_brain_1(self, slice_index):
         """Returns True if the slice indexed by slice_index is a brain 1. Else, returns False.
@@ -757,18 +1076,38 @@ class MaldiData:
         """
         return self._dic_lightweight[slice_index]["is_brain_1"]
 
+    def get_lock(self):
+        """Getter for the read/write lock protecting the memory-mapped arrays. It must be acquired
+        for reading while the memmaps are being read, which prevents them from being cleaned.
+
+        Returns:
+            (ReadWriteLock): The lock of the dataset.
+        """
+        return self._lock
+
+    def get_lock_stats(self):
+        """Returns the counters of the read/write lock protecting the memory-mapped arrays, which
+        can be used to monitor contention between concurrent requests.
+
+        Returns:
+            (dict): The number of readers and writers of the current process, and the number of
+                acquisitions and waiting times, for reading and writing.
+        """
+        return self._lock.get_stats()
+
     def clean_memory(self, slice_index=None, array=None, cache=None):
-        """Cleans the memory (reset the memory-mapped arrays) of the app. slice_index and array
-        allow for a more fine-grained cleaning. If "cache" is provided, it will be used to lock the
-        dataset while cleaning. Overall, this function takes about 5ms to run on all memmaps, and
-        1ms on a given slice.
+        """Cleans the memory (close the memory-mapped arrays, which are reopened when accessed
+        again) of the app. slice_index and array allow for a more fine-grained cleaning. The
+        dataset is locked for writing while cleaning, i.e. the cleaning waits for all current
+        readers to be done.
 
         Args:
             slice_index (int, optional): Index of the slice whose corresponding mmap must be
                 cleaned. Defaults to None.
             array (str, optional): Name of the array whose corresponding mmap must be cleaned.
                 Defaults to None.
-            cache (flask_caching.Cache, optional): Cache of the database. Defaults to None.
+            cache (flask_caching.Cache, optional): Cache of the database. Not used anymore, as the
+                dataset is locked with its own lock. Defaults to None.
         """
         if self._sample_data:
             logging.warning(
@@ -777,74 +1116,56 @@ class MaldiData:
             )
             return None
 
-        # Wait for memory to be released before taking action
-        if cache is not None:
-            while cache.get("locked-reading") or cache.get("locked-cleaning"):
-                time.sleep(0.05)
-
-            # Lock memory to prevent other processes from accessing it
-            cache.set("locked-cleaning", True)
-
-        # Case no array name has been provided
-        if array is None:
-            l_array_names = [
-                "array_spectra",
-                "array_avg_spectrum",
-                "array_avg_spectrum_after_standardization",
-                "array_lookup_mz",
-                "array_cumulated_lookup_mz_image",
-                "array_corrective_factors",
-            ]
+        # Wait for the current readers to be done, and prevent new ones from reading meanwhile.
+        # The memory maps are simply closed, they will be reopened when accessed again
+        with self._lock.write_lock(), self._memmap_lock:
+            for key in list(self._dic_memmap.keys()):
+                if (slice_index is None or key[0] == slice_index) and (
+                    array is None or key[1] == array
+                ):
+                    del self._dic_memmap[key]
 
-            # Clean all memmaps if no slice index have been given
-            if slice_index is None:
-                for index in self._l_slices:
-                    for array_name in l_array_names:
-                        self._dic_memmap[index][array_name] = np.memmap(
-                            self._path_data + array_name + "_" + str(index) + ".mmap",
-                            dtype="float32" if array_name != "array_lookup_mz" else "int32",
-                            mode="r",
-                            shape=self._dic_lightweight[index][array_name + "_shape"],
-                        )
-
-            # Else clean all memmaps of a given slice index
-            else:
-                for array_name in l_array_names:
-                    self._dic_memmap[slice_index][array_name] = np.memmap(
-                        self._path_data + array_name + "_" + str(slice_index) + ".mmap",
-                        dtype="float32" if array_name != "array_lookup_mz" else "int32",
-                        mode="r",
-                        shape=self._dic_lightweight[slice_index][array_name + "_shape"],
-                    )
-        # Case an array name has been provided
-        else:
-            # Clean all memmaps corresponding to the current array if no slice_index have been given
-            if slice_index is None:
-                for index in self._l_slices:
-                    self._dic_memmap[index][array] = np.memmap(
-                        self._path_data + array + "_" + str(index) + ".mmap",
-                        dtype="float32" if array != "array_lookup_mz" else "int32",
-                        mode="r",
-                        shape=self._dic_lightweight[index][array + "_shape"],
-                    )
+        logging.info("Memory cleaned")
 
-            # Else clean the memap of the given slice index
-            else:
-                self._dic_memmap[slice_index][array] = np.memmap(
-                    self._path_data + array + "_" + str(slice_index) + ".mmap",
-                    dtype="float32" if array != "array_lookup_mz" else "int32",
-                    mode="r",
-                    shape=self._dic_lightweight[slice_index][array + "_shape"],
-                )
+    def release_memory(self, slice_index=None):
+        """Releases the memory used by the memory-mapped arrays, which grows as they are being read.
+        In "madvise" mode, the kernel is advised that the pages of the memory maps are not needed
+        anymore, which removes them from the resident memory of the process without closing the
+        maps (they are transparently read again from the page cache if needed). This is safe while
+        other threads are reading the arrays, and much faster than recreating the memory maps. In
+        "remap" mode, clean_memory() is called. If a budget has been set, the memory of all memory
+        maps is only released when the resident memory of the process is above the budget.
 
-        # Release memory
-        if cache is not None:
-            cache.set("locked-cleaning", False)
+        Args:
+            slice_index (int, optional): Index of the slice whose memory maps must be released. If
+                None, or if a budget has been set, all memory maps are released. Defaults to None.
+        """
+        if self._sample_data:
+            return None
 
-        logging.info("Memory cleaned")
+        if self._rss_budget is not None:
+            if psutil.Process(os.getpid()).memory_info().rss <= self._rss_budget:
+                return None
+            slice_index = None
 
-    def compute_l_labels(self, slice_index = None):
-        """Computes the list of labels of the dataset (for the whole dataset, or a given slice).
+        if self._memory_mode == "remap":
+            self.clean_memory(slice_index=slice_index)
+            return None
+
+        # Only the memory maps currently open need to be released
+        with self._memmap_lock:
+            l_memmaps = [
+                memmap
+                for (index, array_name), memmap in self._dic_memmap.items()
+                if slice_index is None or index == slice_index
+            ]
+        for memmap in l_memmaps:
+            if memmap._mmap is not None:
+                memmap._mmap.madvise(mmap.MADV_DONTNEED)
+
+    def compute_l_labels(self, slice_index=None):
+        """Computes the list of labels of the dataset (for the whole dataset, or a given slice). The
+        lists are only computed once, and must therefore not be modified.
 
         Args:
             slice_index (int, optional): Index of the slice for which the list of labels must be
@@ -853,47 +1174,43 @@ class MaldiData:
         Returns:
             (list): List of labels of the dataset.
         """
-
-        if slice_index is None:
-            l_labels = (
-                self._df_annotations["name"]
-                + "_"
-                + self._df_annotations["structure"]
-                + "_"
-                + self._df_annotations["cation"]
-            ).to_list()
-
-        else:
-            df_slice = self._df_annotations[self._df_annotations["slice"] == slice_index]
-            l_labels = (
-                df_slice["name"] + "_" + df_slice["structure"] + "_" + df_slice["cation"]
-            ).to_list()
+        l_labels = self._dic_labels.get(slice_index)
+        if l_labels is None:
+            if slice_index is None:
+                df = self._df_annotations
+            else:
+                df = self._df_annotations.iloc[
+                    self._dic_annotation_rows_per_slice.get(
+                        slice_index, np.zeros((0,), dtype=np.int64)
+                    )
+                ]
+            l_labels = (df["name"] + "_" + df["structure"] + "_" + df["cation"]).to_list()
+            self._dic_labels[slice_index] = l_labels
         return l_labels
 
     def return_lipid_options(self):
-        """Computes and returns the list of lipid names, structures and cation.
+        """Computes and returns the list of lipid names, structures and cation, sorted by name, then
+        structure, then cation. The list is computed in a single pass over the unique triplets of
+        the annotations, and kept in memory until the annotations are reloaded. It must therefore
+        not be modified.
 
         Returns:
             (list): List of lipid names, structures and cations.
         """
-
-        return [
-            {
-                "label": name + " " + structure + " " + cation,
-                "value": name + " " + structure + " " + cation,
-                "group": name,
-            }
-            for name in sorted(self.get_annotations().name.unique())
-            for structure in sorted(
-                self.get_annotations()[(self.get_annotations()["name"] == name)].structure.unique()
+        if self._l_lipid_options is None:
+            df_lipids = (
+                self._df_annotations[["name", "structure", "cation"]]
+                .drop_duplicates()
+                .sort_values(["name", "structure", "cation"])
             )
-            for cation in sorted(
-                self.get_annotations()[
-                    (self.get_annotations()["name"] == name)
-                    & (self.get_annotations()["structure"] == structure)
-                ].cation.unique()
-            )
-        ]
+            array_labels = (
+                df_lipids["name"] + " " + df_lipids["structure"] + " " + df_lipids["cation"]
+            ).to_numpy()
+            self._l_lipid_options = [
+                {"label": label, "value": label, "group": name}
+                for label, name in zip(array_labels, df_lipids["name"].to_numpy())
+            ]
+        return self._l_lipid_options
 
     def compute_padded_original_images(self):
         """Pads the original images of the dataset so that they are all the same size.
@@ -10,54 +10,685 @@
 # Standard modules
 import logging
 import shelve
+import dbm
 import os
+import io
+import copy
+import glob
+import hashlib
+import inspect
+import pickle
+import sqlite3
+import threading
+import time
+import types
+import numpy as np
 from pympler import asizeof
 
 # LBAE imports
-from modules.tools.misc import logmem
+from modules.tools.misc import logmem, delete_all_files_in_folder, LRUCache
+from modules.tools.compression import (
+    filter_array,
+    unfilter_array,
+    choose_codec,
+    compress,
+    decompress,
+)
+
+# Arguments of the compute functions which don't change their result, and are therefore ignored
+# when building the keys and version stamps of the objects
+L_NON_SEMANTIC_ARGUMENTS = ["cache_flask", "set_progress"]
+
+# Maximum length of a string argument to be kept as is in a key (longer strings are hashed)
+MAX_LENGTH_ARGUMENT_KEY = 50
+
+# ==================================================================================================
+# --- Backends
+# ==================================================================================================
+
+
+class StorageBackend:
+    """Base class of the key-value stores used by Storage. A backend only deals with string keys
+    and bytes values: serialization is handled by the Storage class, such that backends can be
+    swapped without changing the content of the objects stored. Each value can be stored along with
+    a version stamp, identifying the code which produced it.
+
+    Methods:
+        get(key): Returns the bytes stored under key. Raises a KeyError if key is missing.
+        get_version(key): Returns the version stamp stored under key (possibly None). Raises a
+            KeyError if key is missing.
+        put(key, value, version=None): Stores the bytes value under key, along with a version
+            stamp, replacing any previous value.
+        contains(key): Returns True if key is in the store.
+        delete(key): Deletes key from the store.
+        keys(): Returns the list of all keys in the store.
+        clear(): Erases all entries in the store.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def get_version(self, key):
+        raise NotImplementedError
+
+    def put(self, key, value, version=None):
+        raise NotImplementedError
+
+    def contains(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def keys(self):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class SQLiteBackend(StorageBackend):
+    """Key-value store relying on a SQLite database in WAL mode, in which the values are stored as
+    blobs. Each thread of each process keeps its own connection open for the lifetime of the
+    process, such that reads don't pay any open/close cost. In WAL mode, readers never block each
+    other nor the writer, and SQLite guarantees that there is only one writer at a time, even across
+    gunicorn workers.
+
+    Attributes:
+        dic_columns (dict): Maps the name of the metadata columns of the table to their SQL type.
+        path_file (str): Path of the SQLite database file.
+        timeout (float): Time (in seconds) a connection waits for the write lock before failing.
+        _local (threading.local): Thread-local storage holding the connection of each thread.
+        _write_lock (threading.Lock): Lock used to serialize writes across threads of a process.
+
+    Methods:
+        __init__(path_file, timeout=60.0): Initializes the class SQLiteBackend.
+        _get_connection(): Returns the connection of the current thread, opening it if needed.
+        _write(query, parameters=()): Executes a write query in an immediate transaction.
+    """
+
+    dic_columns = {"version": "TEXT"}
+
+    def __init__(self, path_file, timeout=60.0):
+        """Initialize the class SQLiteBackend.
+
+        Args:
+            path_file (str): Path of the SQLite database file.
+            timeout (float, optional): Time (in seconds) a connection waits for the write lock
+                before failing. Defaults to 60.0.
+        """
+        self.path_file = path_file
+        self.timeout = timeout
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+        # Create the table if needed
+        self._write(
+            "CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, value BLOB NOT NULL)"
+        )
+
+        # Add the metadata columns missing from databases created by former versions of the app
+        set_existing_columns = set(
+            [row[1] for row in self._get_connection().execute("PRAGMA table_info(objects)")]
+        )
+        for column, type_column in self.dic_columns.items():
+            if column not in set_existing_columns:
+                self._write("ALTER TABLE objects ADD COLUMN " + column + " " + type_column)
+
+    def _get_connection(self):
+        """This method returns the connection of the current thread. Connections are never shared
+        across forked processes, as SQLite connections can't survive a fork.
+
+        Returns:
+            (sqlite3.Connection): The connection to the database.
+        """
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path_file, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _write(self, query, parameters=()):
+        """This method executes a write query in an immediate transaction, i.e. the write lock of
+        the database is acquired at the beginning of the transaction.
+
+        Args:
+            query (str): The SQL query to execute.
+            parameters (tuple, optional): The parameters of the query. Defaults to ().
+        """
+        connection = self._get_connection()
+        with self._write_lock:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(query, parameters)
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def get(self, key):
+        row = (
+            self._get_connection()
+            .execute("SELECT value FROM objects WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def get_version(self, key):
+        row = (
+            self._get_connection()
+            .execute("SELECT version FROM objects WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def put(self, key, value, version=None):
+        self._write(
+            "INSERT OR REPLACE INTO objects (key, value, version) VALUES (?, ?, ?)",
+            (key, value, version),
+        )
+
+    def contains(self, key):
+        row = (
+            self._get_connection()
+            .execute("SELECT 1 FROM objects WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return row is not None
+
+    def delete(self, key):
+        self._write("DELETE FROM objects WHERE key = ?", (key,))
+
+    def keys(self):
+        return [row[0] for row in self._get_connection().execute("SELECT key FROM objects")]
+
+    def clear(self):
+        self._write("DELETE FROM objects")
+
+
+# ==================================================================================================
+# --- Serialization
+# ==================================================================================================
+
+
+class _ArrayPickler(pickle.Pickler):
+    """Pickler which writes large arrays in .npy sidecar files instead of the pickle stream. The
+    pickle stream only keeps a reference to the sidecar file, such that the array can be loaded back
+    as a memory map. Smaller arrays are kept in the pickle stream, but filtered to compress better.
+
+    Attributes:
+        storage (Storage): Storage object in which the arrays are written.
+        key (str): Key of the object being pickled.
+        dic_written_arrays (dict): Maps the id of the arrays already written to their reference.
+    """
+
+    def __init__(self, file, storage, key):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.storage = storage
+        self.key = key
+        self.dic_written_arrays = {}
+
+    def persistent_id(self, obj):
+        if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+            if obj.nbytes >= self.storage.array_threshold:
+                if id(obj) not in self.dic_written_arrays:
+                    file_name = self.storage._write_array(
+                        self.key, len(self.dic_written_arrays), obj
+                    )
+                    self.dic_written_arrays[id(obj)] = ("npy", file_name)
+                return self.dic_written_arrays[id(obj)]
+            t_filtered = filter_array(obj)
+            if t_filtered is not None:
+                return ("filtered",) + t_filtered
+        return None
+
+
+class _ArrayUnpickler(pickle.Unpickler):
+    """Unpickler which loads the arrays written by _ArrayPickler as read-only memory maps, such that
+    the pages of the array are shared across processes through the OS page cache.
+
+    Attributes:
+        path_arrays (str): Path of the folder containing the sidecar files.
+        nbytes_inline (int): Size in memory of the arrays unfiltered from the pickle stream, which
+            can be much larger than their filtered representation.
+    """
+
+    def __init__(self, file, path_arrays):
+        super().__init__(file)
+        self.path_arrays = path_arrays
+        self.nbytes_inline = 0
+
+    def persistent_load(self, pid):
+        type_pid = pid[0]
+        if type_pid == "npy":
+            return np.load(os.path.join(self.path_arrays, pid[1]), mmap_mode="r")
+        elif type_pid == "filtered":
+            array = unfilter_array(*pid[1:])
+            self.nbytes_inline += array.nbytes
+            return array
+        raise pickle.UnpicklingError("Unsupported persistent object: " + str(type_pid))
+
+
+# ==================================================================================================
+# --- Keys and version stamps
+# ==================================================================================================
+
+
+def _canonicalize_argument(value):
+    """This function returns a deterministic string representation of an argument of a compute
+    function, which doesn't depend on the memory address of the objects, nor on the choice of
+    tuples vs lists or on the ordering of dictionnaries and sets.
+
+    Args:
+        value (object): The argument to canonicalize.
+
+    Returns:
+        (str): The canonical representation of the argument.
+    """
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join([_canonicalize_argument(x) for x in value]) + "]"
+    elif isinstance(value, (set, frozenset)):
+        return "{" + ",".join(sorted([_canonicalize_argument(x) for x in value])) + "}"
+    elif isinstance(value, dict):
+        return (
+            "{"
+            + ",".join(
+                sorted(
+                    [
+                        _canonicalize_argument(k) + ":" + _canonicalize_argument(v)
+                        for k, v in value.items()
+                    ]
+                )
+            )
+            + "}"
+        )
+    elif isinstance(value, np.ndarray):
+        return (
+            "ndarray("
+            + str(value.dtype)
+            + ","
+            + str(value.shape)
+            + ","
+            + hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()
+            + ")"
+        )
+    elif isinstance(value, (np.generic,)):
+        return _canonicalize_argument(value.item())
+    else:
+        return type(value).__name__ + ":" + repr(value)
+
+
+def _format_argument(value):
+    """This function formats an argument of a compute function such that it can be appended to
+    the name of the corresponding object. Simple values (e.g. booleans, numbers, short strings) are
+    kept human-readable, while other values are replaced by a hash of their canonical
+    representation.
+
+    Args:
+        value (object): The argument to format.
+
+    Returns:
+        (str): The formatted argument.
+    """
+    if value is None or isinstance(value, (bool, int, float, np.integer, np.floating)):
+        return str(value)
+    elif isinstance(value, str) and len(value) <= MAX_LENGTH_ARGUMENT_KEY and "/" not in value:
+        return value
+    else:
+        return "#" + hashlib.sha1(_canonicalize_argument(value).encode()).hexdigest()[:16]
+
+
+def _repr_constant(const):
+    """This function returns a representation of a constant of a code object which doesn't depend
+    on the process. The members of frozensets (e.g. compiled from set literals such as
+    x in {"a", "b"}) are sorted, as their order depends on the (randomized) hashing of strings.
+
+    Args:
+        const (object): The constant to represent.
+
+    Returns:
+        (str): The representation of the constant.
+    """
+    if isinstance(const, frozenset):
+        return "frozenset({" + ", ".join(sorted([_repr_constant(x) for x in const])) + "})"
+    elif isinstance(const, tuple):
+        # Same as repr() for tuples without frozensets, such that version stamps are unchanged
+        repr_tuple = ", ".join([_repr_constant(x) for x in const])
+        return "(" + repr_tuple + ("," if len(const) == 1 else "") + ")"
+    return repr(const)
+
+
+def _hash_code(code, hasher):
+    """This function feeds a hasher with the bytecode of a code object, including the code of
+    nested functions and comprehensions.
+
+    Args:
+        code (types.CodeType): The code object to hash.
+        hasher (hashlib._Hash): The hasher to update.
+    """
+    hasher.update(code.co_code)
+    hasher.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(const, hasher)
+        else:
+            hasher.update(_repr_constant(const).encode())
+
+
+def _compute_function_version(compute_function):
+    """This function computes a version stamp for a compute function, which changes whenever the
+    code of the function (or its default arguments) is modified. Note that the code of the functions
+    called by compute_function is not taken into account.
+
+    Args:
+        compute_function (func): The function/method whose version must be computed.
+
+    Returns:
+        (str): The version stamp.
+    """
+    # Get the underlying Python function of methods, decorated and numba functions
+    function = getattr(compute_function, "__func__", compute_function)
+    function = inspect.unwrap(getattr(function, "py_func", function))
+
+    hasher = hashlib.sha1(getattr(function, "__qualname__", repr(function)).encode())
+    if hasattr(function, "__code__"):
+        _hash_code(function.__code__, hasher)
+        hasher.update(repr(function.__defaults__).encode())
+        hasher.update(repr(function.__kwdefaults__).encode())
+    return hasher.hexdigest()[:16]
+
+
+def _get_key_prefix(key):
+    """This function returns the prefix of a key, i.e. the key stripped from the arguments appended
+    to the name of the object (e.g. 'atlas/atlas_objects/mask_and_spectrum_12_1006' becomes
+    'atlas/atlas_objects/mask_and_spectrum').
+
+    Args:
+        key (str): The key of an object.
+
+    Returns:
+        (str): The prefix of the key.
+    """
+    data_folder, _, file_name = key.rpartition("/")
+    l_tokens = []
+    for token in file_name.split("_"):
+        if token.isdigit() or token in ["True", "False", "None"] or token.startswith("#"):
+            break
+        l_tokens.append(token)
+    return data_folder + "/" + "_".join(l_tokens)
+
+
+def _copy_cached_object(object):
+    """This function returns a copy of an object from the cache of Storage, such that callers can
+    modify the object they get without altering the cached version. Read-only arrays (e.g. memory
+    maps) are not copied, as they can't be modified anyway.
+
+    Args:
+        object (object): The cached object.
+
+    Returns:
+        (object): A copy of the object.
+    """
+    if isinstance(object, np.ndarray):
+        if object.flags.writeable:
+            return object.copy()
+        return object
+    elif isinstance(object, tuple):
+        return tuple(_copy_cached_object(x) for x in object)
+    elif isinstance(object, list):
+        return [_copy_cached_object(x) for x in object]
+    elif type(object) is dict:
+        return {key: _copy_cached_object(value) for key, value in object.items()}
+    elif isinstance(object, (str, bytes, int, float, bool, type(None))):
+        return object
+    else:
+        return copy.deepcopy(object)
+
 
 # ==================================================================================================
 # --- Class
 # ==================================================================================================
 class Storage:
     """A class used to handle the loading/dumping of the data used in the app (memmaps excluded),
-    e.g. figures or masks, are defined. The storage relies on a shelve database.
+    e.g. figures or masks, are defined. The objects are pickled and stored in a key-value backend,
+    which is by default a SQLite database in WAL mode, kept open for the whole lifetime of the
+    process. Large arrays (possibly nested in tuples, lists, etc.) are not pickled, but written as
+    .npy files next to the database, and loaded back as read-only memory maps. Other objects are
+    compressed with zlib, at a level depending on their type (see modules.tools.compression).
+    Loaded objects are kept in an in-process LRU cache, bounded by their size in memory (memory-
+    mapped arrays excluded, as their pages belong to the OS page cache). Note that the cache is not
+    invalidated by writes happening in other processes.
 
     Attributes:
-        path_db (str): Path of the shelve database.
+        path_db (str): Path of the database folder.
+        backend (StorageBackend): Key-value store in which the serialized objects are saved.
+        path_arrays (str): Path of the folder in which large arrays are written.
+        array_threshold (int): Size (in bytes) above which an array is written in its own file.
+        cache (LRUCache): In-process cache of the objects loaded from the database.
 
     Methods:
-        __init__(path_db="data/whole_dataset/"): Initializes the class Storage.
-        dump_shelved_object(data_folder, file_name, object): Dumps an object in a shelve database.
-        load_shelved_object(data_folder, file_name): Loads an object from a shelve database.
-        check_shelved_object(data_folder, file_name): Checks if an object is in a shelve database.
+        __init__(path_db="data/whole_dataset/", backend=None, array_threshold=2**23,
+            cache_size=2**28, l_pinned_prefixes=()): Initializes the class Storage.
+        _write_array(key, index, array): Writes an array of the object key in a .npy file.
+        _serialize(object, key): Converts an object into bytes.
+        _deserialize(value, return_size=False): Converts bytes back into the original object.
+        _load(key): Loads an object from the cache or the database.
+        _dump(key, object, version=None): Dumps an object in the database and invalidates the
+            cache.
+        get_cache_stats(): Returns the counters of the cache.
+        import_legacy_shelve(): Copies the entries of a former shelve database into the backend.
+        list_keys(): Returns the list of all the keys in the database.
+        dump_shelved_object(data_folder, file_name, object): Dumps an object in the database.
+        load_shelved_object(data_folder, file_name): Loads an object from the database.
+        check_shelved_object(data_folder, file_name): Checks if an object is in the database.
         return_shelved_object(data_folder, file_name, force_update, compute_function,
-        ignore_arguments_naming=False, **compute_function_args): Returns an object from a shelve
+        ignore_arguments_naming=False, **compute_function_args): Returns an object from the
             database. If the object is not in the database, it is computed and dumped in the
             database.
-        empty_shelve(): Erases all entries in the shelve database.
-        list_shelve_objects_size(): Lists the size of all objects in the shelve database.
+        empty_shelve(): Erases all entries in the database.
+        list_shelve_objects_size(report_compression=True): Lists the size of all objects in the
+            database, and reports compression statistics per prefix.
     """
 
     # ==============================================================================================
     # --- Constructor
     # ==============================================================================================
 
-    def __init__(self, path_db="data/whole_dataset/"):
+    def __init__(
+        self,
+        path_db="data/whole_dataset/",
+        backend=None,
+        array_threshold=2**23,
+        cache_size=2**28,
+        l_pinned_prefixes=(),
+    ):
         """Initialize the class Storage.
 
         Args:
-            path_db (str): Path of the shelve database.
+            path_db (str): Path of the database folder.
+            backend (StorageBackend, optional): Key-value store in which the objects are saved. If
+                None, a SQLite database is created in path_db. Defaults to None.
+            array_threshold (int, optional): Size (in bytes) above which an array is written in its
+                own .npy file and loaded back as a memory map. Defaults to 2**23 (8MB).
+            cache_size (int, optional): Capacity (in bytes) of the in-process cache. Defaults to
+                2**28 (256MB).
+            l_pinned_prefixes (tuple, optional): Prefixes of the keys which must never be evicted
+                from the cache. Defaults to ().
         """
 
         # Create database folder if not existing
         self.path_db = path_db
         if not os.path.exists(self.path_db):
             os.makedirs(self.path_db)
+
+        # Define backend (path_db may be a legacy shelve file rather than a folder)
+        if backend is None:
+            if os.path.isdir(self.path_db):
+                backend = SQLiteBackend(os.path.join(self.path_db, "storage.sqlite"))
+            else:
+                backend = SQLiteBackend(self.path_db + ".sqlite")
+        self.backend = backend
+
+        # Define folder for large arrays
+        if os.path.isdir(self.path_db):
+            self.path_arrays = os.path.join(self.path_db, "arrays")
+        else:
+            self.path_arrays = self.path_db + "_arrays"
+        if not os.path.exists(self.path_arrays):
+            os.makedirs(self.path_arrays)
+        self.array_threshold = array_threshold
+
+        # Define in-process cache
+        self.cache = LRUCache(cache_size, l_pinned_prefixes=l_pinned_prefixes)
+
+        # Recover the objects computed with a former shelve database, if any
+        if len(self.backend.keys()) == 0:
+            self.import_legacy_shelve()
         # self.list_shelve_objects_size()
 
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def _write_array(self, key, index, array):
+        """This method writes an array belonging to the object key in a .npy file. The file is
+        first written under a temporary name and then renamed, such that processes which have
+        already memory-mapped a previous version of the file are not affected.
+
+        Args:
+            key (str): Key of the object the array belongs to.
+            index (int): Index of the array in the object.
+            array (np.ndarray): The array to write.
+
+        Returns:
+            (str): The name of the .npy file, relative to self.path_arrays.
+        """
+        file_name = hashlib.sha1(key.encode()).hexdigest()[:20] + "_" + str(index) + ".npy"
+        path_file = os.path.join(self.path_arrays, file_name)
+        path_temp = path_file + "." + str(os.getpid()) + ".tmp"
+        with open(path_temp, "wb") as f:
+            np.save(f, array, allow_pickle=False)
+        os.replace(path_temp, path_file)
+        return file_name
+
+    def _serialize(self, object, key):
+        """This method converts an object into bytes before it is written in the backend. Large
+        arrays are written in separate .npy files, and only referenced in the returned bytes. The
+        bytes are compressed with a codec chosen according to the type of the object.
+
+        Args:
+            object (object): The object to serialize.
+            key (str): The key under which the object is saved.
+
+        Returns:
+            (bytes): The serialized object.
+        """
+        file = io.BytesIO()
+        pickler = _ArrayPickler(file, self, key)
+        pickler.dump(object)
+
+        # Remove the arrays previously written for this key and which are not used anymore
+        set_files = set([file_name for _, file_name in pickler.dic_written_arrays.values()])
+        for path_file in glob.glob(
+            os.path.join(self.path_arrays, hashlib.sha1(key.encode()).hexdigest()[:20] + "_*.npy")
+        ):
+            if os.path.basename(path_file) not in set_files:
+                os.remove(path_file)
+
+        codec, level = choose_codec(object)
+        return compress(file.getvalue(), codec=codec, level=level)
+
+    def _deserialize(self, value, return_size=False):
+        """This method converts bytes read from the backend back into the original object. Arrays
+        stored in separate files are returned as read-only memory maps.
+
+        Args:
+            value (bytes): The serialized object.
+            return_size (bool, optional): If True, the approximate size in memory of the object is
+                also returned, i.e. the size of the decompressed pickle stream plus the size of the
+                arrays unfiltered from it. Memory-mapped arrays are not counted, as their pages
+                belong to the OS page cache. Defaults to False.
+
+        Returns:
+            (object): The deserialized object, and its size in memory if return_size is True.
+        """
+        decompressed = decompress(value)
+        unpickler = _ArrayUnpickler(io.BytesIO(decompressed), self.path_arrays)
+        object = unpickler.load()
+        if return_size:
+            return object, len(decompressed) + unpickler.nbytes_inline
+        return object
+
+    def _load(self, key):
+        """This method loads an object from the cache if possible, or from the database otherwise.
+        The object returned is always a copy of the cached object.
+
+        Args:
+            key (str): The key of the object.
+
+        Returns:
+            (object): The loaded object. Raises a KeyError if the key is not in the database.
+        """
+        object = self.cache.get(key, default=self.cache)
+        if object is self.cache:
+            value = self.backend.get(key)
+            object, size = self._deserialize(value, return_size=True)
+            self.cache.set(key, object, size)
+        return _copy_cached_object(object)
+
+    def _dump(self, key, object, version=None):
+        """This method dumps an object in the database, and removes the previous version of the
+        object from the cache.
+
+        Args:
+            key (str): The key of the object.
+            object (object): The object to save.
+            version (str, optional): Version stamp of the code which computed the object. Defaults
+                to None.
+        """
+        self.backend.put(key, self._serialize(object, key), version=version)
+        self.cache.invalidate(key)
+
+    def get_cache_stats(self):
+        """This method returns the counters of the in-process cache, for monitoring purposes.
+
+        Returns:
+            (dict): A dictionnary containing the number of entries, the size in bytes (evictable
+                and pinned), the capacity, and the number of hits, misses and evictions.
+        """
+        return self.cache.get_stats()
+
+    def import_legacy_shelve(self):
+        """This method copies all the entries of a shelve database located at self.path_db (the
+        format used by former versions of the app) into the backend, such that precomputed objects
+        don't need to be computed again.
+        """
+        # Check that a shelve database actually exists
+        if not dbm.whichdb(self.path_db):
+            return
+
+        logging.info("Importing entries from legacy shelve database " + self.path_db + logmem())
+        with shelve.open(self.path_db, flag="r") as db:
+            for key in db:
+                self.backend.put(key, self._serialize(db[key], key))
+        logging.info("Legacy shelve database imported" + logmem())
+
+    def list_keys(self):
+        """This method returns the keys of all the objects in the database.
+
+        Returns:
+            (list): List of the keys (i.e. data_folder + "/" + file_name) of all objects.
+        """
+        return self.backend.keys()
+
     def dump_shelved_object(self, data_folder, file_name, object):
-        """This method dumps an object in a shelve database.
+        """This method dumps an object in the database.
 
         Args:
             data_folder (str): The path of the folder in which the object must be
@@ -70,11 +701,10 @@ class Storage:
         complete_file_name = data_folder + "/" + file_name
 
         # Dump in db
-        with shelve.open(self.path_db) as db:
-            db[complete_file_name] = object
+        self._dump(complete_file_name, object)
 
     def load_shelved_object(self, data_folder, file_name):
-        """This method loads an object from a shelve database.
+        """This method loads an object from the database.
 
         Args:
             data_folder (str): The path of the folder in which the object must be
@@ -86,11 +716,10 @@ class Storage:
         complete_file_name = data_folder + "/" + file_name
 
         # Load from in db
-        with shelve.open(self.path_db) as db:
-            return db[complete_file_name]
+        return self._load(complete_file_name)
 
     def check_shelved_object(self, data_folder, file_name):
-        """This method checks if an object is in a shelve database.
+        """This method checks if an object is in the database.
 
         Args:
             data_folder (str): The path of the folder in which the object must be
@@ -102,11 +731,7 @@ class Storage:
         complete_file_name = data_folder + "/" + file_name
 
         # Load from in db
-        with shelve.open(self.path_db) as db:
-            if complete_file_name in db:
-                return True
-            else:
-                return False
+        return self.backend.contains(complete_file_name)
 
     def return_shelved_object(
         self,
@@ -118,8 +743,13 @@ class Storage:
         **compute_function_args
     ):
         """This method checks if the result of the method or function compute_function has not been
-        computed and saved already. If yes, it returns this result from the corresponding shelve.
-        Else, it executes compute_function, saves the result in a shelve file, and returns the result.
+        computed and saved already. If yes, it returns this result from the database. Else, it
+        executes compute_function, saves the result in the database, and returns the result.
+        The result is saved along with a version stamp of compute_function, such that it is
+        automatically recomputed if the code of compute_function changes. Arguments which don't
+        change the result (e.g. cache_flask or set_progress) are not used to build the name of the
+        result, and arguments which can't be represented in a short and stable way (e.g. lists of
+        boundaries) are hashed.
 
         Args:
             data_folder (str): The path of the folder in which the result of compute_function must be
@@ -136,8 +766,6 @@ class Storage:
         Returns:
             The result of compute_function. Type may vary depending on compute_function.
         """
-        # Define database path
-        db_path = self.path_db
 
         # Get complete file name
         complete_file_name = data_folder + "/" + file_name
@@ -145,59 +773,96 @@ class Storage:
         # Complete filename with function arguments
         if not ignore_arguments_naming:
             for key, value in compute_function_args.items():
-                complete_file_name += "_" + str(value)
-
-        # Load the shelve
-        db = shelve.open(db_path)
-        # Check if the object is in the folder already and return it
-        if complete_file_name in db and not force_update:
-            logging.info("Returning " + complete_file_name + " from shelve file." + logmem())
-            object = db[complete_file_name]
-        else:
-            logging.info(
-                complete_file_name
-                + " could not be found or force_update is True. "
-                + "Computing the object and shelving it now."
-            )
-
-            # Close shelve to prevent nesting issues with compute function
-            db.close()
-
-            # Execute compute_function
-            object = compute_function(**compute_function_args)
-
-            # Reopen shelve
-            db = shelve.open(db_path)
-
-            # Save the result in a pickle file
-            db[complete_file_name] = object
-            logging.info(complete_file_name + " being returned now from computation.")
+                if key not in L_NON_SEMANTIC_ARGUMENTS:
+                    complete_file_name += "_" + _format_argument(value)
+
+        # Get the version of the code computing the object
+        version = _compute_function_version(compute_function)
+
+        # Check if the object is in the database already and return it (objects without version
+        # stamp come from older versions of the app and are considered valid)
+        if not force_update:
+            try:
+                stored_version = self.backend.get_version(complete_file_name)
+                if stored_version is None or stored_version == version:
+                    object = self._load(complete_file_name)
+                    logging.info("Returning " + complete_file_name + " from database." + logmem())
+                    return object
+                logging.info(
+                    complete_file_name + " was computed with an outdated version of the code."
+                )
+            except KeyError:
+                pass
+
+        logging.info(
+            complete_file_name
+            + " could not be found or force_update is True. "
+            + "Computing the object and saving it now."
+        )
+
+        # Execute compute_function (the connection to the database can be safely reused by
+        # compute_function if it needs to access the database as well)
+        object = compute_function(**compute_function_args)
+
+        # Save the result in the database
+        self._dump(complete_file_name, object, version=version)
+        logging.info(complete_file_name + " being returned now from computation.")
 
-        # Close shelve for good this time
-        db.close()
         return object
 
     def empty_shelve(self):
-        """This method erases all entries in the shelve database."""
-        # Load from in db
-        with shelve.open(self.path_db) as db:
-
-            # Completely empty database
-            for key in db:
-                del db[key]
+        """This method erases all entries in the database."""
+        self.backend.clear()
+        self.cache.clear()
+        delete_all_files_in_folder(self.path_arrays)
 
-    def list_shelve_objects_size(self):
-        """This method list the size of all objects in the shelve database."""
+    def list_shelve_objects_size(self, report_compression=True):
+        """This method list the size of all objects in the database. It can also report, for each
+        prefix of keys (e.g. 'atlas/atlas_objects/mask_and_spectrum'), the raw size of the objects
+        (i.e. pickled without compression), the size actually stored, and the decoding throughput.
 
-        # Load from in db
-        with shelve.open(self.path_db) as db:
+        Args:
+            report_compression (bool, optional): If True, compression statistics are reported for
+                each prefix. Defaults to True.
+        """
 
-            tot_size = 0
-            # List size
-            for key in db:
-                try:
-                    size_obj = asizeof.asizeof(db[key]) / 1024 / 1024
-                    tot_size += size_obj
-                    logging.info(key + ":\t" + str(size_obj) + ", tot_size:\t" + str(tot_size))
-                except:
-                    pass
+        tot_size = 0
+        dic_stats_per_prefix = {}
+        # List size
+        for key in self.backend.keys():
+            try:
+                value = self.backend.get(key)
+                t0 = time.perf_counter()
+                object = self._deserialize(value)
+                time_decode = time.perf_counter() - t0
+                size_obj = asizeof.asizeof(object) / 1024 / 1024
+                tot_size += size_obj
+                logging.info(key + ":\t" + str(size_obj) + ", tot_size:\t" + str(tot_size))
+                if report_compression:
+                    prefix = _get_key_prefix(key)
+                    l_stats = dic_stats_per_prefix.setdefault(prefix, [0, 0, 0, 0.0])
+                    l_stats[0] += 1
+                    l_stats[1] += len(pickle.dumps(object, protocol=pickle.HIGHEST_PROTOCOL))
+                    l_stats[2] += len(value)
+                    l_stats[3] += time_decode
+            except:
+                pass
+
+        # Report compression statistics
+        for prefix, (n_entries, raw_size, stored_size, time_decode) in sorted(
+            dic_stats_per_prefix.items()
+        ):
+            logging.info(
+                prefix
+                + " ("
+                + str(n_entries)
+                + " entries): raw size "
+                + "{:.2f}".format(raw_size / 1024 / 1024)
+                + "MB, compressed size "
+                + "{:.2f}".format(stored_size / 1024 / 1024)
+                + "MB (ratio "
+                + "{:.2f}".format(raw_size / max(stored_size, 1))
+                + "), decode throughput "
+                + "{:.1f}".format(raw_size / 1024 / 1024 / max(time_decode, 1e-9))
+                + "MB/s"
+            )
@@ -20,40 +20,68 @@ from numba import njit
 
 
 @njit
-def project_image(slice_index, original_image, array_projection_correspondence):
+def compute_projection_flat_indices(
+    array_projection_correspondence_sliced, original_shape, border_width=50
+):
+    """This function converts the projection correspondence of a given slice into an array of flat
+    indices, which associates, to each pixel of the warped higher-resolution image, the index of the
+    corresponding pixel in the flattened original acquisition. The projection of an image then boils
+    down to a single gather (see project_image()).
+
+    Args:
+        array_projection_correspondence_sliced (np.ndarray): A three-dimensional array which
+            associates, to each couple of coordinates of the warped higher-resolution image
+            (row_index, column_index), a tuple of coordinates corresponding to the row_index and
+            column_index of the original acquisition.
+        original_shape (np.ndarray): The shape of the original acquisition.
+        border_width (int, optional): Width (in pixels) of the borders of the warped image which are
+            left unassigned, as they never contain any data. Defaults to 50.
+
+    Returns:
+        (np.ndarray): A two-dimensional array of flat indices, with -1 corresponding to unassigned
+            pixels.
+    """
+    array_flat_indices = np.full(array_projection_correspondence_sliced.shape[:-1], -1, np.int32)
+    for i in range(border_width, array_flat_indices.shape[0] - border_width):
+        for j in range(border_width, array_flat_indices.shape[1] - border_width):
+            x, y = array_projection_correspondence_sliced[i, j]
+            # Coordinate -1 corresponds to unassigned
+            if x != -1 and x < original_shape[0] and y < original_shape[1]:
+                array_flat_indices[i, j] = x * original_shape[1] + y
+    return array_flat_indices
+
+
+def project_image(slice_index, original_image, array_projection_flat_indices):
     """This function is used to project the original maldi acquisition (low-resolution, possibly
     tilted, and) into a warped and higher resolution, indexed with the Allen Mouse Brain Common
-    Coordinate Framework (ccfv3).
+    Coordinate Framework (ccfv3). Stacks of images (e.g. the channels of an RGB image, or the images
+    of several lipids) are projected at once, in a single gather.
 
     Args:
         slice_index (int): Index of the slice to project.
-        original_image (np.ndarray): A two-dimensional array representing the MADI data of the
-            current slice (e.g. for a given lipid selection).
-        array_projection_correspondence (np.ndarray): A three-dimensional array which associates, to
-            each triplet of coordinates of the original acquisition (slice_index, row_index,
-            column_index), a tuple of coordinates corresponding to the row_index and column_index of
-            the warped higher-resolution image.
+        original_image (np.ndarray): An array representing the MADI data of the current slice (e.g.
+            for a given lipid selection), of shape (height, width), or (height, width, n_images) for
+            a stack of images.
+        array_projection_flat_indices (np.ndarray): A three-dimensional array which associates, to
+            each triplet of coordinates of the warped higher-resolution images (slice_index,
+            row_index, column_index), the flat index of the corresponding pixel in the original
+            acquisition (see compute_projection_flat_indices()).
 
     Returns:
-        (np.ndarray): A warped, high-resolution image, corresponding to the clean, registered version,
-            of our acquisition.
+        (np.ndarray): A warped, high-resolution image (or stack of images, with the same layout as
+            original_image), corresponding to the clean, registered version, of our acquisition.
     """
     # Correct index as slice names start at 1
-    slice_index -= 1
-
-    # Define empty array for the high-resolution image
-    new_image = np.zeros(array_projection_correspondence.shape[1:-1], dtype=original_image.dtype)
+    array_flat_indices = array_projection_flat_indices[slice_index - 1]
 
-    # Exclude the borders of the image to gain some time
-    for i in range(50, array_projection_correspondence[slice_index].shape[0] - 50):
-        for j in range(50, array_projection_correspondence[slice_index].shape[1] - 50):
-            # Maps the original coordinates to the new one, with coordinate -1 corresponding
-            # to unassigned
-            if array_projection_correspondence[slice_index, i, j, 0] != -1:
-                x, y = array_projection_correspondence[slice_index, i, j]
-                new_image[i, j] = original_image[x, y]
+    # Flatten the images and append a zero pixel, which is gathered by the unassigned pixels (-1).
+    # Pixels are kept along the first axis such that the values of a stack are gathered together.
+    array_flat_images = original_image.reshape((-1,) + original_image.shape[2:])
+    array_flat_images = np.concatenate(
+        (array_flat_images, np.zeros((1,) + original_image.shape[2:], original_image.dtype))
+    )
 
-    return new_image
+    return np.take(array_flat_images, array_flat_indices, axis=0)
 
 
 @njit
@@ -94,6 +122,133 @@ def project_atlas_mask(stack_mask, slice_coordinates_rescaled, shape_atlas):
     return projected_mask
 
 
+@njit
+def project_atlas_annotation(array_annotation, slice_coordinates_rescaled):
+    """This function projects the annotation of the atlas (i.e. the id of the finest structure for
+    each voxel) on our two-dimensional, high-resolution warped data, for a given slice. As opposed
+    to project_atlas_mask(), the projection is done only once for all structures.
+
+    Args:
+        array_annotation (np.ndarray): A three-dimensional array indexed with the ccfv3, containing
+            the id of the finest structure for each voxel.
+        slice_coordinates_rescaled (np.ndarray): A two-dimensional array mapping our slice
+            coordinate (rescaled and discretized) to the ccfv3.
+
+    Returns:
+        (np.ndarray): A two-dimensional array containing the projected structure ids.
+    """
+    # Pixels outside of the atlas are set as the first voxel, as in project_atlas_mask()
+    projected_annotation = np.full(
+        slice_coordinates_rescaled.shape[:-1],
+        array_annotation[0, 0, 0],
+        dtype=array_annotation.dtype,
+    )
+    shape_atlas = array_annotation.shape
+    for x in range(slice_coordinates_rescaled.shape[0]):
+        for y in range(slice_coordinates_rescaled.shape[1]):
+            current_coor_rescaled = slice_coordinates_rescaled[x, y]
+            if (
+                min(current_coor_rescaled) >= 0
+                and current_coor_rescaled[0] < shape_atlas[0]
+                and current_coor_rescaled[1] < shape_atlas[1]
+                and current_coor_rescaled[2] < shape_atlas[2]
+            ):
+                projected_annotation[x, y] = array_annotation[
+                    current_coor_rescaled[0], current_coor_rescaled[1], current_coor_rescaled[2]
+                ]
+    return projected_annotation
+
+
+@njit
+def _sweep_mask_runs_per_structure(
+    projected_labels, array_ancestors, array_last_run, array_runs, array_offsets, fill
+):
+    """This function sweeps the runs of identical labels of a projected annotation, and assigns them
+    to every structure containing the label. Adjacent runs belonging to the same structure are
+    merged. If fill is False, the runs are only counted (per structure) in array_offsets.
+    Otherwise, they are written in array_runs, at the position given by array_offsets.
+
+    Args:
+        projected_labels (np.ndarray): A two-dimensional array of labels (indexes of
+            array_ancestors).
+        array_ancestors (np.ndarray): A two-dimensional array containing, for each label, the
+            indexes of all the structures containing it, padded with -1.
+        array_last_run (np.ndarray): A buffer array of shape (n_structures,), containing the index
+            of the last run of each structure. Must be initialized to -1.
+        array_runs (np.ndarray): The array of runs to fill (only used if fill is True).
+        array_offsets (np.ndarray): The number of runs per structure if fill is False, the current
+            index of the next run of each structure in array_runs otherwise.
+        fill (bool): Whether to count or fill the runs.
+    """
+    # Row and last column (excluded) of the last run of each structure
+    array_last_row = np.full(array_last_run.shape[0], -1, dtype=np.int32)
+    array_last_end = np.full(array_last_run.shape[0], -1, dtype=np.int32)
+    for x in range(projected_labels.shape[0]):
+        start = 0
+        for y in range(1, projected_labels.shape[1] + 1):
+            if y < projected_labels.shape[1]:
+                if projected_labels[x, y] == projected_labels[x, start]:
+                    continue
+
+            # A run of identical labels [start, y) has been found
+            for idx_structure in array_ancestors[projected_labels[x, start]]:
+                if idx_structure < 0:
+                    break
+                if array_last_row[idx_structure] == x and array_last_end[idx_structure] == start:
+                    # The run is adjacent to the previous one of the structure, extend the latter
+                    if fill:
+                        array_runs[array_last_run[idx_structure], 2] = y
+                elif fill:
+                    idx_run = array_offsets[idx_structure]
+                    array_runs[idx_run, 0] = x
+                    array_runs[idx_run, 1] = start
+                    array_runs[idx_run, 2] = y
+                    array_last_run[idx_structure] = idx_run
+                    array_offsets[idx_structure] += 1
+                else:
+                    array_offsets[idx_structure] += 1
+                array_last_row[idx_structure] = x
+                array_last_end[idx_structure] = y
+            start = y
+
+
+@njit
+def compute_mask_runs_per_structure(projected_labels, array_ancestors, n_structures):
+    """This function computes, in a single sweep over a projected annotation, the masks (encoded
+    as runs, see compute_mask_runs()) of all the structures given in array_ancestors. The runs of
+    all structures are stored contiguously, in a CSR-like fashion.
+
+    Args:
+        projected_labels (np.ndarray): A two-dimensional array of labels (indexes of
+            array_ancestors).
+        array_ancestors (np.ndarray): A two-dimensional array containing, for each label, the
+            indexes of all the structures containing it, padded with -1.
+        n_structures (int): The number of structures.
+
+    Returns:
+        (np.ndarray, np.ndarray): The first array has shape (n_runs, 3) and contains the runs of all
+            the structures. The second has shape (n_structures + 1,), and the runs of the i-th
+            structure are array_runs[array_offsets[i] : array_offsets[i + 1]].
+    """
+    # First count the runs per structure, to allocate the array only once
+    array_last_run = np.full(n_structures, -1, dtype=np.int64)
+    array_count = np.zeros(n_structures, dtype=np.int64)
+    array_runs = np.empty((0, 3), dtype=np.int32)
+    _sweep_mask_runs_per_structure(
+        projected_labels, array_ancestors, array_last_run, array_runs, array_count, False
+    )
+    array_offsets = np.zeros(n_structures + 1, dtype=np.int64)
+    array_offsets[1:] = np.cumsum(array_count)
+
+    # Then fill the runs
+    array_runs = np.empty((array_offsets[-1], 3), dtype=np.int32)
+    array_position = array_offsets[:-1].copy()
+    _sweep_mask_runs_per_structure(
+        projected_labels, array_ancestors, array_last_run, array_runs, array_position, True
+    )
+    return array_runs, array_offsets
+
+
 @njit
 def get_array_rows_from_atlas_mask(mask, mask_remapped, array_projection_correspondence_sliced):
     """This function is similar to spectra.sample_rows_from_path(), in that it returns the lower and
@@ -129,7 +284,25 @@ def get_array_rows_from_atlas_mask(mask, mask_remapped, array_projection_corresp
             ):
                 mask_remapped[x_original, y_original] = mask[x, y]
 
-    # Then compute the column boundaries for each row
+    return _compute_row_boundaries(mask_remapped)
+
+
+@njit
+def _compute_row_boundaries(mask_remapped):
+    """This function computes the lower and upper indexes of the rows belonging to a mask expressed
+    in the coordinates of the original acquisition, as well as the corresponding column boundaries
+    for each row.
+
+    Args:
+        mask_remapped (np.ndarray): A two-dimensional array of the shape of the original
+            acquisition, whose non-zero values represent the mask.
+
+    Returns:
+        (np.ndarray, np.ndarray): The first array contains the lower and upper indexes of the rows
+            belonging to the mask. The second array contains, for each row, the corresponding column
+            boundaries of the mask (there can be more than 2 for non-convex shapes).
+    """
+    # Compute the column boundaries for each row
     ll_rows = []
     for x in range(mask_remapped.shape[0]):
         first = False
@@ -171,6 +344,170 @@ def get_array_rows_from_atlas_mask(mask, mask_remapped, array_projection_corresp
     return np.array([xmin, xmax], dtype=np.int32), array_index_bound_column_per_row
 
 
+@njit
+def compute_mask_runs(mask):
+    """This function encodes a two-dimensional mask as a list of runs, i.e. horizontal segments of
+    consecutive non-zero pixels. This representation is much more compact than the dense mask, as
+    brain structures usually only cover a small part of a slice.
+
+    Args:
+        mask (np.ndarray): A two-dimensional array whose non-zero values represent the mask.
+
+    Returns:
+        (np.ndarray): A two-dimensional array of shape (n_runs, 3), each row containing the row
+            index, the first column index, and the last column index (excluded) of a run.
+    """
+    # First count the runs, to allocate the array only once
+    n_runs = 0
+    for x in range(mask.shape[0]):
+        in_run = False
+        for y in range(mask.shape[1]):
+            if mask[x, y] != 0 and not in_run:
+                n_runs += 1
+                in_run = True
+            elif mask[x, y] == 0:
+                in_run = False
+
+    # Then fill the runs
+    array_runs = np.empty((n_runs, 3), dtype=np.int32)
+    idx_run = -1
+    for x in range(mask.shape[0]):
+        in_run = False
+        for y in range(mask.shape[1]):
+            if mask[x, y] != 0 and not in_run:
+                idx_run += 1
+                array_runs[idx_run, 0] = x
+                array_runs[idx_run, 1] = y
+                in_run = True
+            elif mask[x, y] == 0 and in_run:
+                array_runs[idx_run, 2] = y
+                in_run = False
+        if in_run:
+            array_runs[idx_run, 2] = mask.shape[1]
+
+    return array_runs
+
+
+@njit
+def convert_mask_runs_to_mask(array_runs, shape, value=1):
+    """This function is the inverse of compute_mask_runs(), i.e. it builds the dense mask from a
+    list of runs. It should only be used when a dense representation is actually needed.
+
+    Args:
+        array_runs (np.ndarray): A two-dimensional array of shape (n_runs, 3), as returned by
+            compute_mask_runs().
+        shape (tuple(int)): The shape of the dense mask.
+        value (int, optional): The value of the pixels belonging to the mask. Defaults to 1.
+
+    Returns:
+        (np.ndarray): A two-dimensional array representing the mask.
+    """
+    mask = np.zeros(shape, dtype=np.uint8)
+    for idx_run in range(array_runs.shape[0]):
+        mask[array_runs[idx_run, 0], array_runs[idx_run, 1] : array_runs[idx_run, 2]] = value
+    return mask
+
+
+@njit
+def compute_mask_overlay(array_runs, shape, color_rgba, min_column=0):
+    """This function builds an RGBA image in which the pixels of a mask (encoded as a list of runs)
+    are colored, while the rest of the image is transparent.
+
+    Args:
+        array_runs (np.ndarray): A two-dimensional array of shape (n_runs, 3), as returned by
+            compute_mask_runs().
+        shape (tuple(int)): The shape (height, width) of the image.
+        color_rgba (np.ndarray): An array of 4 integers representing the color of the mask.
+        min_column (int, optional): Pixels whose column index is lower than min_column are left
+            transparent. Defaults to 0.
+
+    Returns:
+        (np.ndarray): A three-dimensional array of shape (height, width, 4) representing the image.
+    """
+    image = np.zeros((shape[0], shape[1], 4), dtype=np.uint8)
+    for idx_run in range(array_runs.shape[0]):
+        for y in range(max(array_runs[idx_run, 1], min_column), array_runs[idx_run, 2]):
+            image[array_runs[idx_run, 0], y] = color_rgba
+    return image
+
+
+@njit
+def compute_last_projected_pixels(array_projection_correspondence_sliced, original_shape):
+    """This function computes, for each pixel of the original acquisition, the flat index of the
+    last pixel (in raster order) of the high-resolution warped image which maps to it. This is
+    needed to map back masks encoded as runs to the original data with the same result as
+    get_array_rows_from_atlas_mask(), in which the last warped pixel always prevails.
+
+    Args:
+        array_projection_correspondence_sliced (np.ndarray): A two-dimensional array which
+            associates, to each couple of coordinates of the original acquisition (row_index,
+            column_index), a tuple of coordinates corresponding to the row_index and column_index of
+            the warped higher-resolution image.
+        original_shape (tuple(int)): The shape of the original acquisition.
+
+    Returns:
+        (np.ndarray): A two-dimensional array of the shape of the original acquisition, containing
+            the flat index of the last warped pixel mapping to each pixel (-1 if there's none).
+    """
+    array_last_pixels = np.full(original_shape, -1, dtype=np.int64)
+    width = array_projection_correspondence_sliced.shape[1]
+    for x in range(array_projection_correspondence_sliced.shape[0]):
+        for y in range(width):
+            x_original, y_original = array_projection_correspondence_sliced[x, y]
+            if (
+                x_original >= 0
+                and x_original < original_shape[0]
+                and y_original >= 0
+                and y_original < original_shape[0]
+            ):
+                array_last_pixels[x_original, y_original] = x * width + y
+    return array_last_pixels
+
+
+@njit
+def get_array_rows_from_mask_runs(
+    array_runs, mask_remapped, array_projection_correspondence_sliced, array_last_pixels
+):
+    """This function is equivalent to get_array_rows_from_atlas_mask(), but works directly on a mask
+    encoded as a list of runs, such that only the pixels belonging to the mask are browsed.
+
+    Args:
+        array_runs (np.ndarray): A two-dimensional array of shape (n_runs, 3), as returned by
+            compute_mask_runs().
+        mask_remapped (np.ndarray): An empty two-dimensional array of the shape of the original
+            acquisition, passed a parameter as numba won't allow for np.uint8 creation inside of the
+            scope of the function.
+        array_projection_correspondence_sliced (np.ndarray): A two-dimensional array which
+            associates, to each couple of coordinates of the original acquisition (row_index,
+            column_index), a tuple of coordinates corresponding to the row_index and column_index of
+            the warped higher-resolution image.
+        array_last_pixels (np.ndarray): A two-dimensional array of the shape of the original
+            acquisition, as returned by compute_last_projected_pixels().
+
+    Returns:
+        (np.ndarray, np.ndarray): The first array contains the lower and upper indexes of the rows
+            belonging to the mask. The second array contains, for each row, the corresponding column
+            boundaries of the mask (there can be more than 2 for non-convex shapes).
+    """
+    # Map back the mask coordinates to original data
+    width = array_projection_correspondence_sliced.shape[1]
+    for idx_run in range(array_runs.shape[0]):
+        x = array_runs[idx_run, 0]
+        for y in range(array_runs[idx_run, 1], array_runs[idx_run, 2]):
+            x_original, y_original = array_projection_correspondence_sliced[x, y]
+            if (
+                x_original >= 0
+                and x_original < mask_remapped.shape[0]
+                and y_original >= 0
+                and y_original < mask_remapped.shape[0]
+            ):
+                # Only the last warped pixel mapping to the original pixel is taken into account
+                if array_last_pixels[x_original, y_original] == x * width + y:
+                    mask_remapped[x_original, y_original] = 1
+
+    return _compute_row_boundaries(mask_remapped)
+
+
 @njit
 def solve_plane_equation(
     array_coordinates_high_res_slice,
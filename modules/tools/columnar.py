@@ -0,0 +1,259 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" In this module, a columnar container is defined for the small per-slice arrays of the dataset
+(formerly stored in light_arrays.pickle). Each field (e.g. array_lookup_pixels) is stored in a
+single .npy file, in which the flattened arrays of all slices are concatenated, while the offsets
+and shapes of the arrays, as well as the non-array values (e.g. image_shape or is_brain_1), are
+stored in a json file. The .npy files are memory-mapped, such that the arrays are only read when
+accessed, and that their pages are shared between the processes of the app."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import json
+import logging
+import os
+import numpy as np
+
+# LBAE imports
+from modules.tools.misc import logmem
+
+# ==================================================================================================
+# --- Constants
+# ==================================================================================================
+
+# Name of the file containing the offsets and shapes of the arrays, and the non-array values
+NAME_META_FILE = "meta.json"
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def _to_json_value(value):
+    """This function converts a non-array value (e.g. a numpy scalar or a tuple) into a value that
+    can be serialized in json.
+
+    Args:
+        value (object): The value to convert.
+
+    Returns:
+        (object): The converted value.
+    """
+    if isinstance(value, (tuple, list)):
+        return [_to_json_value(x) for x in value]
+    elif isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _from_json_value(value):
+    """This function is the inverse of _to_json_value(). Lists are converted back to tuples, since
+    they are only used for shapes.
+
+    Args:
+        value (object): The value to convert.
+
+    Returns:
+        (object): The converted value.
+    """
+    if isinstance(value, list):
+        return tuple(_from_json_value(x) for x in value)
+    return value
+
+
+def save_columnar_arrays(dic_arrays, path_folder):
+    """This function saves a dictionnary of per-slice arrays (e.g. the former content of
+    light_arrays.pickle) as a columnar container, which can be opened with ColumnarArrays. Numpy
+    arrays are concatenated per field in a .npy file, while the other values are stored in the
+    json file.
+
+    Args:
+        dic_arrays (dict): A dictionnary mapping each slice index to a dictionnary of values.
+        path_folder (str): The folder in which the container is saved.
+    """
+    os.makedirs(path_folder, exist_ok=True)
+    l_slices = sorted(dic_arrays.keys())
+    dic_meta = {"slices": [], "values": {}, "arrays": {}}
+
+    # Collect the arrays of each field
+    dic_columns = {}
+    for slice_index in l_slices:
+        dic_meta["slices"].append(_to_json_value(slice_index))
+        dic_meta["values"][str(slice_index)] = {}
+        dic_meta["arrays"][str(slice_index)] = {}
+        for key, value in dic_arrays[slice_index].items():
+            if isinstance(value, np.ndarray):
+                dic_columns.setdefault(key, []).append((slice_index, value))
+            else:
+                dic_meta["values"][str(slice_index)][key] = _to_json_value(value)
+
+    # Concatenate the flattened arrays of each field, and record their position
+    dic_meta["dtypes"] = {}
+    for key, l_arrays in dic_columns.items():
+        dtype = np.result_type(*[array.dtype for _, array in l_arrays])
+        offset = 0
+        for slice_index, array in l_arrays:
+            dic_meta["arrays"][str(slice_index)][key] = [offset, list(array.shape)]
+            offset += array.size
+        array_column = np.empty(offset, dtype=dtype)
+        for slice_index, array in l_arrays:
+            start, _ = dic_meta["arrays"][str(slice_index)][key]
+            array_column[start : start + array.size] = array.ravel()
+        np.save(os.path.join(path_folder, key + ".npy"), array_column)
+        dic_meta["dtypes"][key] = dtype.str
+
+    # Write the json file last, such that an interrupted conversion can't be opened
+    with open(os.path.join(path_folder, NAME_META_FILE), "w") as file:
+        json.dump(dic_meta, file)
+
+
+# ==================================================================================================
+# --- Classes
+# ==================================================================================================
+
+
+class ColumnarArrays:
+    """A class to access the per-slice arrays saved with save_columnar_arrays(). It can be indexed
+    like the original dictionnary, i.e. columnar_arrays[slice_index][key], but the arrays are
+    views on memory-mapped files, which are only read when accessed.
+
+    Attributes:
+        _path_folder (str): The folder in which the container is saved.
+        _l_slices (list(int)): The slice indices of the container.
+        _dic_values (dict): The non-array values, per slice index.
+        _dic_positions (dict): The offset and shape of the arrays of each field, per slice index.
+        _dic_columns (dict): The memory-mapped columns, opened when first accessed.
+
+    Methods:
+        __init__(path_folder): Initialize the class ColumnarArrays.
+        __len__(): Returns the number of slices.
+        __getitem__(slice_index): Returns a ColumnarSlice for the requested slice.
+        __contains__(slice_index): Returns True if the requested slice is in the container.
+        keys(): Returns the slice indices of the container.
+        items(): Returns the pairs (slice index, ColumnarSlice) of the container.
+        get_value(slice_index, key): Returns the value (or array) of a field for a given slice.
+        get_keys(slice_index): Returns the names of the fields of a given slice.
+    """
+
+    __slots__ = ["_path_folder", "_l_slices", "_dic_values", "_dic_positions", "_dic_columns"]
+
+    def __init__(self, path_folder):
+        """Initialize the class ColumnarArrays.
+
+        Args:
+            path_folder (str): The folder in which the container has been saved.
+        """
+        logging.info("Opening columnar arrays in " + path_folder + logmem())
+        self._path_folder = path_folder
+        with open(os.path.join(path_folder, NAME_META_FILE), "r") as file:
+            dic_meta = json.load(file)
+        self._l_slices = dic_meta["slices"]
+        self._dic_values = {
+            slice_index: {
+                key: _from_json_value(value)
+                for key, value in dic_meta["values"][str(slice_index)].items()
+            }
+            for slice_index in self._l_slices
+        }
+        self._dic_positions = {
+            slice_index: {
+                key: (offset, tuple(shape))
+                for key, (offset, shape) in dic_meta["arrays"][str(slice_index)].items()
+            }
+            for slice_index in self._l_slices
+        }
+        self._dic_columns = {}
+
+    def __len__(self):
+        return len(self._l_slices)
+
+    def __getitem__(self, slice_index):
+        if slice_index not in self._dic_values:
+            raise KeyError(slice_index)
+        return ColumnarSlice(self, slice_index)
+
+    def __contains__(self, slice_index):
+        return slice_index in self._dic_values
+
+    def keys(self):
+        return list(self._l_slices)
+
+    def items(self):
+        return [(slice_index, self[slice_index]) for slice_index in self._l_slices]
+
+    def get_value(self, slice_index, key):
+        """Returns the value of a field for a given slice. Arrays are returned as (read-only) views
+        on the memory-mapped column of the field.
+
+        Args:
+            slice_index (int): The index of the slice.
+            key (str): The name of the field.
+
+        Returns:
+            (object): The requested value or array.
+        """
+        dic_values = self._dic_values[slice_index]
+        if key in dic_values:
+            return dic_values[key]
+        offset, shape = self._dic_positions[slice_index][key]
+        column = self._dic_columns.get(key)
+        if column is None:
+            column = np.load(os.path.join(self._path_folder, key + ".npy"), mmap_mode="r")
+            self._dic_columns[key] = column
+
+        # Return a plain ndarray (still backed by the memory map), as expected by numba
+        return np.asarray(column[offset : offset + int(np.prod(shape))]).reshape(shape)
+
+    def get_keys(self, slice_index):
+        """Returns the names of the fields of a given slice.
+
+        Args:
+            slice_index (int): The index of the slice.
+
+        Returns:
+            (list(str)): The names of the fields.
+        """
+        return list(self._dic_values[slice_index].keys()) + list(
+            self._dic_positions[slice_index].keys()
+        )
+
+
+class ColumnarSlice:
+    """A lightweight view on the fields of a given slice of a ColumnarArrays container, which can be
+    indexed like a dictionnary.
+
+    Attributes:
+        _columnar_arrays (ColumnarArrays): The container.
+        _slice_index (int): The index of the slice.
+
+    Methods:
+        __init__(columnar_arrays, slice_index): Initialize the class ColumnarSlice.
+        __getitem__(key): Returns the value (or array) of the requested field.
+        __contains__(key): Returns True if the requested field exists for the slice.
+        keys(): Returns the names of the fields of the slice.
+    """
+
+    __slots__ = ["_columnar_arrays", "_slice_index"]
+
+    def __init__(self, columnar_arrays, slice_index):
+        """Initialize the class ColumnarSlice.
+
+        Args:
+            columnar_arrays (ColumnarArrays): The container.
+            slice_index (int): The index of the slice.
+        """
+        self._columnar_arrays = columnar_arrays
+        self._slice_index = slice_index
+
+    def __getitem__(self, key):
+        return self._columnar_arrays.get_value(self._slice_index, key)
+
+    def __contains__(self, key):
+        return key in self._columnar_arrays.get_keys(self._slice_index)
+
+    def keys(self):
+        return self._columnar_arrays.get_keys(self._slice_index)
@@ -0,0 +1,154 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" In this module, functions used to compress the objects saved in the database are defined. Arrays
+are first transformed with a filter making them more compressible (bit-packing for binary masks,
+byte-shuffling for multi-bytes numbers), and the whole serialized object is then compressed with
+zlib, at a level chosen according to the type of the object."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import zlib
+import numpy as np
+
+# ==================================================================================================
+# --- Constants
+# ==================================================================================================
+
+# Arrays smaller than this size (in bytes) are not filtered
+MIN_SIZE_FILTER = 1024
+
+# One-byte headers identifying the codec used to compress a payload. Pickle streams (protocol >= 2)
+# always start with b"\x80", which is used to identify uncompressed (or legacy) payloads.
+DIC_CODEC_HEADERS = {"none": b"\x00", "zlib": b"\x01"}
+DIC_HEADERS_CODEC = {header: codec for codec, header in DIC_CODEC_HEADERS.items()}
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def filter_array(array):
+    """This function transforms an array into bytes which compress better than the raw array data.
+    uint8 or boolean arrays containing at most one non-zero value (e.g. projected masks) are
+    bit-packed, while arrays of multi-bytes numbers (e.g. float32 spectra) are byte-shuffled, i.e.
+    the i-th bytes of all the elements are stored contiguously.
+
+    Args:
+        array (np.ndarray): The array to filter.
+
+    Returns:
+        (tuple): A tuple (filter_name, dtype, shape, parameter, bytes) to pass to unfilter_array, or
+            None if the array doesn't benefit from any filter.
+    """
+    if array.nbytes < MIN_SIZE_FILTER or array.dtype.hasobject:
+        return None
+
+    array = np.ascontiguousarray(array)
+    if array.dtype in (np.uint8, np.bool_):
+        array_non_zero = array[array != 0]
+        if array_non_zero.size == 0 or np.all(array_non_zero == array_non_zero[0]):
+            value = int(array_non_zero[0]) if array_non_zero.size > 0 else 1
+            return (
+                "bitpack",
+                array.dtype.str,
+                array.shape,
+                value,
+                np.packbits(array != 0).tobytes(),
+            )
+    elif array.dtype.itemsize > 1 and array.dtype.kind in "fiuc":
+        return (
+            "shuffle",
+            array.dtype.str,
+            array.shape,
+            None,
+            array.view(np.uint8).reshape(-1, array.dtype.itemsize).T.tobytes(),
+        )
+    return None
+
+
+def unfilter_array(filter_name, dtype, shape, parameter, data):
+    """This function is the inverse of filter_array.
+
+    Args:
+        filter_name (str): The name of the filter, i.e. "bitpack" or "shuffle".
+        dtype (str): The dtype of the original array.
+        shape (tuple): The shape of the original array.
+        parameter (object): The parameter of the filter (the non-zero value for "bitpack").
+        data (bytes): The filtered data.
+
+    Returns:
+        (np.ndarray): The original array.
+    """
+    dtype = np.dtype(dtype)
+    if filter_name == "bitpack":
+        n_elements = int(np.prod(shape))
+        array = np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=n_elements)
+        return (array * parameter).astype(dtype).reshape(shape)
+    elif filter_name == "shuffle":
+        array = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T.copy()
+        return array.view(dtype).reshape(shape)
+    raise ValueError("Unknown array filter: " + str(filter_name))
+
+
+def choose_codec(object):
+    """This function chooses the codec used to compress an object according to its type. zlib is
+    used for all objects, as it's part of the standard library (dedicated codecs such as zstd or lz4
+    would be additional dependencies), only the compression level varies: arrays and sequences of
+    arrays (e.g. masks and spectra) are compressed with a fast setting, as they are read in
+    interactive callbacks, while other objects (e.g. figures, dictionnaries) are compressed more
+    strongly.
+
+    Args:
+        object (object): The object to compress.
+
+    Returns:
+        (str, int): The name of the codec and the compression level.
+    """
+    if isinstance(object, np.ndarray) or (
+        isinstance(object, (tuple, list))
+        and len(object) > 0
+        and all([isinstance(x, np.ndarray) for x in object])
+    ):
+        return "zlib", 1
+    return "zlib", 6
+
+
+def compress(data, codec="zlib", level=6):
+    """This function compresses bytes with a given codec, and prefixes the result with a header
+    identifying the codec.
+
+    Args:
+        data (bytes): The bytes to compress.
+        codec (str, optional): The codec to use, i.e. "none" or "zlib". Defaults to "zlib".
+        level (int, optional): The compression level. Defaults to 6.
+
+    Returns:
+        (bytes): The compressed bytes.
+    """
+    if codec == "zlib":
+        data = zlib.compress(data, level)
+    elif codec != "none":
+        raise ValueError("Unknown codec: " + str(codec))
+    return DIC_CODEC_HEADERS[codec] + data
+
+
+def decompress(data):
+    """This function is the inverse of compress. Payloads without header (i.e. raw pickle streams)
+    are returned as is.
+
+    Args:
+        data (bytes): The compressed bytes.
+
+    Returns:
+        (bytes): The decompressed bytes.
+    """
+    codec = DIC_HEADERS_CODEC.get(bytes(data[:1]))
+    if codec is None:
+        return data
+    elif codec == "zlib":
+        return zlib.decompress(data[1:])
+    return data[1:]
@@ -2,21 +2,55 @@
 # Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
 
 """ This file contains functions used to convert arrays to Pillow images, possibly as b64 
-strings."""
+strings. As the same images are requested over and over by the callbacks, the b64 strings are kept
+in a cache, indexed by the content of the image and the conversion parameters. Images can also be
+registered in an ImageStore, such that they're served as binary files by the app, and referenced by
+their URL in the figures."""
 
 # ==================================================================================================
 # --- Imports
 # ==================================================================================================
 
 # Standard modules
+import os
+import re
 import logging
+import threading
 import numpy as np
 import base64
+import hashlib
 from io import BytesIO
 from PIL import Image
 
 # LBAE imports
 from config import black_viridis
+from modules.tools.misc import LRUCache
+
+# ==================================================================================================
+# --- Constants
+# ==================================================================================================
+
+# Maximum cumulated size (in bytes) of the b64 strings kept in cache
+BASE64_CACHE_SIZE = 2**26
+
+# Cache of the b64 strings returned by convert_image_to_base64(), shared by all callbacks of the
+# process
+cache_base64 = LRUCache(BASE64_CACHE_SIZE)
+
+# Palettes computed by return_palette(), indexed by the id of their colormap
+dic_palettes = {}
+
+# URL under which the images of the ImageStore are served by the app
+URL_IMAGES = "/images/"
+
+# Formats of the images which can be registered in an ImageStore
+L_FORMATS_IMAGE_STORE = ["png", "webp"]
+
+# URL under which the tiles of the slice images are served by the app
+URL_TILES = "/tiles/"
+
+# Size (in pixels) of the tiles of the slice images, at all zoom levels
+TILE_SIZE = 256
 
 # ==================================================================================================
 # --- Functions
@@ -39,6 +73,123 @@ def black_to_transparency(img):
     return Image.fromarray(x)
 
 
+def return_palette(colormap):
+    """This function returns the 256-entry palette corresponding to a colormap, i.e. the colors
+    obtained when the colormap is applied to an uint8 image, along with the transparency of each
+    entry if black pixels must be made transparent. Palettes are only computed once per colormap.
+
+    Args:
+        colormap (cm colormap): The colormap used to map uint8 images to colors.
+
+    Returns:
+        (list(int), bytes): The palette (flattened RGB values), and the alpha value of each entry
+            (0 for black entries, 255 otherwise).
+    """
+    t_palette = dic_palettes.get(id(colormap))
+    if t_palette is None:
+        # Same conversion as in encode_image_to_base64() for the generic path
+        array_colors = np.uint8(colormap(np.arange(256, dtype=np.uint8)) * 255)[:, :3]
+        transparency = bytes(255 * (array_colors != 0).any(axis=1).astype(np.uint8))
+        # The colormap is kept in the dictionnary, such that its id can't be reused
+        t_palette = (colormap, array_colors.ravel().tolist(), transparency)
+        dic_palettes[id(colormap)] = t_palette
+    return t_palette[1], t_palette[2]
+
+
+# Precompute the palette of the default colormap
+return_palette(black_viridis)
+
+
+def encode_indexed_image_to_png(
+    image_array, colormap=black_viridis, optimize=True, transparent_zeros=False, compress_level=None
+):
+    """This function encodes an uint8 image as a paletted png, whose palette is the one of the
+    colormap. This is much faster than the generic path of encode_image_to_base64(), as the
+    colormap is never applied to the image, i.e. no float or RGBA intermediate array is built, and
+    the colors are exact (no quantization).
+
+    Args:
+        image_array (np.ndarray): A 2D uint8 array containing the image.
+        colormap (cm colormap, optional): The colormap used to map the image to colors. Defaults to
+            black_viridis.
+        optimize (bool, optional): If True, PIL will try to optimize the image size, at the expense
+            of a longer computation time. Ignored if compress_level is not None. Defaults to True.
+        transparent_zeros (bool, optional): If True, the pixels mapped to black are transparent.
+            Defaults to False.
+        compress_level (int, optional): zlib compression level, from 0 (no compression) to 9. If
+            None, it's set by PIL according to optimize. Defaults to None.
+
+    Returns:
+        (bytes): The png image.
+    """
+    palette, transparency = return_palette(colormap)
+    pil_img = Image.fromarray(np.ascontiguousarray(image_array))
+    pil_img.putpalette(palette)
+    dic_options = {}
+    if transparent_zeros:
+        dic_options["transparency"] = transparency
+    if compress_level is not None:
+        dic_options["compress_level"] = compress_level
+    else:
+        dic_options["optimize"] = optimize
+    with BytesIO() as stream:
+        pil_img.save(stream, format="png", **dic_options)
+        return stream.getvalue()
+
+
+def _hash_array(hasher, array):
+    """This function updates a hash object with the content, shape and type of an array.
+
+    Args:
+        hasher (hashlib.blake2b): The hash object.
+        array (np.ndarray): The array to hash.
+    """
+    array = np.ascontiguousarray(array)
+    hasher.update((str(array.shape) + array.dtype.str).encode())
+    hasher.update(array.data)
+
+
+def compute_base64_cache_key(image_array, overlay=None, **kwargs_conversion):
+    """This function computes the key under which the b64 string of an image is cached. It depends
+    on the content of the image (and overlay), not on their identity, such that the same image
+    recomputed by another callback is found in the cache.
+
+    Args:
+        image_array (np.ndarray): The array containing the image.
+        overlay (np.ndarray, optional): Another image array to overlay with image_array. Defaults to
+            None.
+        **kwargs_conversion: The other arguments of convert_image_to_base64().
+
+    Returns:
+        (str): The key of the image.
+    """
+    hasher = hashlib.blake2b(digest_size=20)
+    _hash_array(hasher, image_array)
+    if overlay is not None:
+        _hash_array(hasher, overlay)
+    for key, value in sorted(kwargs_conversion.items()):
+        # Colormaps are identified by their colors, as their names are not necessarily unique
+        if key == "colormap":
+            _hash_array(hasher, value(np.linspace(0, 1, 256)))
+        else:
+            hasher.update((key + "=" + str(value) + ";").encode())
+    return hasher.hexdigest()
+
+
+def get_base64_cache_stats():
+    """This function returns the counters of the cache of b64 strings, along with its hit rate,
+    e.g. for monitoring purposes.
+
+    Returns:
+        (dict): A dictionnary containing the counters of the cache (see LRUCache.get_stats()) and
+            its hit rate.
+    """
+    dic_stats = cache_base64.get_stats()
+    n_requests = dic_stats["hits"] + dic_stats["misses"]
+    dic_stats["hit_rate"] = dic_stats["hits"] / n_requests if n_requests > 0 else 0.0
+    return dic_stats
+
+
 def convert_image_to_base64(
     image_array,
     optimize=True,
@@ -50,9 +201,134 @@ def convert_image_to_base64(
     decrease_resolution_factor=1,
     binary=False,
     transparent_zeros=False,
+    compress_level=None,
+    use_cache=True,
 ):
     """This functions allows for the conversion of a numpy array into a bytestring image using PIL.
-    All images are paletted so save space.
+    The b64 strings are cached (see cache_base64), such that requesting the same image again
+    returns the same string without encoding it again. Please consult the documentation of
+    encode_image_to_base64() for more information about the arguments.
+
+    Args:
+        image_array (np.ndarray): The array containing the image.
+        optimize (bool, optional): See encode_image_to_base64(). Defaults to True.
+        quality (int, optional): See encode_image_to_base64(). Defaults to 85.
+        colormap (cm colormap, optional): See encode_image_to_base64(). Defaults to black_viridis.
+        type (str, optional): See encode_image_to_base64(). Defaults to None.
+        format (str, optional): See encode_image_to_base64(). Defaults to "png".
+        overlay (np.ndarray, optional): See encode_image_to_base64(). Defaults to None.
+        decrease_resolution_factor (int, optional): See encode_image_to_base64(). Defaults to 1.
+        binary (bool, optional): See encode_image_to_base64(). Defaults to False.
+        transparent_zeros (bool, optional): See encode_image_to_base64(). Defaults to False.
+        compress_level (int, optional): See encode_image_to_base64(). Defaults to None.
+        use_cache (bool, optional): If True, the b64 string is looked up in (and saved to) the
+            cache. Defaults to True.
+
+    Returns:
+        (str): The base 64 image encoded in a string.
+    """
+    dic_kwargs = {
+        "optimize": optimize,
+        "quality": quality,
+        "colormap": colormap,
+        "type": type,
+        "format": format,
+        "decrease_resolution_factor": decrease_resolution_factor,
+        "binary": binary,
+        "transparent_zeros": transparent_zeros,
+        "compress_level": compress_level,
+    }
+    if not use_cache:
+        return encode_image_to_base64(image_array, overlay=overlay, **dic_kwargs)
+
+    key = compute_base64_cache_key(image_array, overlay=overlay, **dic_kwargs)
+    base64_string = cache_base64.get(key)
+    if base64_string is not None:
+        logging.info("Image returned from the base64 cache")
+        return base64_string
+
+    base64_string = encode_image_to_base64(image_array, overlay=overlay, **dic_kwargs)
+    cache_base64.set(key, base64_string, len(base64_string))
+    return base64_string
+
+
+def downsample_image(image_array):
+    """This function divides the resolution of an image by 2, to build the next level of a tile
+    pyramid. Grayscale images are averaged over the non-zero pixels of each 2x2 block (blocks
+    with less than 2 non-zero pixels are zeroed), such that the borders of the slices don't get
+    darker, as zero pixels are displayed as transparent. RGB(A) images (e.g. contour overlays) are
+    max-pooled, such that thin lines don't vanish. Images whose height or width is odd are padded
+    with a row or column of zeros along the corresponding axis.
+
+    Args:
+        image_array (np.ndarray): The image, of shape (..., height, width) for (stacks of)
+            grayscale images, or (height, width, n_channels) for RGB(A) images.
+
+    Returns:
+        (np.ndarray): The downsampled image, with the same dtype as image_array.
+    """
+    rgb = image_array.ndim == 3 and image_array.shape[2] in (3, 4)
+    axis_height = 0 if rgb else image_array.ndim - 2
+
+    # Pad images of odd size with zeros
+    l_padding = [(0, 0)] * image_array.ndim
+    l_padding[axis_height] = (0, image_array.shape[axis_height] % 2)
+    l_padding[axis_height + 1] = (0, image_array.shape[axis_height + 1] % 2)
+    image_array = np.pad(image_array, l_padding)
+    shape_blocks = (
+        image_array.shape[:axis_height]
+        + (image_array.shape[axis_height] // 2, 2, image_array.shape[axis_height + 1] // 2, 2)
+        + image_array.shape[axis_height + 2 :]
+    )
+    array_blocks = image_array.reshape(shape_blocks)
+    if rgb:
+        return array_blocks.max(axis=(1, 3))
+
+    array_sum = array_blocks.sum(axis=(-3, -1), dtype=np.float32)
+    array_count = (array_blocks != 0).sum(axis=(-3, -1))
+    array_mean = np.where(array_count >= 2, array_sum / np.maximum(array_count, 1), 0)
+    return np.round(array_mean).astype(image_array.dtype)
+
+
+def parse_relayout_ranges(relayout_data):
+    """This function extracts the ranges of the axes of a graph from its relayoutData, i.e. the
+    current viewport of the graph.
+
+    Args:
+        relayout_data (dict): The relayoutData of the graph.
+
+    Returns:
+        (list(float), list(float)): The ranges of the x and y axes. None for an axis whose range is
+            not specified in relayout_data, or which has been autoranged.
+    """
+    l_ranges = []
+    for axis in ["xaxis", "yaxis"]:
+        axis_range = None
+        if relayout_data is not None:
+            if axis + ".range[0]" in relayout_data and axis + ".range[1]" in relayout_data:
+                axis_range = [relayout_data[axis + ".range[0]"], relayout_data[axis + ".range[1]"]]
+            elif axis + ".range" in relayout_data:
+                axis_range = list(relayout_data[axis + ".range"])
+        l_ranges.append(axis_range)
+    return l_ranges[0], l_ranges[1]
+
+
+def encode_image_to_base64(
+    image_array,
+    optimize=True,
+    quality=85,
+    colormap=black_viridis,
+    type=None,
+    format="png",
+    overlay=None,
+    decrease_resolution_factor=1,
+    binary=False,
+    transparent_zeros=False,
+    compress_level=None,
+):
+    """This functions encodes a numpy array into a bytestring image using PIL, without using the
+    cache of convert_image_to_base64(). All images are paletted so save space. Uint8 images which
+    are simply colormapped and saved as png go through encode_indexed_image_to_png().
 
     Args:
         image_array (np.ndarray): The array containing the image. May be 1D of 3D or 4D. The type
@@ -75,12 +351,36 @@ def convert_image_to_base64(
         binary (bool, optional): Used to convert the output image to binary format ("LA", in PIL),
             to save a lot of space for greyscales images.
             Defaults to False.
+        transparent_zeros (bool, optional): If True, black pixels are made transparent. Defaults to
+            False.
+        compress_level (int, optional): zlib compression level (0-9) used for png images. If None,
+            it's set by PIL according to optimize. Defaults to None.
 
     Returns:
         (str): The base 64 image encoded in a string.
     """
     logging.info("Entering string conversion function")
 
+    # Fast path for uint8 images: the palette of the colormap is used directly
+    if (
+        type is None
+        and format == "png"
+        and overlay is None
+        and decrease_resolution_factor == 1
+        and not binary
+        and image_array.ndim == 2
+        and image_array.dtype == np.uint8
+    ):
+        png = encode_indexed_image_to_png(
+            image_array,
+            colormap=colormap,
+            optimize=optimize,
+            transparent_zeros=transparent_zeros,
+            compress_level=compress_level,
+        )
+        logging.info("Image has been converted to a paletted png. Returning it now.")
+        return "data:image/png;base64," + base64.b64encode(png).decode("utf-8")
+
     # Convert 1D array into a PIL image
     if type is None:
         # Map image to a colormap and convert to uint8
@@ -147,7 +447,10 @@ def convert_image_to_base64(
             else:
                 pil_img = pil_img.convert("P")
             logging.info("png mode selected, quality argument is not supported")
-            pil_img.save(stream, format=format, optimize=optimize, bits=9)
+            if compress_level is not None:
+                pil_img.save(stream, format=format, compress_level=compress_level, bits=9)
+            else:
+                pil_img.save(stream, format=format, optimize=optimize, bits=9)
 
         # Encode final image
         base64_string = (
@@ -158,3 +461,156 @@ def convert_image_to_base64(
         )
     logging.info("Image has been converted to base64. Returning it now.")
     return base64_string
+
+
+# ==================================================================================================
+# --- Classes
+# ==================================================================================================
+
+
+class ImageStore:
+    """A class used to store the encoded images displayed in the figures, such that they can be
+    served as binary files by the app (see the image route in app.py) instead of being embedded as
+    b64 strings in the figures. Images are identified by the same content-based key as in the cache
+    of convert_image_to_base64(), which is used as ETag, so that browsers and proxies can cache them
+    indefinitely. Encoded images are written in a folder, which is shared by all the processes of
+    the app, and the most recent ones are also kept in memory.
+
+    Attributes:
+        path_folder (str): The folder in which the encoded images are written.
+        max_bytes_folder (int): Approximate maximum size (in bytes) of the folder. The least
+            recently registered images are removed when it's exceeded.
+        cache (LRUCache): In-process cache of the encoded images.
+        _n_writes (int): Number of images written since the size of the folder was last checked.
+        _lock (threading.Lock): Lock protecting _n_writes.
+
+    Methods:
+        __init__(path_folder, cache_size=2**26, max_bytes_folder=2**30): Initializes the class
+            ImageStore.
+        _get_path(key, format): Returns the path of an encoded image.
+        _trim_folder(): Removes the least recently registered images if the folder is too big.
+        register_image(image_array, format="png", **kwargs_conversion): Encodes an image if needed
+            and returns its URL.
+        get_image(key, format): Returns an encoded image.
+    """
+
+    __slots__ = ["path_folder", "max_bytes_folder", "cache", "_n_writes", "_lock"]
+
+    def __init__(self, path_folder, cache_size=2**26, max_bytes_folder=2**30):
+        """Initialize the class ImageStore.
+
+        Args:
+            path_folder (str): The folder in which the encoded images are written.
+            cache_size (int, optional): Capacity (in bytes) of the in-process cache. Defaults to
+                2**26 (64MB).
+            max_bytes_folder (int, optional): Approximate maximum size (in bytes) of the folder.
+                Defaults to 2**30 (1GB).
+        """
+        self.path_folder = path_folder
+        if not os.path.exists(self.path_folder):
+            os.makedirs(self.path_folder)
+        self.max_bytes_folder = max_bytes_folder
+        self.cache = LRUCache(cache_size)
+        self._n_writes = 0
+        self._lock = threading.Lock()
+
+    def _get_path(self, key, format):
+        """This method returns the path of the file of an encoded image.
+
+        Args:
+            key (str): The key of the image.
+            format (str): The format of the image.
+
+        Returns:
+            (str): The path of the file.
+        """
+        return os.path.join(self.path_folder, key + "." + format)
+
+    def _trim_folder(self):
+        """This method removes the least recently registered images of the folder (register_image()
+        updates the modification time of the files) if its size exceeds max_bytes_folder. It's
+        only called every 100 writes, as listing the folder is costly."""
+        l_files = []
+        for entry in os.scandir(self.path_folder):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                l_files.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum([size for _, size, _ in l_files])
+        for _, size_file, path_file in sorted(l_files):
+            if size <= self.max_bytes_folder:
+                break
+            try:
+                os.remove(path_file)
+            except FileNotFoundError:
+                # Already removed by another process
+                pass
+            size -= size_file
+
+    def register_image(self, image_array, format="png", **kwargs_conversion):
+        """This method encodes an image (if it has not been registered already, or if it has been
+        trimmed since) and returns the URL under which it's served by the app.
+
+        Args:
+            image_array (np.ndarray): The array containing the image.
+            format (str, optional): The format of the encoded image, "png" or "webp". Defaults to
+                "png".
+            **kwargs_conversion: The other arguments of encode_image_to_base64().
+
+        Returns:
+            (str): The URL of the image.
+        """
+        key = compute_base64_cache_key(image_array, format=format, **kwargs_conversion)
+        path_file = self._get_path(key, format)
+        try:
+            # Mark the image as recently used, such that the images still referenced by the
+            # figures are trimmed last
+            os.utime(path_file)
+        except FileNotFoundError:
+            content = self.cache.get(key)
+            if content is None:
+                base64_string = encode_image_to_base64(
+                    image_array, format=format, **kwargs_conversion
+                )
+                content = base64.b64decode(base64_string.split(",", 1)[1])
+                self.cache.set(key, content, len(content))
+
+            # Write under a temporary name first, such that other processes never read a
+            # partially written file
+            path_temp = path_file + "." + str(os.getpid()) + ".tmp"
+            with open(path_temp, "wb") as file:
+                file.write(content)
+            os.replace(path_temp, path_file)
+
+            with self._lock:
+                self._n_writes += 1
+                trim = self._n_writes >= 100
+                if trim:
+                    self._n_writes = 0
+            if trim:
+                self._trim_folder()
+        return URL_IMAGES + key + "." + format
+
+    def get_image(self, key, format):
+        """This method returns an encoded image, from the cache if possible, or from the folder
+        otherwise.
+
+        Args:
+            key (str): The key of the image.
+            format (str): The format of the image.
+
+        Returns:
+            (bytes): The encoded image, or None if it doesn't exist (or if the key or the format
+                are invalid).
+        """
+        # Make sure that only files of the folder can be read
+        if format not in L_FORMATS_IMAGE_STORE or re.fullmatch("[0-9a-f]+", key) is None:
+            return None
+        content = self.cache.get(key)
+        if content is None:
+            try:
+                with open(self._get_path(key, format), "rb") as file:
+                    content = file.read()
+            except FileNotFoundError:
+                return None
+            self.cache.set(key, content, len(content))
+        return content
@@ -10,10 +10,15 @@ data. """
 
 # Standard modules
 import numpy as np
-from numba import njit
+from numba import njit, prange
 
 # LBAE imports
-from modules.tools.spectra import convert_spectrum_idx_to_coor, add_zeros_to_spectrum
+from modules.tools.spectra import (
+    convert_spectrum_idx_to_coor,
+    add_zeros_to_spectrum,
+    return_lookup_image_columns,
+)
+from modules.tools.parallel import select_numba_function
 
 # Define divider_lookup (sets resolution of the lookups)
 DIVIDER_LOOKUP = 1
@@ -54,8 +59,9 @@ def build_index_lookup_table(
     )
     lookup_table[0, :] = array_pixel_indexes[:, 0]
 
-    # Loop over pixel indexes
-    for idx_pix in range(array_pixel_indexes.shape[0]):
+    # Loop over pixel indexes. Each pixel is written independently, so the loop can be run in
+    # parallel
+    for idx_pix in prange(array_pixel_indexes.shape[0]):
         j = array_pixel_indexes[idx_pix, 0]
 
         # If there's no peak for the current pixel, lookup is -1
@@ -86,6 +92,69 @@ def build_index_lookup_table(
     return lookup_table
 
 
+# Multithreaded version, see select_numba_function()
+build_index_lookup_table_parallel = njit(parallel=True)(build_index_lookup_table.py_func)
+
+
+@njit
+def build_fine_index_lookup_table(
+    array_spectra,
+    array_pixel_indexes,
+    lookup_table_spectra,
+    first_bin,
+    n_bins,
+    divider_lookup,
+    n_subdivisions=10,
+):
+    """This function builds a lookup table refining the one built with build_index_lookup_table(),
+    for the bins first_bin to first_bin + n_bins (i.e. a restricted m/z range). Each bin is divided
+    into n_subdivisions, and, for each subdivision s of bin i and each pixel, the table gives the
+    offset, from lookup_table_spectra[i], of the first mz index such that
+    mz>=(i+s/n_subdivisions)*divider_lookup (or of the last mz index of the pixel if no such mz
+    exists). Offsets are stored as uint8 and saturate at 255, which still gives a valid (but less
+    precise) starting index. This allows to skip most of the peaks below the lower bound of narrow
+    m/z selections, instead of sweeping the whole bin.
+
+    Args:
+        array_spectra (np.ndarray): An array of shape (2,n) containing spectrum data (m/z and
+            intensity) for each pixel.
+        array_pixel_indexes (np.ndarray): An array of shape (m,2) containing the boundary indices of
+            each pixel in array_spectra.
+        lookup_table_spectra (np.ndarray): The lookup table returned by build_index_lookup_table().
+        first_bin (int): The index of the first bin of lookup_table_spectra to refine.
+        n_bins (int): The number of bins to refine.
+        divider_lookup (int): The resolution of lookup_table_spectra.
+        n_subdivisions (int): The number of subdivisions of each bin. Defaults to 10.
+
+    Returns:
+        (np.ndarray): An array of shape (n_bins, n_subdivisions, m) containing the offsets.
+    """
+    lookup_table_fine = np.zeros((n_bins, n_subdivisions, array_pixel_indexes.shape[0]), np.uint8)
+
+    # Each pixel is written independently, so the loop can be run in parallel
+    for idx_pix in prange(array_pixel_indexes.shape[0]):
+        # If current pixel contains no peak, it's never looked up
+        if array_pixel_indexes[idx_pix, 0] == -1:
+            continue
+        for idx_bin in range(n_bins):
+            j_start = lookup_table_spectra[first_bin + idx_bin, idx_pix]
+            j = j_start
+            for idx_subdivision in range(1, n_subdivisions):
+                # Same threshold as in _return_lower_index()
+                threshold = (
+                    first_bin + idx_bin + idx_subdivision / n_subdivisions
+                ) * divider_lookup
+                while j < array_pixel_indexes[idx_pix, 1] and array_spectra[0, j] < threshold:
+                    j += 1
+                lookup_table_fine[idx_bin, idx_subdivision, idx_pix] = min(j - j_start, 255)
+
+    return lookup_table_fine
+
+
+# Multithreaded version, see select_numba_function()
+build_fine_index_lookup_table_parallel = njit(parallel=True)(build_fine_index_lookup_table.py_func)
+
+
 # Lookup table to
 @njit
 def build_cumulated_image_lookup_table(
@@ -116,7 +185,9 @@ def build_cumulated_image_lookup_table(
         (size_spectrum // divider_lookup, img_shape[0], img_shape[1]), dtype=np.float32
     )
     image_lookup_table[0, :] = np.zeros((img_shape[0], img_shape[1]), dtype=np.float32)
-    for idx_pix in range(array_pixel_indexes.shape[0]):
+
+    # Each pixel is written independently, so the loop can be run in parallel
+    for idx_pix in prange(array_pixel_indexes.shape[0]):
         j = array_pixel_indexes[idx_pix, 0]
         # If current pixel contains no peak, just skip to next one and add nothing
         if j == -1:
@@ -150,6 +221,130 @@ def build_cumulated_image_lookup_table(
     return image_lookup_table
 
 
+# Multithreaded version, see select_numba_function()
+build_cumulated_image_lookup_table_parallel = njit(parallel=True)(
+    build_cumulated_image_lookup_table.py_func
+)
+
+
+@njit
+def _fill_sparse_cumulated_image_lookup_table(
+    image_lookup_table,
+    array_spectra,
+    array_pixel_indexes,
+    array_lookup_image_columns,
+    divider_lookup,
+    size_spectrum,
+):
+    """This internal function fills the sparse cumulated image lookup table provided as an argument.
+    Please consult the documentation of build_sparse_cumulated_image_lookup_table() for more
+    information."""
+    # Each pixel is written independently, so the loop can be run in parallel
+    for idx_pix in prange(array_pixel_indexes.shape[0]):
+        j = array_pixel_indexes[idx_pix, 0]
+        # If current pixel contains no peak, it's not stored in the table
+        if j == -1:
+            continue
+        pix_value = 0
+        idx_column = array_lookup_image_columns[idx_pix]
+
+        # Loop over lookup indexes
+        for index_lookup in range(size_spectrum // divider_lookup - 1):
+            # Find the first mz index corresponding to current lookup for current pixel
+            # (skipped if current mz>lookup)
+            while array_spectra[0, j] >= (index_lookup * divider_lookup) and array_spectra[0, j] < (
+                (index_lookup + 1) * divider_lookup
+            ):
+                pix_value += array_spectra[1, j]
+                j += 1
+                if j == array_pixel_indexes[idx_pix, 1] + 1:
+                    break
+
+            # Check that we're still in the good pixel and add mz index to lookup
+            if j < array_pixel_indexes[idx_pix, 1] + 1:
+                image_lookup_table[index_lookup + 1, idx_column] = pix_value
+
+            # If we're not in the requested pixel, this means that the while loop was exited because
+            # the lookup didn't exist, so we fill the rest of the table with biggest possible value
+            else:
+                for i in range(index_lookup + 1, size_spectrum // divider_lookup):
+                    image_lookup_table[i, idx_column] = pix_value
+                break
+
+    return image_lookup_table
+
+
+# Multithreaded version, see select_numba_function()
+_fill_sparse_cumulated_image_lookup_table_parallel = njit(parallel=True)(
+    _fill_sparse_cumulated_image_lookup_table.py_func
+)
+
+
+def build_sparse_cumulated_image_lookup_table(
+    array_spectra, array_pixel_indexes, divider_lookup, size_spectrum=2000
+):
+    """This function builds the same lookup table as build_cumulated_image_lookup_table(), except
+    that only the pixels containing at least one peak (i.e. the pixels of the tissue) are stored,
+    in the order of their index. Since the table of the other pixels only contains zeros, this
+    reduces the size of the table (and of the corresponding memory map) without any loss of
+    precision. The column of each pixel in the table is given by return_lookup_image_columns(), and
+    the table can be used directly in place of the dense one to compute lipid images.
+
+    Args:
+        array_spectra (np.ndarray): An array of shape (2,n) containing spectrum data (m/z and
+            intensity) for each pixel.
+        array_pixel_indexes (np.ndarray): An array of shape (m,2) containing the boundary indices of
+            each pixel in array_spectra.
+        divider_lookup (int): Sets the resolution of the lookup table. The bigger it is, the bigger
+            the increments between two successive lookups. Must be consistent across lookup tables.
+        size_spectrum (int): The total size of the spectrum indexed by the lookup. Defaults to 2000,
+            corresponding to an indexed spectrum ranging from 0 m/z to 2000 m/z.
+
+    Returns:
+        (np.ndarray): An array of shape (size_spectrum// divider_lookup, n_pixels_with_peaks),
+            mapping m/z values to the cumulated spectrum until the corresponding m/z value for each
+            pixel containing at least one peak.
+    """
+    n_pixels_with_peaks = int(np.sum(array_pixel_indexes[:, 0] != -1))
+    image_lookup_table = np.zeros(
+        (size_spectrum // divider_lookup, n_pixels_with_peaks), dtype=np.float32
+    )
+    return select_numba_function(
+        _fill_sparse_cumulated_image_lookup_table,
+        _fill_sparse_cumulated_image_lookup_table_parallel,
+    )(
+        image_lookup_table,
+        array_spectra,
+        array_pixel_indexes,
+        return_lookup_image_columns(array_pixel_indexes),
+        divider_lookup,
+        size_spectrum,
+    )
+
+
+def convert_cumulated_image_lookup_table_to_sparse(image_lookup_table, array_pixel_indexes):
+    """This function converts a (dense) lookup table built with build_cumulated_image_lookup_table()
+    into the sparse lookup table returned by build_sparse_cumulated_image_lookup_table(), e.g. to
+    convert the lookup tables of an existing dataset.
+
+    Args:
+        image_lookup_table (np.ndarray): An array of shape (k, image height, image_width),
+            mapping m/z values to the cumulated spectrum until the corresponding m/z value for each
+            pixel.
+        array_pixel_indexes (np.ndarray): An array of shape (m,2) containing the boundary indices of
+            each pixel in array_spectra.
+
+    Returns:
+        (np.ndarray): An array of shape (k, n_pixels_with_peaks), containing the columns of the
+            pixels which contain at least one peak.
+    """
+    return np.ascontiguousarray(
+        image_lookup_table.reshape(image_lookup_table.shape[0], -1)[
+            :, array_pixel_indexes[:, 0] != -1
+        ]
+    )
+
+
 @njit
 def build_index_lookup_table_averaged_spectrum(array_mz, size_spectrum=2000):
     """This function builds a lookup table identical to the one defined in
@@ -199,6 +394,9 @@ def process_lookup_tables(
     load_from_file=True,
     save=True,
     return_result=False,
+    sparse_image_lookup=False,
+    fine_lookup_mz_range=None,
+    n_subdivisions_fine=10,
 ):
     """This function has been implemented to allow the paralellization of lookup tables processing.
     It computes and returns/saves the lookup tables for each slice. The output consists of:
@@ -219,9 +417,15 @@ def process_lookup_tables(
         maps m/z values to indexes in array_spectra for each pixel.
     - cumulated_image_lookup_table_high_res: np.nddaray of shape
         (size_spectrum // divider_lookup, image height, image_width), it maps m/z values to the
-        cumulated spectrum until the corresponding m/z value for each pixel.
+        cumulated spectrum until the corresponding m/z value for each pixel. If sparse_image_lookup
+        is True, its shape is (size_spectrum // divider_lookup, n_pixels_with_peaks) instead (see
+        build_sparse_cumulated_image_lookup_table()).
     - lookup_table_averaged_spectrum_high_res: np.nddaray of length size_spectrum, it maps m/z
         values to indexes in the averaged array_spectra for each pixel.
+    - fine_lookup_table_high_res and first_bin_fine (only saved if fine_lookup_mz_range is set):
+        np.ndarray of shape (n_bins, n_subdivisions_fine, m) refining
+        lookup_table_spectra_high_res in the requested m/z range, and index of its first bin (see
+        build_fine_index_lookup_table()).
     - array_peaks_corrected: A two-dimensional array containing the peak annotations (min peak,
         max peak, average value of the peak), sorted by min_mz, for the lipids that have
         been transformed.
@@ -244,6 +448,13 @@ def process_lookup_tables(
         save (bool, optional): If True, output arrays are saved in a npz file. Defaults to True.
         return_result (bool, optional): If True, output arrays are returned by the function.
             Defaults to False.
+        sparse_image_lookup (bool, optional): If True, the cumulated image lookup table only
+            contains the pixels with at least one peak. Defaults to False.
+        fine_lookup_mz_range (tuple(float), optional): If not None, the (lower, upper) m/z range in
+            which a fine lookup table is built. It should be restricted to the range of the
+            annotated lipids to keep its size under control. Defaults to None.
+        n_subdivisions_fine (int, optional): The number of subdivisions of each bin of the lookup
+            table in the fine lookup table. Defaults to 10.
 
     Returns:
         Depending on 'return result', returns either nothing, either several np.ndarrays, described
@@ -290,7 +501,9 @@ def process_lookup_tables(
     divider_lookup = DIVIDER_LOOKUP
 
     # Build lookup table linking mz value to index in array_spectra for each pixel
-    lookup_table_spectra_high_res = build_index_lookup_table(
+    lookup_table_spectra_high_res = select_numba_function(
+        build_index_lookup_table, build_index_lookup_table_parallel
+    )(
         array_spectra_high_res, array_pixel_indexes_high_res, divider_lookup
     )
     print(
@@ -299,10 +512,38 @@ def process_lookup_tables(
     )
     print("Shape of lookup_table_spectra_high_res: ", lookup_table_spectra_high_res.shape)
 
+    # Build lookup table refining the previous one in the requested m/z range
+    dic_fine_lookup = {}
+    if fine_lookup_mz_range is not None:
+        first_bin_fine = int(fine_lookup_mz_range[0] / divider_lookup)
+        dic_fine_lookup["first_bin_fine"] = first_bin_fine
+        dic_fine_lookup["fine_lookup_table_high_res"] = select_numba_function(
+            build_fine_index_lookup_table, build_fine_index_lookup_table_parallel
+        )(
+            array_spectra_high_res,
+            array_pixel_indexes_high_res,
+            lookup_table_spectra_high_res,
+            first_bin_fine,
+            int(np.ceil(fine_lookup_mz_range[1] / divider_lookup)) - first_bin_fine,
+            divider_lookup,
+            n_subdivisions_fine,
+        )
+        print(
+            "Size (in mb) of fine_lookup_table_high_res: ",
+            round(dic_fine_lookup["fine_lookup_table_high_res"].nbytes / 1024 / 1024, 2),
+        )
+
     # Build lookup table of the cumulated spectrum for each pixel
-    cumulated_image_lookup_table_high_res = build_cumulated_image_lookup_table(
-        array_spectra_high_res, array_pixel_indexes_high_res, image_shape, divider_lookup
-    )
+    if sparse_image_lookup:
+        cumulated_image_lookup_table_high_res = build_sparse_cumulated_image_lookup_table(
+            array_spectra_high_res, array_pixel_indexes_high_res, divider_lookup
+        )
+    else:
+        cumulated_image_lookup_table_high_res = select_numba_function(
+            build_cumulated_image_lookup_table, build_cumulated_image_lookup_table_parallel
+        )(
+            array_spectra_high_res, array_pixel_indexes_high_res, image_shape, divider_lookup
+        )
     print(
         "Size (in mb) of cumulated_image_lookup_table_high_res: ",
         round(cumulated_image_lookup_table_high_res.nbytes / 1024 / 1024, 2),
@@ -353,6 +594,7 @@ def process_lookup_tables(
             lookup_table_averaged_spectrum_high_res=lookup_table_averaged_spectrum_high_res,
             array_peaks_corrected=array_peaks_corrected,
             array_corrective_factors=array_corrective_factors,
+            **dic_fine_lookup,
         )
 
     # Returns all array if needed
@@ -13,10 +13,13 @@ import numpy as np
 from numba import njit
 import os
 import pandas as pd
+import pickle
+import lzma
 
 # LBAE imports
 from modules.tools.external_lib.mspec import SmzMLobj
 from modules.tools.spectra import reduce_resolution_sorted_array_spectra
+from modules.tools.columnar import save_columnar_arrays
 
 # Define if the app uses the whole dataset or not
 SAMPLE_APP = False
@@ -977,3 +980,23 @@ def process_raw_data(
             array_peaks_corrected,
             array_corrective_factors,
         )
+
+
+def convert_light_arrays_pickle(path_data, sample_data=False):
+    """This function converts the light_arrays.pickle file of a dataset (lzma-compressed for the
+    sampled dataset) into a columnar container, saved in the light_arrays folder of the dataset.
+    Once converted, the container is memory-mapped by MaldiData instead of loading the pickle file.
+
+    Args:
+        path_data (str): Path of the dataset, e.g. "data/whole_dataset/".
+        sample_data (bool, optional): If True, the pickle file is lzma-compressed, as for the
+            sampled dataset. Defaults to False.
+    """
+    if sample_data:
+        with lzma.open(os.path.join(path_data, "light_arrays.pickle"), "rb") as handle:
+            dic_lightweight = pickle.load(handle)
+    else:
+        with open(os.path.join(path_data, "light_arrays.pickle"), "rb") as handle:
+            dic_lightweight = pickle.load(handle)
+    print("Converting light arrays of " + str(len(dic_lightweight)) + " slices")
+    save_columnar_arrays(dic_lightweight, os.path.join(path_data, "light_arrays"))
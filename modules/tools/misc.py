@@ -9,9 +9,22 @@
 
 # Standard modules
 import os
+import fcntl
+import logging
 import shutil
+import threading
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
 import psutil
 
+# ==================================================================================================
+# --- Constants
+# ==================================================================================================
+
+# Time (in seconds) between two attempts to take a fcntl lock which is held by another process
+LOCK_POLL_INTERVAL = 0.005
+
 # ==================================================================================================
 # --- Functions
 # ==================================================================================================
@@ -45,3 +58,359 @@ def delete_all_files_in_folder(input_folder):
                 shutil.rmtree(file_path)
         except Exception as e:
             print("Failed to delete %s. Reason: %s" % (file_path, e))
+
+
+# ==================================================================================================
+# --- Classes
+# ==================================================================================================
+
+
+class LRUCache:
+    """A thread-safe least-recently-used cache whose capacity is measured in bytes rather than in
+    number of entries. Entries whose key starts with one of the pinned prefixes are never evicted
+    (but still count in the total size).
+
+    Attributes:
+        max_bytes (int): Maximum cumulated size (in bytes) of the entries that can be evicted.
+        l_pinned_prefixes (tuple): Prefixes of the keys which must never be evicted.
+        size (int): Current cumulated size (in bytes) of the evictable entries.
+        size_pinned (int): Current cumulated size (in bytes) of the pinned entries.
+        hits (int): Number of successful lookups.
+        misses (int): Number of unsuccessful lookups.
+        evictions (int): Number of entries evicted to free space.
+        _dic_entries (OrderedDict): Evictable entries, from least to most recently used.
+        _dic_pinned (dict): Pinned entries.
+        _lock (threading.Lock): Lock protecting the entries and counters.
+
+    Methods:
+        __init__(max_bytes, l_pinned_prefixes=()): Initializes the class LRUCache.
+        get(key, default=None): Returns the entry corresponding to key, or default.
+        set(key, value, size): Inserts an entry of a given size in the cache.
+        _remove(key): Removes an entry from the cache, assuming the lock is acquired.
+        invalidate(key): Removes an entry from the cache.
+        clear(): Removes all entries from the cache.
+        get_stats(): Returns the counters of the cache.
+    """
+
+    def __init__(self, max_bytes, l_pinned_prefixes=()):
+        """Initialize the class LRUCache.
+
+        Args:
+            max_bytes (int): Maximum cumulated size (in bytes) of the entries that can be evicted.
+            l_pinned_prefixes (tuple, optional): Prefixes of the keys which must never be evicted.
+                Defaults to ().
+        """
+        self.max_bytes = max_bytes
+        self.l_pinned_prefixes = tuple(l_pinned_prefixes)
+        self.size = 0
+        self.size_pinned = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._dic_entries = OrderedDict()
+        self._dic_pinned = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """This method returns the entry corresponding to key, and marks it as most recently used.
+
+        Args:
+            key (str): The key of the entry.
+            default (object, optional): Value returned if key is not in the cache. Defaults to None.
+
+        Returns:
+            (object): The value of the entry, or default if key is not in the cache.
+        """
+        with self._lock:
+            if key in self._dic_pinned:
+                self.hits += 1
+                return self._dic_pinned[key][0]
+            if key in self._dic_entries:
+                self._dic_entries.move_to_end(key)
+                self.hits += 1
+                return self._dic_entries[key][0]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, size):
+        """This method inserts an entry in the cache, evicting the least recently used entries if
+        needed. Entries bigger than the whole cache are not inserted.
+
+        Args:
+            key (str): The key of the entry.
+            value (object): The value of the entry.
+            size (int): The size (in bytes) of the entry.
+        """
+        with self._lock:
+            self._remove(key)
+            if key.startswith(self.l_pinned_prefixes):
+                self._dic_pinned[key] = (value, size)
+                self.size_pinned += size
+                return
+            if size > self.max_bytes:
+                return
+            self._dic_entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, size_evicted) = self._dic_entries.popitem(last=False)
+                self.size -= size_evicted
+                self.evictions += 1
+
+    def _remove(self, key):
+        """This method removes an entry from the cache. It assumes the lock is already acquired.
+
+        Args:
+            key (str): The key of the entry.
+        """
+        if key in self._dic_pinned:
+            self.size_pinned -= self._dic_pinned.pop(key)[1]
+        elif key in self._dic_entries:
+            self.size -= self._dic_entries.pop(key)[1]
+
+    def invalidate(self, key):
+        """This method removes an entry from the cache, if present.
+
+        Args:
+            key (str): The key of the entry.
+        """
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """This method removes all entries from the cache."""
+        with self._lock:
+            self._dic_entries.clear()
+            self._dic_pinned.clear()
+            self.size = 0
+            self.size_pinned = 0
+
+    def get_stats(self):
+        """This method returns the counters of the cache, e.g. for monitoring purposes.
+
+        Returns:
+            (dict): A dictionnary containing the number of entries, the size in bytes (evictable
+                and pinned), the capacity, and the number of hits, misses and evictions.
+        """
+        with self._lock:
+            return {
+                "n_entries": len(self._dic_entries) + len(self._dic_pinned),
+                "size": self.size,
+                "size_pinned": self.size_pinned,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class ReadWriteLock:
+    """A multi-readers/single-writer lock, which works across threads and processes (e.g. gunicorn
+    workers). Inside a process, readers and writers are coordinated with a threading.Condition,
+    which is cooperative when threading is monkey-patched by gevent. Across processes, each process
+    holds a shared fcntl lock on a file as long as it has readers, and writers take it exclusively.
+    fcntl locks are always requested without blocking, and retried after a (cooperative) sleep,
+    such that a gevent worker never stalls its hub. Writers have the priority: a writer waiting for
+    the lock first takes a gate lock, which prevents new readers from acquiring the lock, in all
+    processes. The number of active readers and writers of the current process, and the time spent
+    waiting for the lock, are recorded. The lock is not reentrant.
+
+    Attributes:
+        path_lock (str): Path of the file locked by the processes having readers, and by writers.
+        path_gate (str): Path of the file locked by writers to block new readers.
+        n_readers (int): Current number of readers holding the lock in the current process.
+        n_writers (int): Current number of writers holding the lock in the current process.
+        dic_stats (dict): For "read" and "write", the number of acquisitions, and the total and
+            maximum time (in seconds) spent waiting for the lock.
+        _condition (threading.Condition): Condition coordinating the readers and writers of the
+            current process, and protecting the counters.
+        _n_waiting_writers (int): Number of writers of the current process waiting for the lock.
+        _fd_read (int): File descriptor holding the shared lock of the current process, if it has
+            readers.
+        _fd_gate_probe (int): File descriptor used to check that no writer waits for the lock.
+        _pid_gate_probe (int): Process id for which _fd_gate_probe was opened.
+
+    Methods:
+        __init__(path_lock): Initializes the class ReadWriteLock.
+        _acquire(path, operation): Opens a file and locks it, returning the file descriptor.
+        _release(fd): Unlocks and closes a file descriptor.
+        _gate_is_open(): Checks that no writer holds the gate lock.
+        _record(mode, wait): Updates the counters after an acquisition.
+        read_lock(): Context manager acquiring the lock for reading.
+        write_lock(): Context manager acquiring the lock for writing.
+        get_stats(): Returns the counters of the lock.
+    """
+
+    def __init__(self, path_lock):
+        """Initialize the class ReadWriteLock.
+
+        Args:
+            path_lock (str): Path of the lock file. It must be the same for all the processes that
+                share the lock. The gate file is created alongside.
+        """
+        self.path_lock = path_lock
+        self.path_gate = path_lock + ".gate"
+        self.n_readers = 0
+        self.n_writers = 0
+        self.dic_stats = {
+            mode: {"n_acquisitions": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for mode in ["read", "write"]
+        }
+        self._condition = threading.Condition()
+        self._n_waiting_writers = 0
+        self._fd_read = None
+        self._fd_gate_probe = None
+        self._pid_gate_probe = None
+
+    def _acquire(self, path, operation):
+        """This method opens a file (creating it if needed) and locks it. The lock is requested
+        without blocking, and the request is retried after a sleep until it succeeds.
+
+        Args:
+            path (str): Path of the file to lock.
+            operation (int): fcntl.LOCK_SH or fcntl.LOCK_EX.
+
+        Returns:
+            (int): The file descriptor holding the lock.
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    time.sleep(LOCK_POLL_INTERVAL)
+        except BaseException:
+            os.close(fd)
+            raise
+
+    def _release(self, fd):
+        """This method unlocks and closes a file descriptor returned by _acquire().
+
+        Args:
+            fd (int): The file descriptor.
+        """
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _gate_is_open(self):
+        """This method checks, without blocking, that no writer (of any process) holds the gate
+        lock. The file descriptor used for the check is opened once per process.
+
+        Returns:
+            (bool): True if no writer holds the gate lock.
+        """
+        if self._pid_gate_probe != os.getpid():
+            self._fd_gate_probe = os.open(self.path_gate, os.O_RDWR | os.O_CREAT, 0o666)
+            self._pid_gate_probe = os.getpid()
+        try:
+            fcntl.flock(self._fd_gate_probe, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        fcntl.flock(self._fd_gate_probe, fcntl.LOCK_UN)
+        return True
+
+    def _record(self, mode, wait):
+        """This method updates the counters after an acquisition. _condition must be held when
+        calling this function.
+
+        Args:
+            mode (str): "read" or "write".
+            wait (float): Time (in seconds) spent waiting for the lock.
+        """
+        if mode == "read":
+            self.n_readers += 1
+        else:
+            self.n_writers += 1
+        dic_stats = self.dic_stats[mode]
+        dic_stats["n_acquisitions"] += 1
+        dic_stats["wait_total"] += wait
+        dic_stats["wait_max"] = max(dic_stats["wait_max"], wait)
+        if wait > 0.1:
+            logging.info("Waited " + "{:.2f}".format(wait) + "s for the " + mode + " lock")
+
+    @contextmanager
+    def read_lock(self):
+        """This method is a context manager which acquires the lock for reading. Several readers
+        can hold the lock at the same time, but not while a writer holds or waits for it. Only the
+        first reader of the process takes the shared lock on the file, the other ones simply check
+        that no writer of another process waits for it."""
+        t0 = time.perf_counter()
+        while True:
+            with self._condition:
+                while self.n_writers > 0 or self._n_waiting_writers > 0:
+                    self._condition.wait()
+                if self.n_readers == 0:
+                    # Wait for the writers of the other processes to be done, then take a shared
+                    # lock for the whole process. No other reader of the process can be waiting
+                    # for a release meanwhile
+                    fd_gate = self._acquire(self.path_gate, fcntl.LOCK_SH)
+                    try:
+                        self._fd_read = self._acquire(self.path_lock, fcntl.LOCK_SH)
+                    finally:
+                        self._release(fd_gate)
+                    self._record("read", time.perf_counter() - t0)
+                    break
+                elif self._gate_is_open():
+                    self._record("read", time.perf_counter() - t0)
+                    break
+
+            # A writer of another process is waiting: let the readers of the process release the
+            # shared lock
+            time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.n_readers -= 1
+                if self.n_readers == 0:
+                    self._release(self._fd_read)
+                    self._fd_read = None
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write_lock(self):
+        """This method is a context manager which acquires the lock for writing, i.e. exclusively.
+        New readers are blocked as soon as the writer starts waiting."""
+        t0 = time.perf_counter()
+        with self._condition:
+            self._n_waiting_writers += 1
+            try:
+                while self.n_readers > 0 or self.n_writers > 0:
+                    self._condition.wait()
+                fd_gate = self._acquire(self.path_gate, fcntl.LOCK_EX)
+                try:
+                    fd = self._acquire(self.path_lock, fcntl.LOCK_EX)
+                except BaseException:
+                    self._release(fd_gate)
+                    raise
+            finally:
+                self._n_waiting_writers -= 1
+            self._record("write", time.perf_counter() - t0)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.n_writers -= 1
+                self._release(fd)
+                self._release(fd_gate)
+                self._condition.notify_all()
+
+    def get_stats(self):
+        """This method returns the counters of the lock, e.g. to monitor contention.
+
+        Returns:
+            (dict): A dictionnary containing the current number of readers and writers of the
+                current process, and, for "read" and "write", the number of acquisitions and the
+                total, maximum and average time (in seconds) spent waiting for the lock.
+        """
+        with self._condition:
+            dic_stats = {"n_readers": self.n_readers, "n_writers": self.n_writers}
+            for mode, dic_stats_mode in self.dic_stats.items():
+                dic_stats[mode] = dict(dic_stats_mode)
+                dic_stats[mode]["wait_average"] = dic_stats_mode["wait_total"] / max(
+                    1, dic_stats_mode["n_acquisitions"]
+                )
+        return dic_stats
@@ -0,0 +1,193 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+"""In this module, functions used to distribute long precomputations over a pool of processes are
+defined."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import logging
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numba
+
+# LBAE imports
+from modules.tools.misc import logmem
+
+# ==================================================================================================
+# --- Constants
+# ==================================================================================================
+
+# Number of threads used by the numba functions compiled with parallel=True. It can be set with the
+# LBAE_NUMBA_THREADS environment variable, or with set_numba_threads(). Defaults to 1 (i.e. the
+# serial versions of the functions are used), as the app already serves concurrent requests in
+# several threads.
+N_THREADS_NUMBA = max(
+    1, min(int(os.environ.get("LBAE_NUMBA_THREADS", 1)), numba.config.NUMBA_NUM_THREADS)
+)
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def set_numba_threads(n_threads):
+    """This function sets the number of threads used by the numba functions compiled with
+    parallel=True. It can't be higher than the number of threads numba has been started with.
+
+    Args:
+        n_threads (int): The number of threads. If 1, the serial versions of the functions are used.
+
+    Returns:
+        (int): The number of threads actually set.
+    """
+    global N_THREADS_NUMBA
+    N_THREADS_NUMBA = max(1, min(n_threads, numba.config.NUMBA_NUM_THREADS))
+    return N_THREADS_NUMBA
+
+
+def select_numba_function(function, function_parallel):
+    """This function returns the version of a numba function (serial or parallel) to use according
+    to N_THREADS_NUMBA. Since the number of threads used by numba is specific to each thread, it is
+    set for the calling thread when the parallel version is returned.
+
+    Args:
+        function (func): The serial version of the function.
+        function_parallel (func): The version of the function compiled with parallel=True.
+
+    Returns:
+        (func): The function to use.
+    """
+    if N_THREADS_NUMBA > 1:
+        numba.set_num_threads(N_THREADS_NUMBA)
+        return function_parallel
+    return function
+
+
+def format_duration(duration):
+    """This function formats a duration in seconds as a string of hours, minutes and seconds.
+
+    Args:
+        duration (float): The duration, in seconds.
+
+    Returns:
+        (str): The formatted duration, e.g. '1h02m03s'.
+    """
+    duration = int(round(duration))
+    return (
+        str(duration // 3600)
+        + "h"
+        + str(duration // 60 % 60).zfill(2)
+        + "m"
+        + str(duration % 60).zfill(2)
+        + "s"
+    )
+
+
+def run_tasks_in_parallel(
+    worker_function,
+    l_tasks,
+    callback,
+    n_workers=None,
+    initializer=None,
+    initargs=(),
+    name="tasks",
+    log_interval=30.0,
+):
+    """This function executes worker_function(*task) for each task of l_tasks in a pool of forked
+    processes, and calls callback(task, result) in the main process each time a task is completed.
+    Since the callback is only executed in the main process, it can safely be used to write the
+    results in the database. The number of tasks submitted at once is bounded, to keep the memory
+    usage under control. Throughput and estimated remaining time are logged regularly.
+
+    Args:
+        worker_function (func): The (module-level) function executed by the workers.
+        l_tasks (list(tuple)): The list of arguments of worker_function for each task.
+        callback (func): The function called in the main process with each task and its result.
+        n_workers (int, optional): The number of processes to use. If None, all cores are used.
+            If 1, the tasks are executed in the main process. Defaults to None.
+        initializer (func, optional): A function called at the start of each worker process.
+            Defaults to None.
+        initargs (tuple, optional): The arguments of initializer. Defaults to ().
+        name (str, optional): The name of the tasks, used for logging. Defaults to "tasks".
+        log_interval (float, optional): The minimum time (in seconds) between two progress logs.
+            Defaults to 30.0.
+    """
+    n_tasks = len(l_tasks)
+    if n_tasks == 0:
+        return
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = max(1, min(n_workers, n_tasks))
+    logging.info(
+        "Starting " + str(n_tasks) + " " + name + " with " + str(n_workers) + " workers" + logmem()
+    )
+
+    t_start = time.time()
+    t_last_log = t_start
+    n_done = 0
+
+    def log_progress(force=False):
+        nonlocal t_last_log
+        t_now = time.time()
+        if force or t_now - t_last_log >= log_interval:
+            t_last_log = t_now
+            throughput = n_done / max(t_now - t_start, 1e-9)
+            logging.info(
+                str(n_done)
+                + "/"
+                + str(n_tasks)
+                + " "
+                + name
+                + " done, "
+                + "{:.2f}".format(throughput)
+                + " "
+                + name
+                + "/s, ETA "
+                + format_duration((n_tasks - n_done) / max(throughput, 1e-9))
+                + logmem()
+            )
+
+    # Execute the tasks in the main process if only one worker is requested
+    if n_workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for task in l_tasks:
+            callback(task, worker_function(*task))
+            n_done += 1
+            log_progress()
+        log_progress(force=True)
+        return
+
+    # Otherwise, use a pool of forked processes, which inherit the memory of the main process
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=initializer,
+        initargs=initargs,
+    ) as executor:
+        iterator_tasks = iter(l_tasks)
+        dic_pending = {}
+
+        def submit_next():
+            task = next(iterator_tasks, None)
+            if task is not None:
+                dic_pending[executor.submit(worker_function, *task)] = task
+
+        for _ in range(2 * n_workers):
+            submit_next()
+
+        while len(dic_pending) > 0:
+            set_done, _ = wait(dic_pending, return_when=FIRST_COMPLETED)
+            for future in set_done:
+                task = dic_pending.pop(future)
+                callback(task, future.result())
+                n_done += 1
+                submit_next()
+            log_progress()
+    log_progress(force=True)
@@ -10,11 +10,14 @@ lipid annotation, for of a given slice) are defined.
 # ==================================================================================================
 
 # Standard modules
-import time
 import numpy as np
-from numba import njit
+from numba import njit, prange
 import logging
 from typing import Tuple
+from contextlib import nullcontext
+
+# LBAE imports
+from modules.tools.parallel import select_numba_function
 
 # ==================================================================================================
 # --- Functions for coordinates indices manipulation
@@ -198,12 +201,15 @@ def compute_image_using_index_lookup(
     array_peaks_transformed_lipids,
     array_corrective_factors,
     apply_transform,
+    lookup_table_fine,
+    first_bin_fine,
 ):
     """For each pixel, this function extracts from array_spectra the intensity of a given m/z
     selection (normally corresponding to a lipid annotation) defined by a lower and a higher bound.
-    For faster computation, it uses lookup_table_spectra to map m/z values to given indices. It then
-    assigns the pixel intensity to an array of shape img_shape, therefore producing an image
-    representing the requested lipid distribution.
+    For faster computation, it uses lookup_table_spectra to map m/z values to given indices, refined
+    with lookup_table_fine if the lower bound is in its m/z range. It then assigns the pixel
+    intensity to an array of shape img_shape, therefore producing an image representing the
+    requested lipid distribution.
 
     Args:
         low_bound (float): Lower m/z value for the annotation.
@@ -225,6 +231,10 @@ def compute_image_using_index_lookup(
             MAIA corrective factor used for lipid (first dimension) and each pixel (second and third
             dimension).
         apply_transform (bool): If True, the MAIA correction for pixel intensity is reverted.
+        lookup_table_fine (np.ndarray): An array of shape (n_bins, n_subdivisions, m) refining
+            lookup_table_spectra (see build_fine_index_lookup_table()). It can be empty.
+        first_bin_fine (int): The index, in lookup_table_spectra, of the first bin of
+            lookup_table_fine.
 
     Returns:
         (np.ndarray): An array of shape img_shape (reprensenting an image) containing the cumulated
@@ -249,14 +259,22 @@ def compute_image_using_index_lookup(
         if idx_lipid_right != -1:
             array_corrective_factors_lipid[:] = array_corrective_factors[idx_lipid_right].flatten()
 
-    # Find lower bound and add from there
-    for idx_pix in range(array_pixel_indexes.shape[0]):
+    # Find lower bound and add from there. Each pixel is written independently, so the loop can be
+    # run in parallel
+    for idx_pix in prange(array_pixel_indexes.shape[0]):
         # If pixel contains no peak, skip it
         if array_pixel_indexes[idx_pix, 0] == -1:
             continue
 
         # Compute range in which values must be summed and extract corresponding part of spectrum
-        lower_bound = lookup_table_spectra[int(low_bound / divider_lookup)][idx_pix]
+        lower_bound = _return_lower_index(
+            low_bound,
+            idx_pix,
+            lookup_table_spectra,
+            lookup_table_fine,
+            first_bin_fine,
+            divider_lookup,
+        )
         higher_bound = lookup_table_spectra[int(np.ceil(high_bound / divider_lookup))][idx_pix]
         array_to_sum = array_spectra[:, lower_bound : higher_bound + 1]
 
@@ -267,7 +285,7 @@ def compute_image_using_index_lookup(
             correction = array_corrective_factors_lipid[idx_pix]
 
         # Sum the m/z values over the requested range
-        image = _fill_image(
+        _fill_image(
             image,
             idx_pix,
             img_shape,
@@ -282,6 +300,36 @@ def compute_image_using_index_lookup(
     return image
 
 
+# Multithreaded version, see select_numba_function()
+compute_image_using_index_lookup_parallel = njit(parallel=True)(
+    compute_image_using_index_lookup.py_func
+)
+
+
+@njit
+def _return_lower_index(
+    low_bound, idx_pix, lookup_table_spectra, lookup_table_fine, first_bin_fine, divider_lookup
+):
+    """This internal function returns, for the pixel idx_pix, an index of array_spectra such that
+    all the previous peaks of the pixel are below low_bound. It's given by lookup_table_spectra,
+    and moved forward with lookup_table_fine if low_bound is in its m/z range."""
+    idx_bin = int(low_bound / divider_lookup)
+    lower_index = lookup_table_spectra[idx_bin, idx_pix]
+    idx_bin_fine = idx_bin - first_bin_fine
+    if idx_bin_fine >= 0 and idx_bin_fine < lookup_table_fine.shape[0]:
+        n_subdivisions = lookup_table_fine.shape[1]
+        idx_subdivision = min(
+            int((low_bound / divider_lookup - idx_bin) * n_subdivisions), n_subdivisions - 1
+        )
+
+        # Make sure that rounding errors can't skip peaks above low_bound
+        if (idx_bin + idx_subdivision / n_subdivisions) * divider_lookup > low_bound:
+            idx_subdivision -= 1
+        if idx_subdivision > 0:
+            lower_index += lookup_table_fine[idx_bin_fine, idx_subdivision, idx_pix]
+    return lower_index
+
+
 @njit
 def _fill_image(
     image,
@@ -323,6 +371,8 @@ def compute_image_using_index_and_image_lookup(
     array_peaks_transformed_lipids,
     array_corrective_factors,
     apply_transform=False,
+    lookup_table_fine=None,
+    first_bin_fine=0,
 ):
     """This function is very much similar to compute_image_using_index_lookup, except that it uses a
     different lookup table: lookup_table_image. This lookup table contains the cumulated intensities
@@ -347,10 +397,12 @@ def compute_image_using_index_and_image_lookup(
         lookup_table_spectra (np.ndarray): An array of shape (k,m) representing a
             lookup table with the following mapping: lookup_table_spectra[i,j] contains the first
             m/z index of pixel j such that m/z >= i * divider_lookup.
-        lookup_table_image (np.ndarray): An array of shape (k,m) representing a
-            lookup table with the following mapping: lookup_table_image[i,j] contains, for the pixel
-            of index j, the cumulated intensities from the lowest possible m/z until the first m/z
-            such that m/z >= i * divider_lookup.
+        lookup_table_image (np.ndarray): An array of shape (k, height, width) representing a
+            lookup table with the following mapping: lookup_table_image[i,x,y] contains, for the
+            pixel of coordinates (x,y), the cumulated intensities from the lowest possible m/z until
+            the first m/z such that m/z >= i * divider_lookup. The sparse version of the table, of
+            shape (k, n_pixels_with_peaks), can also be used (see
+            build_sparse_cumulated_image_lookup_table()).
         divider_lookup (int): Integer used to set the resolution when building the lookup table.
         array_peaks_transformed_lipids (np.ndarray): A two-dimensional numpy array, which contains
             the peak annotations (min peak, max peak, average value of the peak), sorted by min_mz,
@@ -360,6 +412,11 @@ def compute_image_using_index_and_image_lookup(
             dimension).
         apply_transform (bool): If True, the MAIA correction for pixel intensity is applied.
             Defaults to False.
+        lookup_table_fine (np.ndarray, optional): An array of shape (n_bins, n_subdivisions, m)
+            refining lookup_table_spectra for narrow selections (see
+            build_fine_index_lookup_table()). Defaults to None.
+        first_bin_fine (int, optional): The index, in lookup_table_spectra, of the first bin of
+            lookup_table_fine. Defaults to 0.
 
     Returns:
         (np.ndarray): An array of shape img_shape (reprensenting an image) containing the cumulated
@@ -369,7 +426,9 @@ def compute_image_using_index_and_image_lookup(
     # Image lookup table is not worth it for small differences between the bounds
     # And image lookup can't be used if the transformation should not be applied
     if (high_bound - low_bound) < 5 or apply_transform:
-        return compute_image_using_index_lookup(
+        return select_numba_function(
+            compute_image_using_index_lookup, compute_image_using_index_lookup_parallel
+        )(
             low_bound,
             high_bound,
             array_spectra,
@@ -380,10 +439,18 @@ def compute_image_using_index_and_image_lookup(
             array_peaks_transformed_lipids,
             array_corrective_factors,
             apply_transform,
+            _return_lookup_table_fine(lookup_table_fine),
+            first_bin_fine,
         )
 
     else:
-        return _compute_image_using_index_and_image_lookup_partial(
+        lookup_table_image, array_lookup_image_columns = _flatten_image_lookup_table(
+            lookup_table_image, array_pixel_indexes
+        )
+        return select_numba_function(
+            _compute_image_using_index_and_image_lookup_partial,
+            _compute_image_using_index_and_image_lookup_partial_parallel,
+        )(
             low_bound,
             high_bound,
             array_spectra,
@@ -391,10 +458,48 @@ def compute_image_using_index_and_image_lookup(
             img_shape,
             lookup_table_spectra,
             lookup_table_image,
+            array_lookup_image_columns,
             divider_lookup,
         )
 
 
+def return_lookup_image_columns(array_pixel_indexes):
+    """This function returns, for each pixel, the column of the sparse image lookup table (see
+    build_sparse_cumulated_image_lookup_table()) in which its cumulated intensities are stored, i.e.
+    its rank among the pixels which contain at least one peak. Pixels without peaks get the column
+    of the previous pixel with peaks (or -1), but they are never looked up.
+
+    Args:
+        array_pixel_indexes (np.ndarray): An array of shape (m,2) containing the boundary indices of
+            each pixel in array_spectra.
+
+    Returns:
+        (np.ndarray): An array of length m containing the column of each pixel.
+    """
+    return (np.cumsum(np.asarray(array_pixel_indexes)[:, 0] != -1) - 1).astype(np.int32)
+
+
+def _return_lookup_table_fine(lookup_table_fine):
+    """This internal function returns lookup_table_fine, or an empty table if it's None, such that
+    the numba functions always get the same array type."""
+    if lookup_table_fine is None:
+        return np.zeros((0, 1, 1), dtype=np.uint8)
+    return lookup_table_fine
+
+
+def _flatten_image_lookup_table(lookup_table_image, array_pixel_indexes):
+    """This internal function returns the image lookup table as a two-dimensional array of shape
+    (k, n_columns), along with the column of each pixel in this array, such that the numba
+    functions can read both the dense (k, height, width) and the sparse (k, n_pixels_with_peaks)
+    versions of the table."""
+    if lookup_table_image.ndim == 3:
+        return (
+            lookup_table_image.reshape(lookup_table_image.shape[0], -1),
+            np.arange(array_pixel_indexes.shape[0], dtype=np.int32),
+        )
+    return lookup_table_image, return_lookup_image_columns(array_pixel_indexes)
+
+
 @njit
 def _compute_image_using_index_and_image_lookup_partial(
     low_bound,
@@ -404,35 +509,30 @@ def _compute_image_using_index_and_image_lookup_partial(
     img_shape,
     lookup_table_spectra,
     lookup_table_image,
+    array_lookup_image_columns,
     divider_lookup,
 ):
     """This internal function is wrapped by compute_image_using_index_and_image_lookup(). It is used
     as a slower, memory-optimized, option, when the slice data must be manually extracted from a
-    memory-mapped array. Please consult the documentation of
+    memory-mapped array. lookup_table_image is the two-dimensional version of the table returned by
+    _flatten_image_lookup_table(). Please consult the documentation of
     compute_image_using_index_and_image_lookup() for more information.
     """
-    # Get a first approximate of the requested lipid image
-    image = (
-        lookup_table_image[int(high_bound / divider_lookup)]
-        - lookup_table_image[int(low_bound / divider_lookup)]
-    )  # Normalization should be useless here as the spectrum is already normalized
+    image = np.zeros((img_shape[0], img_shape[1]), dtype=np.float32)
+    idx_lookup_low_bound = int(low_bound / divider_lookup)
+    idx_lookup_high_bound = int(high_bound / divider_lookup)
 
     # Look for true lower/higher bound between the lower/higher looked up image and the next one
     array_idx_low_bound_inf_pix = lookup_table_spectra[int(low_bound / divider_lookup)]
     array_idx_low_bound_sup_pix = lookup_table_spectra[int(np.ceil(low_bound / divider_lookup))]
     array_idx_high_bound_inf_pix = lookup_table_spectra[int(high_bound / divider_lookup)]
     array_idx_high_bound_sup_pix = lookup_table_spectra[int(np.ceil(high_bound / divider_lookup))]
-    for (
-        idx_pix,
-        (idx_low_bound_inf, idx_low_bound_sup, idx_high_bound_inf, idx_high_bound_sup),
-    ) in enumerate(
-        zip(
-            array_idx_low_bound_inf_pix,
-            array_idx_low_bound_sup_pix,
-            array_idx_high_bound_inf_pix,
-            array_idx_high_bound_sup_pix,
-        )
-    ):
+    for idx_pix in prange(array_idx_low_bound_inf_pix.shape[0]):
+        idx_low_bound_inf = array_idx_low_bound_inf_pix[idx_pix]
+        idx_low_bound_sup = array_idx_low_bound_sup_pix[idx_pix]
+        idx_high_bound_inf = array_idx_high_bound_inf_pix[idx_pix]
+        idx_high_bound_sup = array_idx_high_bound_sup_pix[idx_pix]
+
         # Extract array from mmap
         array_to_sum_lb = array_spectra[:, idx_low_bound_inf : idx_low_bound_sup + 1]
         array_to_sum_hb = array_spectra[:, idx_high_bound_inf : idx_high_bound_sup + 1]
@@ -441,8 +541,16 @@ def _compute_image_using_index_and_image_lookup_partial(
         if array_pixel_indexes[idx_pix, 0] == -1:
             continue
 
+        # Get a first approximate of the requested lipid image. Normalization should be useless
+        # here as the spectrum is already normalized
+        idx_column = array_lookup_image_columns[idx_pix]
+        image[convert_spectrum_idx_to_coor(idx_pix, img_shape)] = (
+            lookup_table_image[idx_lookup_high_bound, idx_column]
+            - lookup_table_image[idx_lookup_low_bound, idx_column]
+        )
+
         # Correct the image coming from lookup
-        image = _correct_image(
+        _correct_image(
             image,
             idx_pix,
             img_shape,
@@ -456,6 +564,12 @@ def _compute_image_using_index_and_image_lookup_partial(
     return image
 
 
+# Multithreaded version, see select_numba_function()
+_compute_image_using_index_and_image_lookup_partial_parallel = njit(parallel=True)(
+    _compute_image_using_index_and_image_lookup_partial.py_func
+)
+
+
 @njit
 def _correct_image(
     image,
@@ -496,6 +610,227 @@ def _correct_image(
     return image
 
 
+@njit
+def _find_transformed_lipids(array_bounds, array_peaks_transformed_lipids):
+    """This internal function returns, for each pair of bounds in array_bounds, the index of the
+    transformed lipid annotation containing it (as in compute_image_using_index_lookup()), or -1 if
+    there's none."""
+    array_idx_lipids = np.full(array_bounds.shape[0], -1, dtype=np.int32)
+    for idx_bound in range(array_bounds.shape[0]):
+        low_bound, high_bound = array_bounds[idx_bound]
+        for idx_lipid, (min_mz, max_mz, avg_mz) in enumerate(array_peaks_transformed_lipids):
+            # Take 10**-4 for precision
+            if (low_bound + 10**-4) >= min_mz and (high_bound - 10**-4) <= max_mz:
+                array_idx_lipids[idx_bound] = idx_lipid
+                break
+    return array_idx_lipids
+
+
+@njit
+def _compute_images_using_index_and_image_lookup_batch(
+    array_bounds,
+    array_order,
+    array_use_image_lookup,
+    array_idx_lipids,
+    array_spectra,
+    array_pixel_indexes,
+    img_shape,
+    lookup_table_spectra,
+    lookup_table_image,
+    array_lookup_image_columns,
+    divider_lookup,
+    array_corrective_factors,
+    lookup_table_fine,
+    first_bin_fine,
+):
+    """This internal function is wrapped by compute_images_using_index_and_image_lookup_batch().
+    Please consult the documentation of the latter for more information. The pairs of bounds are
+    browsed according to array_order, i.e. by increasing lower bound, such that the spectrum of each
+    pixel is swept only once for all selections which don't use the image lookup. lookup_table_image
+    is the two-dimensional version of the table returned by _flatten_image_lookup_table().
+    """
+    images = np.zeros((array_bounds.shape[0], img_shape[0], img_shape[1]), dtype=np.float32)
+    for idx_pix in prange(array_pixel_indexes.shape[0]):
+        # If pixel contains no peak, skip it
+        if array_pixel_indexes[idx_pix, 0] == -1:
+            continue
+        x, y = convert_spectrum_idx_to_coor(idx_pix, img_shape)
+
+        # Index of the first peak above the lower bound of the previous selection
+        idx_sweep = 0
+        for idx_bound in array_order:
+            low_bound, high_bound = array_bounds[idx_bound]
+            if array_use_image_lookup[idx_bound]:
+                # Approximate the image with the lookup, and correct it
+                images[idx_bound, x, y] = (
+                    lookup_table_image[
+                        int(high_bound / divider_lookup), array_lookup_image_columns[idx_pix]
+                    ]
+                    - lookup_table_image[
+                        int(low_bound / divider_lookup), array_lookup_image_columns[idx_pix]
+                    ]
+                )
+                idx_low_bound_inf = lookup_table_spectra[int(low_bound / divider_lookup), idx_pix]
+                idx_low_bound_sup = lookup_table_spectra[
+                    int(np.ceil(low_bound / divider_lookup)), idx_pix
+                ]
+                idx_high_bound_inf = lookup_table_spectra[int(high_bound / divider_lookup), idx_pix]
+                idx_high_bound_sup = lookup_table_spectra[
+                    int(np.ceil(high_bound / divider_lookup)), idx_pix
+                ]
+                _correct_image(
+                    images[idx_bound],
+                    idx_pix,
+                    img_shape,
+                    array_spectra[:, idx_low_bound_inf : idx_low_bound_sup + 1],
+                    array_spectra[:, idx_high_bound_inf : idx_high_bound_sup + 1],
+                    low_bound,
+                    high_bound,
+                    divider_lookup,
+                )
+                continue
+
+            # Apply MAIA correction
+            correction = 1.0
+            if array_idx_lipids[idx_bound] != -1:
+                if array_corrective_factors[array_idx_lipids[idx_bound], x, y] != 0:
+                    correction = array_corrective_factors[array_idx_lipids[idx_bound], x, y]
+
+            # Resume the sweep from the previous selection, as lower bounds are sorted
+            lower_bound = _return_lower_index(
+                low_bound,
+                idx_pix,
+                lookup_table_spectra,
+                lookup_table_fine,
+                first_bin_fine,
+                divider_lookup,
+            )
+            higher_bound = min(
+                lookup_table_spectra[int(np.ceil(high_bound / divider_lookup)), idx_pix],
+                array_spectra.shape[1] - 1,
+            )
+            i = max(lower_bound, idx_sweep)
+            while i <= higher_bound and array_spectra[0, i] < low_bound:
+                i += 1
+            idx_sweep = i
+
+            # Sum the m/z values over the requested range
+            while i <= higher_bound and array_spectra[0, i] <= high_bound:
+                if array_spectra[0, i] >= low_bound:
+                    images[idx_bound, x, y] += array_spectra[1, i] * correction
+                i += 1
+
+    return images
+
+
+# Multithreaded version, see select_numba_function()
+_compute_images_using_index_and_image_lookup_batch_parallel = njit(parallel=True)(
+    _compute_images_using_index_and_image_lookup_batch.py_func
+)
+
+
+def compute_images_using_index_and_image_lookup_batch(
+    array_bounds,
+    array_spectra,
+    array_pixel_indexes,
+    img_shape,
+    lookup_table_spectra,
+    lookup_table_image,
+    divider_lookup,
+    array_peaks_transformed_lipids,
+    array_corrective_factors,
+    apply_transform=False,
+    lookup_table_fine=None,
+    first_bin_fine=0,
+):
+    """This function is the batched version of compute_image_using_index_and_image_lookup(), i.e. it
+    computes the images of several m/z selections at once. Instead of browsing all pixels once per
+    selection, all pixels are browsed only once, and the spectrum of each pixel is swept by
+    increasing m/z for all the requested selections. As in the non-batched version, the image lookup
+    table is used for wide selections when no MAIA transform is applied.
+
+    Args:
+        array_bounds (np.ndarray): An array of shape (n_selections, 2) containing the lower and
+            higher m/z bounds of each selection.
+        array_spectra (np.ndarray): An array of shape (2,n) containing spectrum
+            data (m/z and intensity) for each pixel.
+        array_pixel_indexes (np.ndarray): An array of shape (m,2) containing the boundary indices of
+            each pixel in array_spectra.
+        img_shape (tuple(int)): A tuple with the two integer values corresponding to height and
+            width of the current slice acquisition.
+        lookup_table_spectra (np.ndarray): An array of shape (k,m) representing a
+            lookup table with the following mapping: lookup_table_spectra[i,j] contains the first
+            m/z index of pixel j such that m/z >= i * divider_lookup.
+        lookup_table_image (np.ndarray): An array of shape (k, height, width) representing a
+            lookup table with the following mapping: lookup_table_image[i,x,y] contains, for the
+            pixel of coordinates (x,y), the cumulated intensities from the lowest possible m/z until
+            the first m/z such that m/z >= i * divider_lookup. As in
+            compute_image_using_index_and_image_lookup(), the sparse version can also be used.
+        divider_lookup (int): Integer used to set the resolution when building the lookup table.
+        array_peaks_transformed_lipids (np.ndarray): A two-dimensional numpy array, which contains
+            the peak annotations (min peak, max peak, average value of the peak), sorted by min_mz,
+            for the lipids that have been transformed.
+        array_corrective_factors (np.ndarray): A three-dimensional numpy array, which contains the
+            MAIA corrective factor used for lipid (first dimension) and each pixel (second and third
+            dimension). It can be of any float type, as only the rows corresponding to the requested
+            lipids are converted.
+        apply_transform (bool): If True, the MAIA correction for pixel intensity is applied.
+            Defaults to False.
+        lookup_table_fine (np.ndarray, optional): An array of shape (n_bins, n_subdivisions, m)
+            refining lookup_table_spectra for narrow selections (see
+            build_fine_index_lookup_table()). Defaults to None.
+        first_bin_fine (int, optional): The index, in lookup_table_spectra, of the first bin of
+            lookup_table_fine. Defaults to 0.
+
+    Returns:
+        (np.ndarray): An array of shape (n_selections, img_shape[0], img_shape[1]) containing, for
+            each selection, the image of the cumulated intensity of the spectra between the
+            corresponding bounds.
+    """
+    array_bounds = np.asarray(array_bounds, dtype=np.float64).reshape(-1, 2)
+
+    # Same rule as in compute_image_using_index_and_image_lookup()
+    array_use_image_lookup = ((array_bounds[:, 1] - array_bounds[:, 0]) >= 5) & (
+        not apply_transform
+    )
+    # Only convert the corrective factors of the lipids actually requested to float32, instead of
+    # the whole (possibly memory-mapped) array
+    if apply_transform:
+        array_idx_lipids = _find_transformed_lipids(array_bounds, array_peaks_transformed_lipids)
+        array_idx_requested, array_idx_lipids = np.unique(array_idx_lipids, return_inverse=True)
+        array_idx_lipids = (array_idx_lipids - int(array_idx_requested[0] == -1)).astype(np.int32)
+        array_corrective_factors = np.asarray(
+            array_corrective_factors[array_idx_requested[array_idx_requested != -1]],
+            dtype=np.float32,
+        )
+    else:
+        array_idx_lipids = np.full(array_bounds.shape[0], -1, dtype=np.int32)
+        array_corrective_factors = np.zeros((0, 1, 1), dtype=np.float32)
+    lookup_table_image, array_lookup_image_columns = _flatten_image_lookup_table(
+        lookup_table_image, array_pixel_indexes
+    )
+
+    return select_numba_function(
+        _compute_images_using_index_and_image_lookup_batch,
+        _compute_images_using_index_and_image_lookup_batch_parallel,
+    )(
+        array_bounds,
+        np.argsort(array_bounds[:, 0], kind="stable"),
+        array_use_image_lookup,
+        array_idx_lipids,
+        array_spectra,
+        array_pixel_indexes,
+        img_shape,
+        lookup_table_spectra,
+        lookup_table_image,
+        array_lookup_image_columns,
+        divider_lookup,
+        array_corrective_factors,
+        _return_lookup_table_fine(lookup_table_fine),
+        first_bin_fine,
+    )
+
+
 def compute_normalized_image_per_lipid(
     lb_mz,
     hb_mz,
@@ -1324,20 +1659,16 @@ def global_lipid_index_store(data, slice_index, l_spectra):
     """
     logging.info("Starting computing ll_idx_labels")
     ll_idx_labels = []
+
+    # Get annotation boundaries for current slice
+    array_min, array_max = data.get_annotation_bounds_per_slice(slice_index)
     for spectrum in l_spectra:
         if spectrum is not None:
             # Get the average spectrum and add it to m/z plot
             grah_scattergl_data = np.array(spectrum, dtype=np.float32)
 
-            # Get df for current slice
-            df_names = data.get_annotations()[data.get_annotations()["slice"] == slice_index]
-
             # Extract lipid names
-            l_idx_labels = return_index_labels(
-                df_names["min"].to_numpy(),
-                df_names["max"].to_numpy(),
-                grah_scattergl_data[0, :],
-            )
+            l_idx_labels = return_index_labels(array_min, array_max, grah_scattergl_data[0, :])
         else:
             l_idx_labels = None
 
@@ -1356,12 +1687,16 @@ def compute_thread_safe_function(
     compute_function, cache, data, slice_index, *args_compute_function, **kwargs_compute_function
 ):
     """This function is a wrapper for safe multithreading and multiprocessing execution of
-    compute_function. This is needed due to the regular cleansing of memory-mapped object.
+    compute_function. The data is locked for reading during the computation, such that the
+    memory-mapped objects can't be cleaned meanwhile.
 
     Args:
         compute_function (func): The function/method whose result must be loaded/saved.
-        cache (flask_caching.Cache): A caching object, used to check if the reading of memory-mapped
-            data is safe
+        cache (flask_caching.Cache): A caching object. Not used for locking anymore, as the data is
+            locked with its own read/write lock (see MaldiData.get_lock()).
+        data (MaldiData): The data read by compute_function. It is locked for reading during the
+            computation, and the memory used by its memory-mapped arrays is released afterwards.
+        slice_index (int): Index of the slice whose memory-mapped arrays must be released.
         *args_compute_function: Arguments of compute_function.
         **kwargs_compute_function: Named arguments of compute_function.
 
@@ -1374,31 +1709,24 @@ def compute_thread_safe_function(
         + str(compute_function).split("<")[1].split("at")[0]
     )
 
-    if cache is not None:
-        # Wait for the data to be safe for reading
-        while cache.get("locked-cleaning"):
-            time.sleep(0.05)
-
-        # Lock it while while it's being read
-        cache.set("locked-reading", True)
-
+    if data is not None:
+        # Prevent the memory-mapped data from being cleaned while it's being read
+        lock = data.get_lock().read_lock()
     else:
-        logging.warning("No cache provided, the thread unsafe version of the function will be run")
+        logging.warning("No data provided, the thread unsafe version of the function will be run")
+        lock = nullcontext()
 
     # Run the actual function
-    try:
-        result = compute_function(*args_compute_function, **kwargs_compute_function)
-    except:
-        logging.warning('The function "%s" failed to run' % str(compute_function))
-        result = None
-
-    if cache is not None:
-        # Unlock the data
-        cache.set("locked-reading", False)
+    with lock:
+        try:
+            result = compute_function(*args_compute_function, **kwargs_compute_function)
+        except:
+            logging.warning('The function "%s" failed to run' % str(compute_function))
+            result = None
 
     if data is not None:
-        # Clean the memory-mapped data
-        data.clean_memory(slice_index=slice_index, cache=cache)
+        # Release the memory used by the memory-mapped data
+        data.release_memory(slice_index=slice_index)
 
     # Return result
     return result
@@ -518,27 +518,12 @@ def page_2_plot_graph_heatmap_mz_selection(
 
             # Build the list of mz boundaries for each peak
             ll_lipid_bounds = [
-                [
-                    (
-                        float(data.get_annotations().iloc[index]["min"]),
-                        float(data.get_annotations().iloc[index]["max"]),
-                    )
-                ]
-                if index != -1
-                else None
+                [data.get_annotation_bounds(index)] if index != -1 else None
                 for index in [lipid_1_index, lipid_2_index, lipid_3_index]
             ]
 
             ll_lipid_names = [
-                [
-                    data.get_annotations().iloc[index]["name"]
-                    + "_"
-                    + data.get_annotations().iloc[index]["structure"]
-                    + "_"
-                    + data.get_annotations().iloc[index]["cation"]
-                ]
-                if index != -1
-                else None
+                [data.compute_l_labels()[index]] if index != -1 else None
                 for index in [lipid_1_index, lipid_2_index, lipid_3_index]
             ]
 
@@ -1039,30 +1024,12 @@ def page_2_add_toast_selection(
                     name, structure, cation = header.split(" ")
 
                     # Find lipid location
-                    l_lipid_loc_temp = (
-                        data.get_annotations()
-                        .index[
-                            (data.get_annotations()["name"] == name)
-                            & (data.get_annotations()["structure"] == structure)
-                            & (data.get_annotations()["cation"] == cation)
-                        ]
-                        .tolist()
-                    )
-                    l_lipid_loc = [
-                        l_lipid_loc_temp[i]
-                        for i, x in enumerate(
-                            data.get_annotations().iloc[l_lipid_loc_temp]["slice"] == slice_index
-                        )
-                        if x
-                    ]
-
-                    # Fill list with first annotation that exists if it can't find one for the
-                    # current slice
-                    if len(l_lipid_loc) == 0:
-                        l_lipid_loc = l_lipid_loc_temp[:1]
-
-                    # Record location and lipid name
-                    lipid_index = l_lipid_loc[0]
+                    lipid_index = data.get_annotation_index(name, structure, cation, slice_index)
+
+                    # Take the first annotation that exists if it can't find one for the current
+                    # slice
+                    if lipid_index == -1:
+                        lipid_index = data.get_annotation_index(name, structure, cation)
 
                     # If lipid has already been selected before, replace the index
                     if header_1 == header:
@@ -1091,37 +1058,14 @@ def page_2_add_toast_selection(
             name, structure, cation = l_lipid_names[-1].split(" ")
 
             # Find lipid location
-            l_lipid_loc = (
-                data.get_annotations()
-                .index[
-                    (data.get_annotations()["name"] == name)
-                    & (data.get_annotations()["structure"] == structure)
-                    & (data.get_annotations()["slice"] == slice_index)
-                    & (data.get_annotations()["cation"] == cation)
-                ]
-                .tolist()
-            )
-
-            # If several lipids correspond to the selection, we have a problem...
-            if len(l_lipid_loc) > 1:
-                logging.warning("More than one lipid corresponds to the selection")
-                l_lipid_loc = [l_lipid_loc[-1]]
+            lipid_index = data.get_annotation_index(name, structure, cation, slice_index)
 
-            if len(l_lipid_loc) < 1:
+            if lipid_index == -1:
                 logging.warning("No lipid annotation exist. Taking another slice annotation")
-                l_lipid_loc = (
-                    data.get_annotations()
-                    .index[
-                        (data.get_annotations()["name"] == name)
-                        & (data.get_annotations()["structure"] == structure)
-                        & (data.get_annotations()["cation"] == cation)
-                    ]
-                    .tolist()
-                )[:1]
+                lipid_index = data.get_annotation_index(name, structure, cation)
                 # return dash.no_update
 
-            # Record location and lipid name
-            lipid_index = l_lipid_loc[0]
+            # Record lipid name
             lipid_string = name + " " + structure + " " + cation
 
             change_made = False
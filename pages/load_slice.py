@@ -12,12 +12,12 @@ import dash_bootstrap_components as dbc
 from dash import dcc, html
 from dash.dependencies import Input, Output, State
 import dash
-import numpy as np
 import logging
 import dash_mantine_components as dmc
 
 # LBAE imports
 from app import app, figures, storage, atlas
+from modules.tools.image import parse_relayout_ranges
 
 # ==================================================================================================
 # --- Layout
@@ -96,11 +96,7 @@ def return_layout(basic_config, slice_index):
                                 "scale": 2,
                             }
                         },
-                        figure=storage.return_shelved_object(
-                            "figures/load_page",
-                            "figure_basic_image",
-                            force_update=False,
-                            compute_function=figures.compute_figure_basic_image,
+                        figure=figures.compute_figure_basic_image_tiled(
                             type_figure="projection_corrected",
                             index_image=slice_index - 1,
                             plot_atlas_contours=False,
@@ -120,6 +116,7 @@ def return_layout(basic_config, slice_index):
                             "top": "7%",
                         },
                     ),
+                    dcc.Store(id="page-1-store-viewport"),
                 ],
                 # ),
             ),
@@ -172,19 +169,55 @@ def return_layout(basic_config, slice_index):
 # ==================================================================================================
 
 
+app.clientside_callback(
+    """
+    function(relayoutData) {
+        var graph = document.getElementById("page-1-graph-slice-selection");
+        var width = graph ? graph.offsetWidth * (window.devicePixelRatio || 1) : null;
+        return {"relayoutData": relayoutData, "width": width};
+    }
+    """,
+    Output("page-1-store-viewport", "data"),
+    Input("page-1-graph-slice-selection", "relayoutData"),
+)
+"""This clientside callback is used to record the relayoutData of page-1-graph-slice-selection,
+along with the width of the graph in device pixels, used to choose the zoom level of the tiles."""
+
+
 @app.callback(
     Output("page-1-graph-slice-selection", "figure"),
     Output("page-1-toggle-annotations", "disabled"),
     Input("main-slider", "data"),
     Input("page-1-card-tabs", "value"),
     Input("page-1-toggle-annotations", "checked"),
+    Input("page-1-store-viewport", "data"),
 )
-def tab_1_load_image(value_slider, active_tab, display_annotations):
-    """This callback is used to update the image in page-1-graph-slice-selection from the slider."""
+def tab_1_load_image(value_slider, active_tab, display_annotations, viewport):
+    """This callback is used to update the image in page-1-graph-slice-selection from the slider,
+    and to load the tiles matching the viewport and the size of the graph when zooming, panning or
+    resizing."""
 
     # Find out which input triggered the function
     id_input, value_input = dash.callback_context.triggered[0]["prop_id"].split(".")
 
+    relayoutData, display_width = None, None
+    if viewport is not None:
+        relayoutData, display_width = viewport["relayoutData"], viewport["width"]
+
+    # Only the tiles of the viewport are loaded, so zooming requires to update the figure
+    x_range, y_range = None, None
+    if id_input == "page-1-store-viewport":
+        if relayoutData is None:
+            return dash.no_update
+        x_range, y_range = parse_relayout_ranges(relayoutData)
+        if (
+            x_range is None
+            and y_range is None
+            and "xaxis.autorange" not in relayoutData
+            and "autosize" not in relayoutData
+        ):
+            return dash.no_update
+
     if active_tab == "0":
         disabled = True
     else:
@@ -204,14 +237,13 @@ def tab_1_load_image(value_slider, active_tab, display_annotations):
 
         # Force no annotation for the original data
         return (
-            storage.return_shelved_object(
-                "figures/load_page",
-                "figure_basic_image",
-                force_update=False,
-                compute_function=figures.compute_figure_basic_image,
+            figures.compute_figure_basic_image_tiled(
                 type_figure=dic_mapping_tab_indices[active_tab],
                 index_image=value_slider - 1,
                 plot_atlas_contours=display_annotations if active_tab != "0" else False,
+                x_range=x_range,
+                y_range=y_range,
+                display_width=display_width,
             ),
             disabled,
         )
@@ -251,15 +283,11 @@ def page_1_hover(hoverData, slice_index):
     if hoverData is not None:
         if len(hoverData["points"]) > 0:
             x = int(slice_index) - 1
-            z = hoverData["points"][0]["x"]
-            y = hoverData["points"][0]["y"]
+            z = int(round(hoverData["points"][0]["x"]))
+            y = int(round(hoverData["points"][0]["y"]))
 
-            slice_coor_rescaled = np.asarray(
-                (atlas.array_coordinates_warped_data[x, y, z] * 1000 / atlas.resolution).round(0),
-                dtype=np.int16,
-            )
             try:
-                label = atlas.labels[tuple(slice_coor_rescaled)]
+                label = atlas.labels.array_names[atlas.array_label_planes[x, y, z]]
             except:
                 label = "undefined"
             return "Hovered region: " + label
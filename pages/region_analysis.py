@@ -22,9 +22,10 @@ from numba import njit
 import dash_mantine_components as dmc
 
 # LBAE imports
-from app import app, figures, data, storage, atlas, cache_flask
+from app import app, figures, data, atlas, cache_flask
 import config
-from modules.tools.image import convert_image_to_base64
+from modules.tools.image import convert_image_to_base64, parse_relayout_ranges
+from modules.tools.atlas import compute_mask_overlay
 from modules.tools.spectra import (
     sample_rows_from_path,
     compute_spectrum_per_row_selection,
@@ -82,11 +83,7 @@ def return_layout(basic_config, slice_index=1):
                             "position": "absolute",
                             "left": "2.5%",
                         },
-                        figure=storage.return_shelved_object(
-                            "figures/load_page",
-                            "figure_basic_image",
-                            force_update=False,
-                            compute_function=figures.compute_figure_basic_image,
+                        figure=figures.compute_figure_basic_image_tiled(
                             type_figure="projection_corrected",
                             index_image=slice_index - 1,
                             plot_atlas_contours=False,
@@ -100,6 +97,7 @@ def return_layout(basic_config, slice_index=1):
                             autosize=True,
                         ),
                     ),
+                    dcc.Store(id="page-3-store-graph-width"),
                     dmc.Text(
                         "Hovered region: ",
                         id="page-3-graph-hover-text",
@@ -853,15 +851,11 @@ def page_3_hover(hoverData, slice_index):
     if hoverData is not None:
         if len(hoverData["points"]) > 0:
             x = int(slice_index) - 1
-            z = hoverData["points"][0]["x"]
-            y = hoverData["points"][0]["y"]
+            z = int(round(hoverData["points"][0]["x"]))
+            y = int(round(hoverData["points"][0]["y"]))
 
-            slice_coor_rescaled = np.asarray(
-                (atlas.array_coordinates_warped_data[x, y, z] * 1000 / atlas.resolution).round(0),
-                dtype=np.int16,
-            )
             try:
-                label = atlas.labels[tuple(slice_coor_rescaled)]
+                label = atlas.labels.array_names[atlas.array_label_planes[x, y, z]]
             except:
                 label = "undefined"
             return "Hovered region: " + label
@@ -880,6 +874,20 @@ def page_3_reset_layout(cliked_reset, url):
     return {}
 
 
+app.clientside_callback(
+    """
+    function(relayoutData) {
+        var graph = document.getElementById("page-3-graph-heatmap-per-sel");
+        return graph ? graph.offsetWidth * (window.devicePixelRatio || 1) : null;
+    }
+    """,
+    Output("page-3-store-graph-width", "data"),
+    Input("page-3-graph-heatmap-per-sel", "relayoutData"),
+)
+"""This clientside callback is used to record the width of page-3-graph-heatmap-per-sel in device
+pixels, used to choose the zoom level of the tiles."""
+
+
 @app.callback(
     Output("page-3-graph-heatmap-per-sel", "figure"),
     Output("dcc-store-color-mask", "data"),
@@ -893,6 +901,7 @@ def page_3_reset_layout(cliked_reset, url):
     State("dcc-store-color-mask", "data"),
     State("dcc-store-reset", "data"),
     State("dcc-store-shapes-and-masks", "data"),
+    State("page-3-store-graph-width", "data"),
     prevent_inital_call=True,
 )
 def page_3_plot_heatmap(
@@ -904,6 +913,7 @@ def page_3_plot_heatmap(
     l_color_mask,
     reset,
     l_shapes_and_masks,
+    display_width,
 ):
     """This callback is used to plot the main heatmap of the page."""
 
@@ -920,14 +930,11 @@ def page_3_plot_heatmap(
         or id_input == "page-3-reset-button"
         or id_input == "url"
     ):
-        fig = storage.return_shelved_object(
-            "figures/load_page",
-            "figure_basic_image",
-            force_update=False,
-            compute_function=figures.compute_figure_basic_image,
+        fig = figures.compute_figure_basic_image_tiled(
             type_figure="projection_corrected",
             index_image=slice_index - 1,
             plot_atlas_contours=False,
+            display_width=display_width,
         )
         fig.update_layout(
             dragmode="drawclosedpath",
@@ -949,14 +956,11 @@ def page_3_plot_heatmap(
         and cliked_reset is None
         and (l_mask_name is None or len(l_mask_name) == 0)
     ):
-        fig = storage.return_shelved_object(
-            "figures/load_page",
-            "figure_basic_image",
-            force_update=False,
-            compute_function=figures.compute_figure_basic_image,
+        fig = figures.compute_figure_basic_image_tiled(
             type_figure="projection_corrected",
             index_image=slice_index - 1,
             plot_atlas_contours=False,
+            display_width=display_width,
         )
 
         fig.update_layout(
@@ -972,15 +976,15 @@ def page_3_plot_heatmap(
     if id_input == "page-3-graph-heatmap-per-sel" or id_input == "page-3-dropdown-brain-regions":
         # Check that a mask has actually been selected
         if l_mask_name is not None or relayoutData is not None:
-            # Rebuild figure
-            fig = storage.return_shelved_object(
-                "figures/load_page",
-                "figure_basic_image",
-                force_update=False,
-                compute_function=figures.compute_figure_basic_image,
+            # Rebuild figure, with the tiles of the current viewport
+            x_range, y_range = parse_relayout_ranges(relayoutData)
+            fig = figures.compute_figure_basic_image_tiled(
                 type_figure="projection_corrected",
                 index_image=slice_index - 1,
                 plot_atlas_contours=False,
+                x_range=x_range,
+                y_range=y_range,
+                display_width=display_width,
             )
             color_idx = None
             col_next = None
@@ -990,18 +994,12 @@ def page_3_plot_heatmap(
                     for idx_mask, mask_name in enumerate(l_mask_name):
                         id_name = atlas.dic_name_acronym[mask_name]
                         if id_name in atlas.dic_existing_masks[slice_index - 1]:
-                            projected_mask = atlas.get_projected_mask_and_spectrum(
+                            array_mask_runs = atlas.get_projected_mask_and_spectrum(
                                 slice_index - 1, mask_name, MAIA_correction=False
                             )[0]
                         else:
                             logging.warning("The mask " + str(mask_name) + " couldn't be found")
 
-                        # Build a list of empty images and add selected lipids for each channel
-                        normalized_projected_mask = projected_mask / np.max(projected_mask)
-
-                        # Correct bug with atlas projection
-                        normalized_projected_mask[:, :10] = 0
-
                         if idx_mask < len(l_color_mask):
                             color_rgb = l_color_mask[idx_mask]
                         else:
@@ -1013,12 +1011,14 @@ def page_3_plot_heatmap(
                             color_rgb = [int(color[i : i + 2], 16) for i in (0, 2, 4)] + [200]
                             l_color_mask.append(color_rgb)
 
-                        l_images = [
-                            normalized_projected_mask * color
-                            for c, color in zip(["r", "g", "b", "a"], color_rgb)
-                        ]
-                        # Reoder axis to match plotly go.image requirements
-                        array_image = np.moveaxis(np.array(l_images, dtype=np.uint8), 0, 2)
+                        # Color the mask directly from its runs (the first columns are left empty
+                        # to correct a bug with atlas projection)
+                        array_image = compute_mask_overlay(
+                            array_mask_runs,
+                            tuple(atlas.image_shape),
+                            np.array(color_rgb, dtype=np.uint8),
+                            min_column=10,
+                        )
 
                         # Convert image to string to save space (new image as each mask must have a
                         # different color)
@@ -1872,15 +1872,9 @@ def page_3_draw_heatmap_per_lipid_selection(
                 l_idx_lipids = list(df_avg_intensity_lipids.index)
 
                 # Replace idx_lipids by actual name
-                df_names = data.get_annotations()[data.get_annotations()["slice"] == slice_index]
-
-
+                l_labels_slice = data.compute_l_labels(slice_index)
                 df_avg_intensity_lipids.index = df_avg_intensity_lipids.index.map(
-                    lambda idx: df_names.iloc[idx]["name"]
-                    + "_"
-                    + df_names.iloc[idx]["structure"]
-                    + "_"
-                    + df_names.iloc[idx]["cation"]
+                    lambda idx: l_labels_slice[idx]
                 )
 
                 # Plot
@@ -1998,15 +1992,8 @@ def page_3_fill_dropdown_options(l_idx_lipids, cliked_reset, slice_index, n_clic
         if l_idx_lipids is not None:
             if len(l_idx_lipids) > 0:
                 logging.info("Starting computing lipid dropdown now.")
-                df_names = data.get_annotations()[data.get_annotations()["slice"] == slice_index]
-                l_names = [
-                    df_names.iloc[idx]["name"]
-                    + "_"
-                    + df_names.iloc[idx]["structure"]
-                    + "_"
-                    + df_names.iloc[idx]["cation"]
-                    for idx in l_idx_lipids
-                ]
+                l_labels_slice = data.compute_l_labels(slice_index)
+                l_names = [l_labels_slice[idx] for idx in l_idx_lipids]
                 options = [
                     {"label": name, "value": str(idx)} for name, idx in zip(l_names, l_idx_lipids)
                 ]
@@ -2120,14 +2107,11 @@ def draw_modal_graph(
     # Check that at least one lipid has been selected
     if len(l_red_lipids + l_green_lipids + l_blue_lipids) > 0:
         logging.info("At least one lipid has been selected, starting computing modal graph now.")
-        df_names = data.get_annotations()[data.get_annotations()["slice"] == slice_index]
+        array_min, array_max = data.get_annotation_bounds_per_slice(slice_index)
         # Build the list of mz boundaries for each peak
         l_lipid_bounds = [
             [
-                (
-                    float(df_names.iloc[int(index)]["min"]),
-                    float(df_names.iloc[int(index)]["max"]),
-                )
+                (float(array_min[int(index)]), float(array_max[int(index)]))
                 if int(index) != -1
                 else None
                 for index in l_lipids
@@ -911,14 +911,7 @@ def page_4_plot_graph_volume(
             # Build the list of mz boundaries for each peak and each index
             lll_lipid_bounds = [
                 [
-                    [
-                        (
-                            float(data.get_annotations().iloc[index]["min"]),
-                            float(data.get_annotations().iloc[index]["max"]),
-                        )
-                    ]
-                    if index != -1
-                    else None
+                    [data.get_annotation_bounds(index)] if index != -1 else None
                     for index in [lipid_1_index, lipid_2_index, lipid_3_index]
                 ]
                 for lipid_1_index, lipid_2_index, lipid_3_index in zip(
@@ -1181,23 +1174,8 @@ def page_4_add_toast_selection(
     # Otherwise, add lipid to selection
     elif cation is not None and id_input == "page-4-add-lipid-button":
         for idx_slice_index, slice_index in enumerate(data.get_slice_list(indices=brain)):
-            # Find lipid location
-            l_lipid_loc = (
-                data.get_annotations()
-                .index[
-                    (data.get_annotations()["name"] == name)
-                    & (data.get_annotations()["structure"] == structure)
-                    & (data.get_annotations()["slice"] == slice_index)
-                    & (data.get_annotations()["cation"] == cation)
-                ]
-                .tolist()
-            )
-            # If several lipids correspond to the selection, we have a problem...
-            if len(l_lipid_loc) > 1:
-                logging.warning("More than one lipid corresponds to the selection")
-                l_lipid_loc = [l_lipid_loc[-1]]
-            if len(l_lipid_loc) == 0:
-                l_lipid_loc = [-1]
+            # Find lipid location (-1 if the lipid is not annotated in the slice)
+            l_lipid_loc = [data.get_annotation_index(name, structure, cation, slice_index)]
 
             lipid_string = name + " " + structure + " " + cation
 
@@ -1253,23 +1231,8 @@ def page_4_add_toast_selection(
             if header != "":
                 name, structure, cation = header.split(" ")
                 for idx_slice_index, slice_index in enumerate(data.get_slice_list(indices=brain)):
-                    # Find lipid location
-                    l_lipid_loc = (
-                        data.get_annotations()
-                        .index[
-                            (data.get_annotations()["name"] == name)
-                            & (data.get_annotations()["structure"] == structure)
-                            & (data.get_annotations()["slice"] == slice_index)
-                            & (data.get_annotations()["cation"] == cation)
-                        ]
-                        .tolist()
-                    )
-                    # If several lipids correspond to the selection, we have a problem...
-                    if len(l_lipid_loc) > 1:
-                        logging.warning("More than one lipid corresponds to the selection")
-                        l_lipid_loc = [l_lipid_loc[-1]]
-                    if len(l_lipid_loc) == 0:
-                        l_lipid_loc = [-1]
+                    # Find lipid location (-1 if the lipid is not annotated in the slice)
+                    l_lipid_loc = [data.get_annotation_index(name, structure, cation, slice_index)]
 
                     if idx_slice_index == 0:
                         l_selected_lipids.append(l_lipid_loc[0])